@@ -0,0 +1,239 @@
+"""
+Benchmark both allocation engines over the fixtures.
+
+    python benchmark_allocation.py                                  # all fixtures, both engines
+    python benchmark_allocation.py --engine v2 --runs 10 ../fixtures/soll_noflex_validation.json
+    python benchmark_allocation.py --output baseline.json
+    python benchmark_allocation.py --baseline baseline.json         # run and flag regressions
+    python benchmark_allocation.py --results new.json --baseline baseline.json   # compare only
+
+Every fixture is allocated --warmup times without measuring, then --runs times measuring the
+wall time and the time per phase, and once more with tracemalloc for the peak memory.
+"""
+import argparse
+import datetime
+import glob
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+from kjk.allocation import Allocator
+from kjk.inputdata import RedisDataprovider
+from v2.allocate import allocate
+from v2.conf import trace_context
+from v2.parse import Parse
+
+FIXTURES = "../fixtures/**/*.json"
+ENGINES = ("v1", "v2")
+
+
+class PhaseTimer:
+    """sums the time spent in every phase, a phase can be entered more than once"""
+
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self.phase = None
+        self.start = None
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        if self.phase is not None:
+            self.phases[self.phase] += now - self.start
+        self.phase = phase
+        self.start = now
+
+    def stop(self):
+        self.enter(None)
+        return dict(self.phases)
+
+
+class BenchmarkAllocator(Allocator):
+    def __init__(self, dp, phase_timer):
+        self.phase_timer = phase_timer
+        super().__init__(dp)
+
+    def set_allocation_phase(self, phase_id):
+        self.phase_timer.enter(phase_id)
+        super().set_allocation_phase(phase_id)
+
+
+def run_v1(data):
+    """returns the duration per allocation phase"""
+    phase_timer = PhaseTimer()
+    phase_timer.enter("init")
+    allocator = BenchmarkAllocator(RedisDataprovider(data), phase_timer)
+    allocator.get_allocation()
+    return phase_timer.stop()
+
+
+def run_v2(data):
+    """returns the duration per epic, as timed by the trace"""
+    with trace_context() as allocation_trace:
+        parsed = Parse(data)
+        allocate(**parsed.__dict__)
+    summary = allocation_trace.get_summary()
+    return {epic: epic_summary["duration"] for epic, epic_summary in summary["epics"].items()}
+
+
+RUNNERS = {
+    "v1": run_v1,
+    "v2": run_v2,
+}
+
+
+def get_engines(data):
+    """the v2 parser needs the rows with the bakType of every kraam, older inputs are v1 only"""
+    rows = data.get("rows")
+    if rows and all("bakType" in kraam for row in rows for kraam in row):
+        return ENGINES
+    return ("v1",)
+
+
+def load_fixtures(paths):
+    """the allocation inputs with the engines that can allocate them, fixtures with an allocation output are skipped"""
+    fixtures = {}
+    for path in sorted(paths or glob.glob(FIXTURES, recursive=True)):
+        with open(path) as f:
+            data = json.load(f)
+        data = data.get("data", data)
+        if "marktDate" not in data or "toewijzingen" in data:
+            continue
+        fixtures[path] = (json.dumps(data), get_engines(data))
+    return fixtures
+
+
+def run_once(engine, json_data):
+    # every run gets its own copy of the input, the allocation can change it
+    data = json.loads(json_data)
+    start = time.perf_counter()
+    phases = RUNNERS[engine](data)
+    wall_time = time.perf_counter() - start
+    return wall_time, phases
+
+
+def measure_peak_memory(engine, json_data):
+    data = json.loads(json_data)
+    tracemalloc.start()
+    try:
+        RUNNERS[engine](data)
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def benchmark(engine, json_data, runs, warmup):
+    for _ in range(warmup):
+        run_once(engine, json_data)
+    wall_times = []
+    phase_times = defaultdict(list)
+    for _ in range(runs):
+        wall_time, phases = run_once(engine, json_data)
+        wall_times.append(wall_time)
+        for phase, duration in phases.items():
+            phase_times[phase].append(duration)
+    return {
+        "wall_time": {
+            "median": statistics.median(wall_times),
+            "min": min(wall_times),
+            "max": max(wall_times),
+            "runs": wall_times,
+        },
+        "peak_memory": measure_peak_memory(engine, json_data),
+        "phases": {phase: statistics.median(durations) for phase, durations in phase_times.items()},
+    }
+
+
+def run_benchmarks(fixtures, engines, runs, warmup):
+    results = {}
+    for path, (json_data, fixture_engines) in fixtures.items():
+        for engine in engines:
+            key = f"{engine}:{path}"
+            if engine not in fixture_engines:
+                print(f"{key}: skipped, input format not supported", file=sys.stderr)
+                continue
+            try:
+                result = benchmark(engine, json_data, runs, warmup)
+                print(f"{key}: {result['wall_time']['median']:.3f} sec, "
+                      f"{result['peak_memory'] / 2 ** 20:.1f} MB", file=sys.stderr)
+            except Exception as e:
+                result = {"error": repr(e)}
+                print(f"{key}: error {e!r}", file=sys.stderr)
+            results[key] = result
+    return {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": runs,
+            "warmup": warmup,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold, min_delta):
+    """returns the regressions: a new error, a slower median wall time or a higher peak memory than the baseline"""
+    regressions = []
+    for key, result in current["results"].items():
+        base = baseline["results"].get(key)
+        if "error" in result:
+            if base is None or "error" not in base:
+                regressions.append(f"{key}: error {result['error']}")
+            continue
+        if base is None or "error" in base:
+            continue
+        base_time, new_time = base["wall_time"]["median"], result["wall_time"]["median"]
+        if new_time > base_time * (1 + threshold) and new_time - base_time > min_delta:
+            regressions.append(f"{key}: wall time {base_time:.3f} -> {new_time:.3f} sec "
+                               f"(+{(new_time / base_time - 1) * 100:.0f}%)")
+        base_memory, new_memory = base["peak_memory"], result["peak_memory"]
+        if new_memory > base_memory * (1 + threshold):
+            regressions.append(f"{key}: peak memory {base_memory / 2 ** 20:.1f} -> {new_memory / 2 ** 20:.1f} MB "
+                               f"(+{(new_memory / base_memory - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the v1 and v2 allocation engines over the fixtures")
+    parser.add_argument("fixtures", nargs="*", help=f"fixture json files (default: {FIXTURES})")
+    parser.add_argument("--engine", nargs="+", choices=ENGINES, default=ENGINES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", default="benchmark_results.json", help="results file")
+    parser.add_argument("--results", help="compare this results file instead of running the benchmarks")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed relative increase")
+    parser.add_argument("--min-delta", type=float, default=0.02, help="ignored wall time increase in seconds")
+    args = parser.parse_args()
+
+    if args.results:
+        with open(args.results) as f:
+            current = json.load(f)
+    else:
+        # the allocation logs are collected, but not printed
+        logging.disable(logging.CRITICAL)
+        current = run_benchmarks(load_fixtures(args.fixtures), args.engine, args.runs, args.warmup)
+        logging.disable(logging.NOTSET)
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=4)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold, args.min_delta)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Generate synthetic markets to see how the allocation engines scale.
+
+    python generate_market.py --rows 40 --kramen-per-row 25 --ondernemers 900 --output big_market.json
+    python generate_market.py --scaling 100 200 400 800 1600 --engine v1 v2 --output scaling.json
+
+A generated market is valid input for both the v1 and the v2 allocation.
+With --scaling every size is the number of kramen of a generated market (with --kramen-per-row
+kramen per row, ondernemers-per-kraam ondernemers per kraam and the other flags for the market shape),
+the allocation of every market is benchmarked like benchmark_allocation.py does and the wall time
+and peak memory per size are written to the output file.
+"""
+import argparse
+import json
+import logging
+import random
+import sys
+
+from faker import Faker
+
+from kjk.inputdata import MockDataprovider
+
+BASE_FIXTURE = "../fixtures/test_input.json"
+
+
+class MarketGenerator:
+    """
+    Builds a market with the MockDataprovider builder api, the structure is random but
+    reproducible for a seed: the same arguments and seed give the same market.
+    """
+
+    def __init__(
+        self,
+        rows=10,
+        kramen_per_row=20,
+        ondernemers=300,
+        branches=10,
+        verplichte_branche_ratio=0.3,
+        branche_kraam_ratio=0.2,
+        bak_ratio=0.1,
+        bak_licht_ratio=0.05,
+        evi_ratio=0.05,
+        vpl_ratio=0.4,
+        attending_ratio=0.9,
+        min_prefs=1,
+        max_prefs=6,
+        max_kramen_per_ondernemer=3,
+        seed=1,
+        base_fixture=BASE_FIXTURE,
+    ):
+        self.rows = rows
+        self.kramen_per_row = kramen_per_row
+        self.num_ondernemers = ondernemers
+        self.num_branches = branches
+        self.verplichte_branche_ratio = verplichte_branche_ratio
+        self.branche_kraam_ratio = branche_kraam_ratio
+        self.bak_ratio = bak_ratio
+        self.bak_licht_ratio = bak_licht_ratio
+        self.evi_ratio = evi_ratio
+        self.vpl_ratio = vpl_ratio
+        self.attending_ratio = attending_ratio
+        self.min_prefs = min_prefs
+        self.max_prefs = max_prefs
+        self.max_kramen_per_ondernemer = max_kramen_per_ondernemer
+        self.base_fixture = base_fixture
+
+        self.random = random.Random(seed)
+        self.fake = Faker(["nl_NL"])
+        self.fake.seed_instance(seed)
+
+    def choose_bak_type(self):
+        value = self.random.random()
+        if value < self.bak_ratio:
+            return "bak"
+        if value < self.bak_ratio + self.bak_licht_ratio:
+            return "bak-licht"
+        return "geen"
+
+    def choose_verkoopinrichting(self):
+        return ["eigen-materieel"] if self.random.random() < self.evi_ratio else []
+
+    def create_branches(self, dp):
+        branches = []
+        for i in range(self.num_branches):
+            branche = {
+                "brancheId": f"{101 + i}-{self.fake.word()}",
+                "number": 101 + i,
+                "description": self.fake.word(),
+                "color": self.fake.hex_color(),
+            }
+            if self.random.random() < self.verplichte_branche_ratio:
+                branche["verplicht"] = True
+                branche["maximumPlaatsen"] = self.random.randint(1, max(1, self.rows * self.kramen_per_row // 10))
+            dp.add_branche(**branche)
+            branches.append(branche)
+        return branches
+
+    def create_kramen(self, dp, branches):
+        verplichte_branches = [branche["brancheId"] for branche in branches if branche.get("verplicht")]
+        rows = []
+        plaats_id = 1
+        for _ in range(self.rows):
+            row = []
+            for _ in range(self.kramen_per_row):
+                kraam_branches = []
+                if verplichte_branches and self.random.random() < self.branche_kraam_ratio:
+                    kraam_branches = [self.random.choice(verplichte_branches)]
+                kraam = {
+                    "plaatsId": str(plaats_id),
+                    "branches": kraam_branches,
+                    "verkoopinrichting": self.choose_verkoopinrichting(),
+                    "properties": [],
+                    "bakType": self.choose_bak_type(),
+                }
+                dp.add_stand(**kraam)
+                row.append(kraam)
+                plaats_id += 1
+            dp.add_page([kraam["plaatsId"] for kraam in row])
+            rows.append(row)
+        return rows
+
+    def take_own_kramen(self, rows, taken, amount):
+        """adjacent kramen in a random row that are not taken by another vpl yet"""
+        for _ in range(10):
+            row = self.random.choice(rows)
+            start = self.random.randrange(len(row))
+            kramen = row[start:start + amount]
+            if len(kramen) == amount and not any(kraam["plaatsId"] in taken for kraam in kramen):
+                taken.update(kraam["plaatsId"] for kraam in kramen)
+                return kramen
+        return []
+
+    def create_prefs(self, dp, rows, erkenningsnummer):
+        num_prefs = self.random.randint(self.min_prefs, self.max_prefs)
+        row = self.random.choice(rows)
+        start = self.random.randrange(len(row))
+        for priority, kraam in enumerate(reversed(row[start:start + num_prefs])):
+            dp.add_pref(erkenningsNummer=erkenningsnummer, plaatsId=kraam["plaatsId"], priority=priority + 1)
+
+    def create_ondernemers(self, dp, rows, branches):
+        branche_ids = [branche["brancheId"] for branche in branches]
+        taken = set()
+        erkenningsnummers = set()
+        rsvps = []
+        for rank in range(1, self.num_ondernemers + 1):
+            erkenningsnummer = f"{self.random.randrange(10 ** 10):010d}"
+            while erkenningsnummer in erkenningsnummers:
+                erkenningsnummer = f"{self.random.randrange(10 ** 10):010d}"
+            erkenningsnummers.add(erkenningsnummer)
+            maximum = self.random.randint(1, self.max_kramen_per_ondernemer)
+            minimum = self.random.randint(1, maximum)
+            own_kramen = []
+            if self.random.random() < self.vpl_ratio:
+                own_kramen = self.take_own_kramen(rows, taken, minimum)
+            status = "vpl" if own_kramen else "soll"
+            # a vpl usually has the branche and kraam type of the own kramen
+            own_branches = [branche for kraam in own_kramen for branche in kraam["branches"]]
+            branche_id = own_branches[0] if own_branches else self.random.choice(branche_ids)
+            bak_type = own_kramen[0]["bakType"] if own_kramen else self.choose_bak_type()
+            verkoopinrichting = own_kramen[0]["verkoopinrichting"] if own_kramen else self.choose_verkoopinrichting()
+            dp.add_merchant(
+                description=self.fake.last_name(),
+                erkenningsNummer=erkenningsnummer,
+                plaatsen=[kraam["plaatsId"] for kraam in own_kramen],
+                voorkeur={
+                    "erkenningsNummer": erkenningsnummer,
+                    "maximum": maximum,
+                    "minimum": minimum,
+                    "anywhere": status == "soll" and self.random.random() < 0.5,
+                    "brancheId": branche_id,
+                    "branches": [branche_id],
+                    "bakType": bak_type,
+                    "verkoopinrichting": verkoopinrichting,
+                    "absentFrom": None,
+                    "absentUntil": None,
+                },
+                sollicitatieNummer=rank,
+                status=status,
+            )
+            self.create_prefs(dp, rows, erkenningsnummer)
+            if status == "soll" and self.random.random() < self.attending_ratio:
+                rsvps.append(erkenningsnummer)
+        return rsvps
+
+    def generate(self):
+        dp = MockDataprovider(self.base_fixture)
+        branches = self.create_branches(dp)
+        rows = self.create_kramen(dp, branches)
+        rsvps = self.create_ondernemers(dp, rows, branches)
+        for erkenningsnummer in rsvps:
+            dp.add_rsvp(erkenningsNummer=erkenningsnummer, marktDate=dp.data["marktDate"], attending=True)
+        dp.mock()
+
+        data = dp.data
+        # the v2 allocation reads the rows and the presence list
+        data["rows"] = rows
+        data["aanwezigheid"] = data["aanmeldingen"]
+        data["markt"] = {
+            **data["markt"],
+            "aantalKramen": self.rows * self.kramen_per_row,
+            "maxAantalKramenPerOndernemer": self.max_kramen_per_ondernemer,
+            "kiesJeKraamGeblokkeerdePlaatsen": None,
+            "kiesJeKraamGeblokkeerdeData": None,
+        }
+        return data
+
+
+def run_scaling(sizes, ondernemers_per_kraam, engines, runs, warmup, kramen_per_row=20, **generator_kwargs):
+    """generator_kwargs shape every market, only the number of rows and ondernemers follow from the size"""
+    # imported here, generating a market does not need the allocation engines
+    from benchmark_allocation import benchmark
+
+    results = []
+    for size in sizes:
+        num_rows = max(1, size // kramen_per_row)
+        market = MarketGenerator(
+            rows=num_rows,
+            kramen_per_row=kramen_per_row,
+            ondernemers=int(num_rows * kramen_per_row * ondernemers_per_kraam),
+            **generator_kwargs,
+        ).generate()
+        json_data = json.dumps(market)
+        result = {"kramen": num_rows * kramen_per_row, "ondernemers": len(market["ondernemers"])}
+        for engine in engines:
+            try:
+                engine_result = benchmark(engine, json_data, runs, warmup)
+                result[engine] = {
+                    "wall_time": engine_result["wall_time"]["median"],
+                    "peak_memory": engine_result["peak_memory"],
+                }
+            except Exception as e:
+                result[engine] = {"error": repr(e)}
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic markets and scaling curves")
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--kramen-per-row", type=int, default=20)
+    parser.add_argument("--ondernemers", type=int, default=300)
+    parser.add_argument("--branches", type=int, default=10)
+    parser.add_argument("--verplichte-branche-ratio", type=float, default=0.3)
+    parser.add_argument("--bak-ratio", type=float, default=0.1)
+    parser.add_argument("--bak-licht-ratio", type=float, default=0.05)
+    parser.add_argument("--evi-ratio", type=float, default=0.05)
+    parser.add_argument("--vpl-ratio", type=float, default=0.4)
+    parser.add_argument("--min-prefs", type=int, default=1)
+    parser.add_argument("--max-prefs", type=int, default=6)
+    parser.add_argument("--max-kramen-per-ondernemer", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--scaling", type=int, nargs="+", help="numbers of kramen for the scaling curve")
+    parser.add_argument("--ondernemers-per-kraam", type=float, default=1.2)
+    parser.add_argument("--engine", nargs="+", choices=("v1", "v2"), default=("v1", "v2"))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=0)
+    parser.add_argument("--output", default="generated_market.json")
+    args = parser.parse_args()
+
+    generator_kwargs = dict(
+        kramen_per_row=args.kramen_per_row,
+        branches=args.branches,
+        verplichte_branche_ratio=args.verplichte_branche_ratio,
+        bak_ratio=args.bak_ratio,
+        bak_licht_ratio=args.bak_licht_ratio,
+        evi_ratio=args.evi_ratio,
+        vpl_ratio=args.vpl_ratio,
+        min_prefs=args.min_prefs,
+        max_prefs=args.max_prefs,
+        max_kramen_per_ondernemer=args.max_kramen_per_ondernemer,
+        seed=args.seed,
+    )
+    if args.scaling:
+        # the allocation logs are collected, but not printed
+        logging.disable(logging.CRITICAL)
+        output = run_scaling(args.scaling, args.ondernemers_per_kraam, args.engine, args.runs, args.warmup,
+                             **generator_kwargs)
+    else:
+        output = MarketGenerator(rows=args.rows, ondernemers=args.ondernemers, **generator_kwargs).generate()
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=4)
+    print(f"Written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ from kjk.base import STRATEGY_EXP_FULL
 from kjk.rejection_reasons import MINIMUM_UNAVAILABLE
 from kjk.rejection_reasons import PREF_NOT_AVAILABLE
 from kjk.validation import ValidatorMixin
-from kjk.logging import clog, log
+from kjk.logging import clog, log, collect_logs
 from kjk.outputdata import ConvertToRejectionError
 from kjk.moving_vpl import MovingVPLSolver
 
@@ -354,7 +354,8 @@ class Allocator(BaseAllocator, ValidatorMixin):
         clog.debug(f"Open plaatsen: {self.positions_df.index.to_list()}")
         clog.debug(f"Reclaimed: {self.reclaimed_number_stands}")
 
-    def get_allocation(self):
+    @collect_logs
+    def get_allocation(self, slim=False):
 
         clog.info("--- Makkelijkemarkt Allocatie ---")
         self._phase_msg(
@@ -462,7 +463,7 @@ class Allocator(BaseAllocator, ValidatorMixin):
             debug_redis = DebugRedisClient()
             debug_redis.insert_test_result(json_file)
 
-        return self.market_output.to_data()
+        return self.market_output.to_data(slim=slim)
 
 
 if __name__ == "__main__":
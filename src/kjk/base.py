@@ -1,10 +1,11 @@
+import numpy as np
 import pandas as pd
 from datetime import date
 from kjk.outputdata import MarketArrangement
 from kjk.utils import MarketStandClusterFinder, RejectionReasonManager
 from kjk.utils import BranchesScrutenizer
 from kjk.utils import PreferredStandFinder
-from kjk.logging import clog, log
+from kjk.logging import clog, log, collect_logs
 from pandas.core.computation.ops import UndefinedVariableError
 from kjk.rejection_reasons import BRANCHE_FULL, MINIMUM_UNAVAILABLE
 from kjk.rejection_reasons import VPL_POSITION_NOT_AVAILABLE
@@ -138,6 +139,10 @@ class BaseAllocator:
     Mock-dataproviders can be userd for testing and API-based dataprovider for ACC and PRD envs.
     """
 
+    # every allocator collects its own logs, see get_logs
+    log_collector = None
+
+    @collect_logs
     def __init__(self, data_provider):
         """Accept the dataprovider and populate the data model"""
         dp = data_provider
@@ -279,16 +284,52 @@ class BaseAllocator:
             self.positions_df.to_excel("../../kramen.xls")
             self.branches_df.to_excel("../../branches.xls")
 
+    def get_logs(self):
+        """the clog and log messages of this allocation"""
+        return self.log_collector.get_logs()
+
     def set_mode_blist(self):
         """set mode to blist, this is used in query format strings"""
         self.list_mode = MODE_BLIST
 
+    @property
+    def merchants_df(self):
+        return self._merchants_df
+
+    @merchants_df.setter
+    def merchants_df(self, df):
+        self._merchants_df = df
+        self.market_space_cache = {}
+
+    @property
+    def positions_df(self):
+        return self._positions_df
+
+    @positions_df.setter
+    def positions_df(self, df):
+        self._positions_df = df
+        self.market_space_cache = {}
+
+    def _cached_market_space(self, key, func, *args):
+        """
+        The cluster finder checks the market space for every option,
+        cache the result until the merchant or stand queue changes.
+        """
+        try:
+            return self.market_space_cache[key]
+        except KeyError:
+            has_space = self.market_space_cache[key] = func(*args)
+            return has_space
+
     def market_has_unused_bak_space(self):
         """
         Check if the market has unused bak space.
         This will allow non bak vpl merchants that want to move
         to get a bak stand.
         """
+        return self._cached_market_space("bak", self._market_has_unused_bak_space)
+
+    def _market_has_unused_bak_space(self):
         df = self.merchants_df.query("has_bak == True")
         return df["voorkeur.maximum"].sum() < self.num_bak_stands
 
@@ -298,6 +339,9 @@ class BaseAllocator:
         This will allow non evi vpl merchants that want to move
         to get an evi stand.
         """
+        return self._cached_market_space("evi", self._market_has_unused_evi_space)
+
+    def _market_has_unused_evi_space(self):
         df = self.merchants_df.query("has_evi == 'yes'")
         return df["voorkeur.maximum"].sum() < self.num_evi_stands
 
@@ -307,6 +351,13 @@ class BaseAllocator:
         This will allow non branche vpl merchants that want to move
         to get a branched stand.
         """
+        return self._cached_market_space(
+            ("branches", tuple(branches)),
+            self._market_has_unused_branche_space,
+            branches,
+        )
+
+    def _market_has_unused_branche_space(self, branches):
         for branche in branches:
 
             def has_branch(x):
@@ -400,40 +451,30 @@ class BaseAllocator:
         """add has_stands boolean to the merchant dataframe,
         exp merchants may or may not have stands"""
 
-        def has_stands(x):
-            try:
-                if len(x["plaatsen"]) > 0:
-                    return True
-                return False
-            except Exception:
-                clog.warning("No valid plaatsen field for merchant assume []")
-                return False
-
-        self.merchants_df["has_stands"] = self.merchants_df.apply(has_stands, axis=1)
+        try:
+            num_stands = self._num_elements(self.merchants_df["plaatsen"])
+        except KeyError:
+            num_stands = pd.Series(np.nan, index=self.merchants_df.index)
+        for _ in range(num_stands.isna().sum()):
+            clog.warning("No valid plaatsen field for merchant assume []")
+        self.merchants_df["has_stands"] = num_stands > 0
 
     def add_bak_type(self):
         """add bak_type to the merchant dataframe
         make sure there is a value so we don't have data quality issues later on."""
 
-        def bak_type(x):
-            try:
-                return x["voorkeur.bakType"]
-            except Exception:
-                return "geen"
-
-        self.merchants_df["bak_type"] = self.merchants_df.apply(bak_type, axis=1)
+        try:
+            self.merchants_df["bak_type"] = self.merchants_df["voorkeur.bakType"]
+        except KeyError:
+            self.merchants_df["bak_type"] = "geen"
 
     def add_has_bak(self):
-        def has_bak(x):
-            try:
-                if x["voorkeur.bakType"] == "bak":
-                    return True
-                return False
-            except Exception:
+        try:
+            self.merchants_df["has_bak"] = self.merchants_df["voorkeur.bakType"] == "bak"
+        except KeyError:
+            for _ in range(len(self.merchants_df)):
                 clog.warning("No valid branches field for merchant assume []")
-                return False
-
-        self.merchants_df["has_bak"] = self.merchants_df.apply(has_bak, axis=1)
+            self.merchants_df["has_bak"] = False
 
     def create_expanders_set(self):
         """
@@ -549,13 +590,7 @@ class BaseAllocator:
     def prepare_stands(self):
         """prepare the stands list for allocation"""
 
-        def required(x):
-            try:
-                return self.get_required_for_branche(x)
-            except KeyError:
-                return "unknown"
-
-        is_required = self.positions_df["branches"].apply(required)
+        is_required = self.get_required_for_branches(self.positions_df["branches"])
         self.positions_df["required"] = is_required
         self.positions_df.set_index("plaatsId", inplace=True)
         self.positions_df["plaatsId"] = self.positions_df.index
@@ -600,6 +635,44 @@ class BaseAllocator:
                 return "no"
         return "unknown"
 
+    def get_required_for_branches(self, branches):
+        """
+        Vectorized version of get_required_for_branche for a series of branche lists,
+        'unknown' if the branches data has no brancheId or verplicht column.
+        """
+        required = pd.Series("no", index=branches.index, dtype=object)
+        first_branche = branches[self._num_elements(branches) >= 1].map(lambda b: b[0])
+        try:
+            known_branches = self.branches_df.drop_duplicates(subset="brancheId")
+            known_branches = known_branches.set_index("brancheId")
+        except KeyError:
+            required[first_branche.index] = "unknown"
+            return required
+        first_branche = first_branche[first_branche.isin(known_branches.index)]
+        try:
+            verplicht = known_branches["verplicht"] == True
+        except KeyError:
+            required[first_branche.index] = "unknown"
+            return required
+        required[first_branche.index] = np.where(
+            first_branche.map(verplicht), "yes", "no"
+        )
+        return required
+
+    @staticmethod
+    def _num_elements(series):
+        """length of every list in the series, NaN for values without a length"""
+        try:
+            return series.str.len()
+        except AttributeError:
+            return pd.Series(np.nan, index=series.index)
+
+    @staticmethod
+    def _contains(series, value):
+        """boolean array, does the list in each row of the series contain value"""
+        exploded = pd.Series(series.to_numpy(), dtype=object).explode()
+        return (exploded == value).groupby(level=0).any().to_numpy(dtype=bool)
+
     def get_prefs_for_merchant(self, merchant_number):
         """get position pref for merchant_number (erkenningsNummer)"""
         result_df = self.prefs_df[
@@ -624,16 +697,13 @@ class BaseAllocator:
         If true a merchant will allocated bofore others (B-list)
         """
 
-        def prefs(x):
-            try:
-                result_df = self.a_list_df[
-                    self.a_list_df["erkenningsNummer"] == x
-                ].copy()
-                return len(result_df) > 0
-            except KeyError:
-                return False
-
-        self.merchants_df["alist"] = self.merchants_df["erkenningsNummer"].apply(prefs)
+        try:
+            alist = self.merchants_df["erkenningsNummer"].isin(
+                self.a_list_df["erkenningsNummer"]
+            )
+        except KeyError:
+            alist = False
+        self.merchants_df["alist"] = alist
 
     def add_mandatory_columns(self):
         """
@@ -660,38 +730,26 @@ class BaseAllocator:
         If true this merchant will only be allocated on 'branched' stands.
         """
 
-        def required(x):
-            try:
-                return self.get_required_for_branche(x)
-            except KeyError:
-                return "unknown"
-
-        is_required = self.merchants_df["voorkeur.branches"].apply(required)
-        self.merchants_df["branche_required"] = is_required
-
-        def clean_branches(x):
-            if isinstance(x, list):
-                return x
-            return []
-
-        cleansed_branches = self.merchants_df["voorkeur.branches"].apply(clean_branches)
-        self.merchants_df["voorkeur.branches"] = cleansed_branches
+        branches = self.merchants_df["voorkeur.branches"]
+        self.merchants_df["branche_required"] = self.get_required_for_branches(branches)
+        self.merchants_df["voorkeur.branches"] = [
+            x if isinstance(x, list) else [] for x in branches
+        ]
 
     def add_evi_for_merchant(self):
         """
         Does the merchant bring his own stand inventory.
         """
 
-        def has_evi(x):
-            try:
-                if "eigen-materieel" in x:
-                    return "yes"
-                else:
-                    return "no"
-            except TypeError:
-                return "unknown"
-
-        hasevi = self.merchants_df["voorkeur.verkoopinrichting"].apply(has_evi)
+        verkoopinrichting = self.merchants_df["voorkeur.verkoopinrichting"]
+        hasevi = np.select(
+            [
+                verkoopinrichting.isna(),
+                self._contains(verkoopinrichting, "eigen-materieel"),
+            ],
+            ["unknown", "yes"],
+            default="no",
+        )
         self.merchants_df["has_evi"] = hasevi
 
     def create_sollnr_weighted_prefs(self):
@@ -702,17 +760,11 @@ class BaseAllocator:
         lowest soll nr will be given away last. (last elem in the list)
         """
         p = {}
-
-        def weighted_prefs(merch):
-            soll_nr = merch["sollicitatieNummer"]
-            pref = merch["pref"]
-            erk = merch["erkenningsNummer"]
+        for soll_nr, pref in zip(
+            self.merchants_df["sollicitatieNummer"], self.merchants_df["pref"]
+        ):
             if len(pref) > 0:
-                p[soll_nr] = self.get_prefs_for_merchant(erk)
-
-        self.merchants_df[["erkenningsNummer", "sollicitatieNummer", "pref"]].apply(
-            weighted_prefs, axis=1
-        )
+                p[soll_nr] = pref
         _prefs = []
         for m in sorted(p.items()):
             for std in m[1]:
@@ -723,25 +775,27 @@ class BaseAllocator:
 
     def add_prefs_for_merchant(self):
         """add position preferences to the merchant dataframe"""
+        erkenningsnummers = self.merchants_df["erkenningsNummer"]
 
-        def prefs(x):
-            try:
-                merchant_prefs = self.get_prefs_for_merchant(x)
-                return merchant_prefs
-            except KeyError:
-                return []
-
-        self.merchants_df["pref"] = self.merchants_df["erkenningsNummer"].apply(prefs)
-
-        def will_move(x):
-            try:
-                return self.get_willmove_for_merchant(x)
-            except KeyError:
-                return "no"
+        # a stable sort keeps the order of equal priorities the same as
+        # sorting the prefs per merchant (see get_prefs_for_merchant)
+        try:
+            sorted_prefs = self.prefs_df.sort_values(by=["priority"], kind="mergesort")
+            prefs = (
+                sorted_prefs.groupby("erkenningsNummer", sort=False)["plaatsId"]
+                .agg(list)
+                .to_dict()
+            )
+        except KeyError:
+            prefs = {}
+        self.merchants_df["pref"] = [list(prefs.get(x, [])) for x in erkenningsnummers]
 
-        self.merchants_df["will_move"] = self.merchants_df["erkenningsNummer"].apply(
-            will_move
-        )
+        try:
+            movers = self.prefs_df[["erkenningsNummer", "plaatsId"]]["erkenningsNummer"]
+            will_move = erkenningsnummers.isin(movers)
+        except KeyError:
+            will_move = np.zeros(len(erkenningsnummers), dtype=bool)
+        self.merchants_df["will_move"] = np.where(will_move, "yes", "no")
 
     def df_for_attending_merchants(self):
         """
@@ -750,20 +804,17 @@ class BaseAllocator:
         - non vpl (tvplz, soll and exp) do have to attend.
         """
 
-        def is_attending_market(x):
-            try:
-                att = self.get_rsvp_for_merchant(x)
-                if att == True:
-                    return "yes"
-                elif att == False:
-                    return "no"
-                else:
-                    return "na"
-            except KeyError:
-                return "na"
-
-        self.merchants_df["attending"] = self.merchants_df["erkenningsNummer"].apply(
-            is_attending_market
+        # only a single rsvp for a merchant counts (see get_rsvp_for_merchant)
+        try:
+            rsvp_df = self.rsvp_df[["erkenningsNummer", "attending"]]
+            rsvp_df = rsvp_df.drop_duplicates(subset="erkenningsNummer", keep=False)
+            att = self.merchants_df["erkenningsNummer"].map(
+                rsvp_df.set_index("erkenningsNummer")["attending"]
+            )
+        except KeyError:
+            att = pd.Series(None, index=self.merchants_df.index, dtype=object)
+        self.merchants_df["attending"] = np.select(
+            [att == True, att == False], ["yes", "no"], default="na"
         )
         df_1 = self.merchants_df.query(
             "attending != 'no' & (status == 'vpl' | status == 'tvpl' | status == 'eb')"
@@ -897,9 +948,11 @@ class BaseAllocator:
 
     def dequeue_merchant(self, merchant_id):
         self.merchants_df.drop(merchant_id, inplace=True)
+        self.market_space_cache = {}
 
     def dequeue_market_stand(self, stand_id):
         self.positions_df.drop(stand_id, inplace=True)
+        self.market_space_cache = {}
 
     def num_merchants_in_queue(self):
         return len(self.merchants_df)
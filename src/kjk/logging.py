@@ -1,44 +1,88 @@
 import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
 from colorlog import ColoredFormatter
 
+# maximum number of log lines kept per allocation, the oldest are dropped first
+MAX_LOGS = 10000
+
 
 class LogCollector:
-    logs = []
+    def __init__(self, max_logs=None):
+        self.max_logs = max_logs
+        self.logs = deque(maxlen=max_logs)
+
+    def add(self, log_level, message):
+        self.logs.append({"level": log_level, "message": message})
+
+    def clear(self):
+        self.logs.clear()
+
+    def get_logs(self):
+        return list(self.logs)
+
+
+current_log_collector = ContextVar("current_log_collector", default=LogCollector())
+
+
+@contextmanager
+def log_context(log_collector=None):
+    """
+    Collect the clog and log messages in a separate log collector,
+    so allocations in other threads or asyncio tasks don't share their logs.
+    """
+    log_collector = log_collector or LogCollector(max_logs=MAX_LOGS)
+    token = current_log_collector.set(log_collector)
+    try:
+        yield log_collector
+    finally:
+        current_log_collector.reset(token)
+
+
+def collect_logs(method):
+    """decorator, runs an allocator method in the log context of the allocator"""
+
+    @wraps(method)
+    def wrapper(allocator, *args, **kwargs):
+        if allocator.log_collector is None:
+            allocator.log_collector = LogCollector(max_logs=MAX_LOGS)
+        with log_context(allocator.log_collector):
+            return method(allocator, *args, **kwargs)
 
-    @classmethod
-    def add(cls, log_level, message):
-        cls.logs.append({"level": log_level, "message": message})
+    return wrapper
 
 
 class LogProxy:
     def purge(self):
-        LogCollector.logs = []
+        current_log_collector.get().clear()
 
     def __init__(self, obj):
         self.obj = obj
 
     def debug(self, message):
         self.obj.debug(message)
-        LogCollector.add("DEBUG", message)
+        current_log_collector.get().add("DEBUG", message)
 
     def info(self, message):
         self.obj.info(message)
-        LogCollector.add("INFO", message)
+        current_log_collector.get().add("INFO", message)
 
     def warning(self, message):
         self.obj.warning(message)
-        LogCollector.add("WARNING", message)
+        current_log_collector.get().add("WARNING", message)
 
     def error(self, message):
         self.obj.error(message)
-        LogCollector.add("ERROR", message)
+        current_log_collector.get().add("ERROR", message)
 
     def critical(self, message):
         self.obj.critical(message)
-        LogCollector.add("CRITICAL", message)
+        current_log_collector.get().add("CRITICAL", message)
 
     def get_logs(self):
-        return LogCollector.logs
+        return current_log_collector.get().get_logs()
 
     @property
     def disabled(self):
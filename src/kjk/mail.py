@@ -1,3 +1,4 @@
+import json
 import sendgrid
 import os
 from pprint import pprint
@@ -24,3 +25,8 @@ class KjKEmailclient:
 
         elif os.environ.get("MAIL_BACKEND") == "console":
             pprint(mail_json)
+
+        elif os.environ.get("MAIL_BACKEND") == "file":
+            # local stand-in for sendgrid, every mail is appended as a json line
+            with open(os.environ.get("MAIL_FILE_PATH", "mail.jsonl"), "a") as f:
+                f.write(json.dumps(mail_json) + "\n")
@@ -0,0 +1,57 @@
+import atexit
+import os
+import queue
+import sys
+import threading
+import traceback
+
+# maximum number of side effects waiting in the outbox
+OUTBOX_SIZE = int(os.getenv("OUTBOX_SIZE", 100))
+
+
+class Outbox:
+    """
+    Runs side effects of a job (debug dumps, notification emails) in a background thread,
+    so they don't add to the duration of the job.
+    The queue is bounded: a full outbox drops optional side effects and blocks for the others.
+    Pending side effects are still run when the process exits.
+    """
+
+    def __init__(self, max_size=OUTBOX_SIZE):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="outbox", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def send(self, func, *args, optional=False):
+        if not optional:
+            self.queue.put((func, args))
+            return
+        try:
+            self.queue.put_nowait((func, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                func, args = item
+                func(*args)
+            except Exception:
+                print("Error in outbox side effect:")
+                traceback.print_exc(file=sys.stdout)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """wait until all pending side effects are done"""
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -106,7 +106,13 @@ class MarketArrangement:
     def set_rsvp(self, rsvp):
         self.rsvp = rsvp
 
-    def to_data(self):
+    def to_data(self, slim=False):
+        """
+        slim: only the toewijzingen, afwijzingen and the market identifiers,
+        without echoing the market input (ondernemers, marktplaatsen, etc.)
+        """
+        if slim:
+            return self.to_slim_data()
         self.output["naam"] = "?"
         self.output["marktId"] = self.market_id
         self.output["marktDate"] = self.market_date
@@ -123,6 +129,18 @@ class MarketArrangement:
         self.__add_prefs_to_allocations(self.output["afwijzingen"])
         return self.output
 
+    def to_slim_data(self):
+        toewijzingen = list(self.allocation_dict.values())
+        self.__add_prefs_to_allocations(toewijzingen)
+        self.__add_prefs_to_allocations(self.rejection_list)
+        return {
+            "naam": "?",
+            "marktId": self.market_id,
+            "marktDate": self.market_date,
+            "toewijzingen": toewijzingen,
+            "afwijzingen": self.rejection_list,
+        }
+
     def __add_prefs_to_allocations(self, allocations):
         for allocation in allocations:
             allocation["ondernemer"]["plaatsvoorkeuren"] = []
@@ -0,0 +1,200 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+
+# values of at least COMPRESSION_MIN_SIZE bytes are compressed with REDIS_COMPRESSION (zlib or gzip),
+# compression is off by default because the consumer has to recognize the compressed values
+REDIS_COMPRESSION = os.getenv("REDIS_COMPRESSION", "")
+COMPRESSION_MIN_SIZE = int(os.getenv("REDIS_COMPRESSION_MIN_SIZE", 64 * 1024))
+
+# a compressed value starts with a marker, a json or text value never does
+COMPRESSION_MARKERS = {
+    "zlib": b"zlib:",
+    "gzip": b"gzip:",
+}
+COMPRESSORS = {
+    "zlib": zlib.compress,
+    "gzip": gzip.compress,
+}
+DECOMPRESSORS = {
+    "zlib": zlib.decompress,
+    "gzip": gzip.decompress,
+}
+
+
+# result cache for concept allocations: off, "memory" (per worker process) or "redis"
+ALLOCATION_CACHE = os.getenv("ALLOCATION_CACHE", "")
+ALLOCATION_CACHE_TTL = int(os.getenv("ALLOCATION_CACHE_TTL", 60 * 60))
+ALLOCATION_CACHE_SIZE = int(os.getenv("ALLOCATION_CACHE_SIZE", 100))
+ALLOCATION_CACHE_PREFIX = "ALLOCATION_CACHE_"
+ALLOCATION_CACHE_LRU = "ALLOCATION_CACHE_LRU"
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ALLOCATION_PACKAGES = ("kjk", "v2")
+
+
+class UnknownCompressionError(Exception):
+    pass
+
+
+def encode_value(value, compression=REDIS_COMPRESSION, min_size=COMPRESSION_MIN_SIZE):
+    """
+    returns the value as it should be stored in redis,
+    compressed and prefixed with the compression marker if it is large enough
+    """
+    if not compression:
+        return value
+    if compression not in COMPRESSORS:
+        raise UnknownCompressionError(f"Unknown compression: {compression}")
+    raw = value.encode("utf-8") if isinstance(value, str) else value
+    if len(raw) < min_size:
+        return value
+    return COMPRESSION_MARKERS[compression] + COMPRESSORS[compression](raw)
+
+
+def decode_value(value):
+    """returns the stored value as a str, decompressed if it starts with a compression marker"""
+    if isinstance(value, bytes):
+        for compression, marker in COMPRESSION_MARKERS.items():
+            if value.startswith(marker):
+                value = DECOMPRESSORS[compression](value[len(marker):])
+                break
+        return value.decode("utf-8")
+    return value
+
+
+class JobStore:
+    """
+    Collects the redis writes of one job (results, logs, errors and the bee queue bookkeeping)
+    and sends them to redis in one pipelined transaction with execute().
+    Every value is written with SET ... EX, so a key never exists without an expire time.
+    """
+
+    def __init__(self, r, compression=REDIS_COMPRESSION, min_size=COMPRESSION_MIN_SIZE):
+        self.pipeline = r.pipeline(transaction=True)
+        self.compression = compression
+        self.min_size = min_size
+
+    def set(self, key, value, ttl):
+        self.pipeline.set(key, encode_value(value, self.compression, self.min_size), ex=ttl)
+
+    def execute(self):
+        return self.pipeline.execute()
+
+
+def get_input_hash(data):
+    """sha256 of the job data, independent of the key order"""
+    json_data = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(json_data.encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_code_version():
+    """
+    sha256 of the source of the allocation packages,
+    a cached result is only valid for the allocation code that produced it
+    """
+    code_hash = hashlib.sha256()
+    for package in ALLOCATION_PACKAGES:
+        for dir_path, dir_names, file_names in os.walk(os.path.join(SRC_DIR, package)):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if file_name.endswith(".py"):
+                    path = os.path.join(dir_path, file_name)
+                    code_hash.update(os.path.relpath(path, SRC_DIR).encode("utf-8"))
+                    with open(path, "rb") as f:
+                        code_hash.update(f.read())
+    return code_hash.hexdigest()
+
+
+def get_cache_key(data, settings=None):
+    """the job data contains the allocation version, the code version and the engine settings are the salt"""
+    return get_input_hash({"code_version": get_code_version(), "settings": settings or {}, "data": data})
+
+
+class MemoryResultCache:
+    """
+    Stores the allocation results of the current process,
+    the least recently used result is removed when the cache is full.
+    """
+
+    def __init__(self, max_size=ALLOCATION_CACHE_SIZE, ttl=ALLOCATION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.results = OrderedDict()
+
+    def get(self, key):
+        try:
+            expires_at, value = self.results[key]
+        except KeyError:
+            return None
+        if expires_at < time.time():
+            del self.results[key]
+            return None
+        self.results.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.results[key] = (time.time() + self.ttl, value)
+        self.results.move_to_end(key)
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+
+class RedisResultCache:
+    """
+    Stores the allocation results in redis, shared by all workers.
+    The last access time of every result is kept in a sorted set,
+    the least recently used results are removed when the cache is full.
+    The redis client should not decode the responses, the results can be compressed.
+    """
+
+    def __init__(
+        self,
+        r,
+        max_size=ALLOCATION_CACHE_SIZE,
+        ttl=ALLOCATION_CACHE_TTL,
+        compression=REDIS_COMPRESSION,
+        min_size=COMPRESSION_MIN_SIZE,
+    ):
+        self.r = r
+        self.max_size = max_size
+        self.ttl = ttl
+        self.compression = compression
+        self.min_size = min_size
+
+    def get(self, key):
+        value = self.r.get(f"{ALLOCATION_CACHE_PREFIX}{key}")
+        if value is None:
+            return None
+        self.r.zadd(ALLOCATION_CACHE_LRU, {key: time.time()})
+        return decode_value(value)
+
+    def set(self, key, value):
+        now = time.time()
+        pipeline = self.r.pipeline(transaction=True)
+        pipeline.set(
+            f"{ALLOCATION_CACHE_PREFIX}{key}",
+            encode_value(value, self.compression, self.min_size),
+            ex=self.ttl,
+        )
+        pipeline.zadd(ALLOCATION_CACHE_LRU, {key: now})
+        # results removed by their ttl
+        pipeline.zremrangebyscore(ALLOCATION_CACHE_LRU, 0, now - self.ttl)
+        pipeline.execute()
+
+        num_evict = self.r.zcard(ALLOCATION_CACHE_LRU) - self.max_size
+        if num_evict > 0:
+            evict_keys = [
+                evict_key.decode("utf-8") if isinstance(evict_key, bytes) else evict_key
+                for evict_key in self.r.zrange(ALLOCATION_CACHE_LRU, 0, num_evict - 1)
+            ]
+            pipeline = self.r.pipeline(transaction=True)
+            pipeline.delete(*[f"{ALLOCATION_CACHE_PREFIX}{evict_key}" for evict_key in evict_keys])
+            pipeline.zrem(ALLOCATION_CACHE_LRU, *evict_keys)
+            pipeline.execute()
@@ -1,6 +1,5 @@
 import redis
 import os
-from collections import namedtuple
 
 from kjk.logging import clog
 from kjk.rejection_reasons import MARKET_FULL
@@ -219,6 +218,31 @@ class MarketStandClusterFinder:
                         _next = None
                     self.stands_linked_list[_mid] = {"prev": _prev, "next": _next}
         self.flattened_list.append(None)
+        self._index_stand_positions()
+
+    def _index_stand_positions(self):
+        """
+        Availability is checked with bitsets over the flattened_list positions,
+        bit n of a mask represents self.flattened_list[n].
+        """
+        self.stand_positions = {}
+        # positions that can be part of an option (no row ends or blocked stands)
+        self.stand_mask = 0
+        for pos, elem in enumerate(self.flattened_list):
+            if isinstance(elem, str):
+                self.stand_mask |= 1 << pos
+            try:
+                self.stand_positions[elem] = self.stand_positions.get(elem, 0) | (
+                    1 << pos
+                )
+            except TypeError:
+                # blocked stands are unhashable lists
+                pass
+        self.stw_mask = self.stand_positions.get("STW", 0)
+        self.weighted_prefs_mask = self._positions_mask(self.weighted_prefs)
+        self.stands_allocated_mask = 0
+        self.stands_reserved_mask = 0
+        self._compile_stand_table()
 
     def set_market_info_delegate(self, delegate):
         self.market_info_delegate = delegate
@@ -228,14 +252,49 @@ class MarketStandClusterFinder:
 
     def set_stands_allocated(self, allocated_stands):
         self.stands_allocated += allocated_stands
+        self.stands_allocated_mask |= self._positions_mask(allocated_stands)
 
     def set_stands_available(self, stands):
         self.stands_allocated = list(set(self.stands_allocated) - set(stands))
+        self.stands_allocated_mask &= ~self._positions_mask(stands)
 
     def set_stands_reserved(self, stands_to_reserve, erk=None):
         self.stands_reserved_for_expansion += stands_to_reserve
+        self.stands_reserved_mask |= self._positions_mask(stands_to_reserve)
         self.expansion_optimizer.add_expansion_reservation(stands_to_reserve, erk)
 
+    def _positions_mask(self, stands):
+        """bitset of the flattened_list positions of the stands"""
+        mask = 0
+        for std in stands:
+            try:
+                mask |= self.stand_positions.get(std, 0)
+            except TypeError:
+                pass
+        return mask
+
+    @staticmethod
+    def _window_mask(start, size):
+        """bitset of the flattened_list positions of the option flattened_list[start : start + size]"""
+        return ((1 << max(size, 0)) - 1) << start
+
+    def _unavailable_mask(self, mode=None):
+        if mode == self.MODE_AVOID_PREFS_AND_EXPANSION:
+            return (
+                self.weighted_prefs_mask
+                | self.stands_reserved_mask
+                | self.stands_allocated_mask
+            )
+        elif mode == self.MODE_AVOID_EXPANSION:
+            return self.stands_reserved_mask | self.stands_allocated_mask
+        elif mode == self.MODE_AVOID_PREFS:
+            return self.weighted_prefs_mask | self.stands_allocated_mask
+        return self.stands_allocated_mask
+
+    def window_is_available(self, window_mask, mode=None):
+        """option_is_available for an option given as bitset of flattened_list positions"""
+        return not window_mask & (self.stw_mask | self._unavailable_mask(mode))
+
     def _process_obstacle_dict(self, obs):
         d = {}
         for ob in obs:
@@ -298,6 +357,112 @@ class MarketStandClusterFinder:
         except TypeError:
             return "geen"
 
+    def _compile_stand_table(self):
+        """
+        Compile the branche, bak, bak type and evi properties of the stands into bitsets
+        over a stand table, bit n of a mask represents self.stand_table[n].
+        A merchant is compatible with an option if none of the option stands
+        is in the illegal stands mask for that merchant.
+        """
+        self.stand_table = []
+        self.stand_table_index = {}
+        self.evi_stands_mask = 0
+        self.bak_stands_mask = 0
+        self.geen_bak_type_mask = 0
+        self.branche_stands_masks = {}
+        self.required_branches_masks = {}
+        self.illegal_stands_masks = {}
+        for std in self.stand_positions:
+            if not isinstance(std, str):
+                continue
+            try:
+                self._add_to_stand_table(std)
+            except KeyError:
+                # incomplete stand data, fails when this stand is checked
+                pass
+
+    def _add_to_stand_table(self, std):
+        try:
+            branches = self.branches_dict[std]
+        except KeyError:
+            # stands input data is not always complete
+            branches = []
+        stand_has_evi = self.stand_has_evi(std)
+        stand_has_bak = self.stand_has_bak(std)
+        stand_bak_type = self.stand_bak_type(std)
+
+        index = len(self.stand_table)
+        bit = 1 << index
+        self.stand_table.append(std)
+        self.stand_table_index[std] = index
+        if stand_has_evi:
+            self.evi_stands_mask |= bit
+        if stand_has_bak:
+            self.bak_stands_mask |= bit
+        if stand_bak_type == "geen":
+            self.geen_bak_type_mask |= bit
+        for br in branches:
+            self.branche_stands_masks[br] = self.branche_stands_masks.get(br, 0) | bit
+        if self.stand_has_required_branche(branches):
+            key = tuple(branches)
+            self.required_branches_masks[key] = (
+                self.required_branches_masks.get(key, 0) | bit
+            )
+        # the merchant masks are compiled for the stands in the table
+        self.illegal_stands_masks = {}
+        return index
+
+    def _get_illegal_stands_mask(self, branche, bak_merchant, evi_merchant, bak_type):
+        """
+        Mask of the stands a merchant can not be allocated to:
+        - a required branche merchant on a stand without this branche
+        - a bak merchant on a stand without bak
+        - a bak-licht merchant on a stand with bak type 'geen'
+        - an evi merchant on a stand without evi
+        """
+        key = (branche, bak_merchant == True, evi_merchant == True, bak_type == "bak-licht")
+        try:
+            return self.illegal_stands_masks[key]
+        except KeyError:
+            pass
+        all_stands = (1 << len(self.stand_table)) - 1
+        mask = 0
+        if self.branche_is_required(branche) == True:
+            mask |= all_stands & ~self.branche_stands_masks.get(branche, 0)
+        if bak_merchant == True:
+            mask |= all_stands & ~self.bak_stands_mask
+        if bak_type == "bak-licht":
+            mask |= self.geen_bak_type_mask
+        if evi_merchant == True:
+            mask |= all_stands & ~self.evi_stands_mask
+        self.illegal_stands_masks[key] = mask
+        return mask
+
+    def _get_no_space_stands_mask(self, branche, bak_merchant, evi_merchant):
+        """
+        Mask of the stands that have to be kept free for other merchants:
+        - evi stands for a non evi merchant if there is no unused evi space
+        - bak stands for a non bak merchant if there is no unused bak space
+        - required branche stands of another branche without unused branche space
+        The market info delegate caches the space checks until the merchant queue changes.
+        """
+        mask = 0
+        if evi_merchant == False:
+            if self.market_info_delegate.market_has_unused_evi_space() == False:
+                mask |= self.evi_stands_mask
+        if bak_merchant == False:
+            if self.market_info_delegate.market_has_unused_bak_space() == False:
+                mask |= self.bak_stands_mask
+        other_branches = ~self.branche_stands_masks.get(branche, 0)
+        for branches, stands_mask in self.required_branches_masks.items():
+            if stands_mask & other_branches:
+                has_space = self.market_info_delegate.market_has_unused_branche_space(
+                    list(branches)
+                )
+                if has_space == False:
+                    mask |= stands_mask & other_branches
+        return mask
+
     def option_is_valid_branche(
         self,
         option,
@@ -307,171 +472,36 @@ class MarketStandClusterFinder:
         erk=None,
         bak_type=None,
     ):
-        AV = namedtuple(
-            "AllocationVars",
-            [
-                "merchant_has_required_branche",
-                "stand_has_branche",
-                "stand_has_required_branche",
-                "market_has_unused_bak_space",
-                "market_has_unused_evi_space",
-                "merchant_has_evi",
-                "merchant_has_bak",
-                "branches_match",
-                "stand_has_evi",
-                "stand_has_bak",
-                "market_has_unused_branche_space",
-                "stand_bak_type",
-                "merchant_bak_type",
-            ],
-            defaults=(None,) * 13,
+        branche = merchant_branches[0]
+        illegal_mask = self._get_illegal_stands_mask(
+            branche, bak_merchant, evi_merchant, bak_type
         )
-
-        illegal_combos = [
-            AV(
-                merchant_has_required_branche=True,
-                branches_match=False,
-            ),
-            AV(
-                merchant_has_bak=True,
-                stand_has_bak=False,
-            ),
-            AV(
-                merchant_has_evi=True,
-                stand_has_evi=False,
-            ),
-            AV(
-                market_has_unused_branche_space=False,
-                branches_match=False,
-                stand_has_required_branche=True,
-            ),
-            AV(
-                market_has_unused_bak_space=False,
-                merchant_has_bak=False,
-                stand_has_bak=True,
-            ),
-            AV(
-                market_has_unused_evi_space=False,
-                merchant_has_evi=False,
-                stand_has_evi=True,
-            ),
-            AV(
-                merchant_bak_type="bak-licht",
-                stand_bak_type="geen",
-            ),
-        ]
-
-        is_required = self.branche_is_required(merchant_branches[0])
+        if self.should_check_branche_bak_evi_space:
+            illegal_mask |= self._get_no_space_stands_mask(
+                branche, bak_merchant, evi_merchant
+            )
         for std in option:
             try:
-                branches = self.branches_dict[std]
+                index = self.stand_table_index[std]
             except KeyError:
-                # stands input data is not always complete
-                branches = []
-            stand_required_br = self.stand_has_required_branche(branches)
-            std_has_evi = self.stand_has_evi(std)
-            std_has_bak = self.stand_has_bak(std)
-            std_bak_type = self.stand_bak_type(std)
-
-            # print("- "*23)
-            # print("ERK: ", erk)
-            # print("stand nr: ", std)
-            # print("branches: ", branches)
-            # print("stand required branche: ", stand_required_br)
-            # print("stand evi: ", std_has_evi)
-            # print("stand bak: ", std_has_bak)
-            # print("merchant bak: ", bak_merchant)
-            # print("merchant evi: ", evi_merchant)
-            # print("merchant bak type:", bak_type)
-            # print("stand bak type:", std_bak_type)
-
-            # branche
-            branch_vars = AV(
-                merchant_has_required_branche=is_required,
-                branches_match=merchant_branches[0] in branches,
-            )
-            if branch_vars in illegal_combos:
-                return False
-
-            # bak
-            bak_vars = AV(
-                merchant_has_bak=bak_merchant,
-                stand_has_bak=std_has_bak,
-            )
-            if bak_vars in illegal_combos:
-                return False
-
-            # bak licht
-            bak_licht_vars = AV(
-                merchant_bak_type=bak_type,
-                stand_bak_type=std_bak_type,
-            )
-            if bak_licht_vars in illegal_combos:
-                return False
-
-            # evi
-            evi_vars = AV(
-                merchant_has_evi=evi_merchant,
-                stand_has_evi=std_has_evi,
-            )
-            if evi_vars in illegal_combos:
-                return False
-
-            if self.should_check_branche_bak_evi_space:
-                evi_space = self.market_info_delegate.market_has_unused_evi_space()
-
-                evi_space_vars = AV(
-                    market_has_unused_evi_space=evi_space,
-                    merchant_has_evi=evi_merchant,
-                    stand_has_evi=std_has_evi,
-                )
-                if evi_space_vars in illegal_combos:
-                    return False
-
-                bak_space = self.market_info_delegate.market_has_unused_bak_space()
-                bak_space_vars = AV(
-                    market_has_unused_bak_space=bak_space,
-                    merchant_has_bak=bak_merchant,
-                    stand_has_bak=std_has_bak,
+                index = self._add_to_stand_table(std)
+                # a new stand invalidates the compiled merchant masks
+                return self.option_is_valid_branche(
+                    option, merchant_branches, bak_merchant, evi_merchant, bak_type=bak_type
                 )
-                if bak_space_vars in illegal_combos:
-                    return False
-
-                branches_moving_vpl = AV(
-                    market_has_unused_branche_space=self.market_info_delegate.market_has_unused_branche_space(
-                        branches
-                    ),
-                    stand_has_required_branche=stand_required_br,
-                    branches_match=merchant_branches[0] in branches,
-                )
-                if branches_moving_vpl in illegal_combos:
-                    return False
+            if illegal_mask >> index & 1:
+                return False
         return True
 
     def option_is_available(self, option, mode=None):
         if "STW" in option:
             return False
-        if mode == self.MODE_AVOID_PREFS_AND_EXPANSION:
-            stands_not_available = (
-                self.weighted_prefs
-                + self.stands_reserved_for_expansion
-                + self.stands_allocated
-            )
-        elif mode == self.MODE_AVOID_EXPANSION:
-            stands_not_available = (
-                self.stands_reserved_for_expansion + self.stands_allocated
-            )
-        elif mode == self.MODE_AVOID_PREFS:
-            stands_not_available = self.weighted_prefs + self.stands_allocated
-        else:
-            stands_not_available = self.stands_allocated
-        return not any(elem in option for elem in stands_not_available)
+        return not self._positions_mask(option) & self._unavailable_mask(mode)
 
     def option_is_available_for_expansion(self, option):
         if "STW" in option:
             return False
-        stands_not_available = self.stands_allocated
-        return not any(elem in option for elem in stands_not_available)
+        return not self._positions_mask(option) & self.stands_allocated_mask
 
     def find_valid_expansion(
         self,
@@ -495,21 +525,23 @@ class MarketStandClusterFinder:
         """
 
         valid_options = []
-        for i, elem in enumerate(self.flattened_list):
+        fixed_masks = [self._positions_mask([std]) for std in fixed_positions]
+        for i, _ in enumerate(self.flattened_list):
             # an option is valid if it contains the fixed positions
-            option = self.flattened_list[i : i + total_size]
-            valid = all(elem in option for elem in fixed_positions) and all(
-                isinstance(x, str) for x in option
+            window_mask = self._window_mask(i, total_size)
+            valid = not window_mask & ~self.stand_mask and all(
+                window_mask & mask for mask in fixed_masks
             )
 
-            # NOTE: we remove the already assigned positions from the option
-            # this prevents this position to be re-evaluated
-            # some vpl or eb merchants have fixed stands assigned by 'marktbureau'
-            # that are illegal according to the assigment rules, this would prevent
-            # expansion that would normally be legal
-            option = [x for x in option if x not in fixed_positions]
-
             if valid:
+                # NOTE: we remove the already assigned positions from the option
+                # this prevents this position to be re-evaluated
+                # some vpl or eb merchants have fixed stands assigned by 'marktbureau'
+                # that are illegal according to the assigment rules, this would prevent
+                # expansion that would normally be legal
+                option = self.flattened_list[i : i + total_size]
+                option = [x for x in option if x not in fixed_positions]
+
                 branche_valid_for_option = True
                 if merchant_branche:
                     branche_valid_for_option = self.option_is_valid_branche(
@@ -556,19 +588,19 @@ class MarketStandClusterFinder:
         """
         if len(prefs) > 0:
             valid_options = []
+            prefs_mask = self._positions_mask(prefs)
             for i, _ in enumerate(self.flattened_list):
                 # an option is valid if it is present in de prio list
-                option = self.flattened_list[i : i + size]
-                valid = any(elem in prefs for elem in option) and all(
-                    isinstance(x, str) for x in option
-                )
+                window_mask = self._window_mask(i, size)
+                valid = window_mask & prefs_mask and not window_mask & ~self.stand_mask
                 if valid:
                     branche_valid_for_option = True
-                    option_is_available = self.option_is_available(
-                        option, mode=self.MODE_AVOID_NONE
+                    option_is_available = self.window_is_available(
+                        window_mask, mode=self.MODE_AVOID_NONE
                     )
                     if not option_is_available:
                         continue
+                    option = self.flattened_list[i : i + size]
                     if merchant_branche and check_branche_bak_evi:
                         branche_valid_for_option = self.option_is_valid_branche(
                             option,
@@ -614,13 +646,14 @@ class MarketStandClusterFinder:
     ):
         valid_options = []
         for i, _ in enumerate(self.flattened_list):
-            option = self.flattened_list[i : i + size]
-            valid = all(isinstance(x, str) and x != "STW" for x in option)
+            window_mask = self._window_mask(i, size)
+            valid = not window_mask & (~self.stand_mask | self.stw_mask)
             if valid:
                 branche_valid_for_option = True
-                option_is_available = self.option_is_available(option, mode=mode)
+                option_is_available = self.window_is_available(window_mask, mode=mode)
                 if not option_is_available:
                     continue
+                option = self.flattened_list[i : i + size]
                 if merchant_branche:
                     branche_valid_for_option = self.option_is_valid_branche(
                         option,
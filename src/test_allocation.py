@@ -1,8 +1,10 @@
+import threading
 import unittest
 from pprint import pprint
+from unittest import mock
 import json
 from kjk.allocation import Allocator
-from kjk.inputdata import FixtureDataprovider, MockDataprovider
+from kjk.inputdata import FixtureDataprovider, MockDataprovider, RedisDataprovider
 from kjk.outputdata import MarketArrangement
 from kjk.outputdata import StandsTypeError
 from kjk.rejection_reasons import (
@@ -26,6 +28,11 @@ from kjk.test_utils import (
     ErkenningsnummerNotFoudError,
 )
 from kjk.utils import TradePlacesSolver
+from generate_market import MarketGenerator, run_scaling
+from benchmark_allocation import compare, get_engines
+from v2.allocate import parse_and_allocate
+from kjk.outbox import Outbox
+from kjk.storage import encode_value, decode_value, get_cache_key, MemoryResultCache
 
 
 class ExpansionOptimizerTestCase(unittest.TestCase):
@@ -295,6 +302,61 @@ class MockDataproviderTestCase(unittest.TestCase):
         )
 
 
+class MarketGeneratorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sut = MarketGenerator(rows=3, kramen_per_row=10, ondernemers=30, seed=7)
+
+    def test_generate_is_reproducible(self):
+        data = self.sut.generate()
+        self.assertEqual(len(data["marktplaatsen"]), 30)
+        self.assertEqual(len(data["rows"]), 3)
+        self.assertEqual(len(data["ondernemers"]), 30)
+        self.assertEqual(data, MarketGenerator(rows=3, kramen_per_row=10, ondernemers=30, seed=7).generate())
+
+    def test_allocate_generated_market(self):
+        data = self.sut.generate()
+        # the absent sollicitanten are not allocated or rejected
+        num_vpl = len([m for m in data["ondernemers"] if m["status"] == "vpl"])
+        num_present = num_vpl + len(data["aanmeldingen"])
+        output = Allocator(RedisDataprovider(json.loads(json.dumps(data)))).get_allocation()
+        self.assertEqual(len(output["toewijzingen"]) + len(output["afwijzingen"]), num_present)
+        output_v2, _logs = parse_and_allocate(data)
+        self.assertNotIn("error", output_v2)
+        self.assertEqual(len(output_v2["toewijzingen"]) + len(output_v2["afwijzingen"]), num_present)
+
+    def test_scaling_uses_generator_kwargs(self):
+        markets = []
+
+        def benchmark(engine, json_data, runs, warmup):
+            markets.append(json.loads(json_data))
+            return {"wall_time": {"median": 0.0}, "peak_memory": 0}
+
+        with mock.patch("benchmark_allocation.benchmark", benchmark):
+            results = run_scaling([20, 40], 1.0, ["v2"], 1, 0, kramen_per_row=10, vpl_ratio=0.0,
+                                  evi_ratio=1.0, max_kramen_per_ondernemer=2, seed=7)
+        self.assertEqual([result["kramen"] for result in results], [20, 40])
+        self.assertEqual([len(market["rows"]) for market in markets], [2, 4])
+        for market in markets:
+            self.assertEqual(market["markt"]["maxAantalKramenPerOndernemer"], 2)
+            self.assertFalse([m for m in market["ondernemers"] if m["status"] == "vpl"])
+            self.assertTrue(all(kraam["verkoopinrichting"] == ["eigen-materieel"] for row in market["rows"] for kraam in row))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_engines_per_input_format(self):
+        with open("../fixtures/soll_noflex_validation.json") as f:
+            self.assertEqual(get_engines(json.load(f)), ("v1", "v2"))
+        with open("../fixtures/test_input.json") as f:
+            self.assertEqual(get_engines(json.load(f)), ("v1",))
+
+    def test_compare_reports_new_errors(self):
+        ok = {"wall_time": {"median": 1.0}, "peak_memory": 100}
+        baseline = {"results": {"v2:a": ok, "v2:b": {"error": "KeyError('x')"}, "v2:c": ok}}
+        current = {"results": {"v2:a": {"error": "ValueError()"}, "v2:b": {"error": "KeyError('x')"},
+                               "v2:c": ok, "v2:d": {"error": "ValueError()"}}}
+        self.assertEqual(compare(baseline, current, 0.1, 0.02), ["v2:a: error ValueError()", "v2:d: error ValueError()"])
+
+
 class ClusterFinderTestCase(unittest.TestCase):
     def setUp(self):
         dp = FixtureDataprovider("../fixtures/test_input.json")
@@ -325,6 +387,36 @@ class ClusterFinderTestCase(unittest.TestCase):
         )
         self.assertListEqual(["151", "153"], res)
 
+    def test_find_cluster_allocated_stands(self):
+        prefs = ["2", "4", "5", "7", "9", "11"]
+        self.sut.set_stands_allocated(["7"])
+        self.assertFalse(self.sut.option_is_available(["5", "7"]))
+        self.assertListEqual(["6", "8", "10"], self.sut.find_valid_cluster(prefs, size=3))
+        self.sut.set_stands_available(["7"])
+        self.assertTrue(self.sut.option_is_available(["5", "7"]))
+        self.assertListEqual(["5", "7", "9"], self.sut.find_valid_cluster(prefs, size=3))
+
+    def test_option_is_valid_branche(self):
+        dp = FixtureDataprovider("../fixtures/test_input.json")
+        dp.load_data()
+        sut = MarketStandClusterFinder(
+            dp.get_market_blocks(),
+            dp.get_obstacles(),
+            {"1": ["101-agf"], "2": []},
+            {"1": [], "2": ["eigen-materieel"]},
+            {"1": "bak", "2": "geen"},
+            [{"brancheId": "101-agf", "verplicht": True}],
+        )
+        self.assertTrue(sut.option_is_valid_branche(["1"], ["101-agf"], False, False))
+        self.assertFalse(sut.option_is_valid_branche(["1", "2"], ["101-agf"], False, False))
+        self.assertTrue(sut.option_is_valid_branche(["1", "2"], ["999-other"], False, False))
+        self.assertFalse(sut.option_is_valid_branche(["2"], ["999-other"], True, False))
+        self.assertFalse(sut.option_is_valid_branche(["1"], ["999-other"], False, True))
+        self.assertTrue(sut.option_is_valid_branche(["2"], ["999-other"], False, True))
+        self.assertFalse(
+            sut.option_is_valid_branche(["2"], ["999-other"], False, True, bak_type="bak-licht")
+        )
+
     def test_find_valid_expansion(self):
         res = self.sut.find_valid_expansion(["5", "7"], total_size=3)
         self.assertListEqual([["9"]], res)
@@ -348,6 +440,77 @@ class ClusterFinderTestCase(unittest.TestCase):
         self.assertListEqual(["207 - 209"], res)
 
 
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.value = json.dumps([{"level": "INFO", "message": "nog open plaatsen: 12"}] * 1000)
+
+    def test_compressed_value(self):
+        for compression in ("zlib", "gzip"):
+            encoded = encode_value(self.value, compression=compression, min_size=1024)
+            self.assertTrue(encoded.startswith(compression.encode() + b":"))
+            self.assertLess(len(encoded), len(self.value) / 10)
+            self.assertEqual(decode_value(encoded), self.value)
+
+    def test_small_or_uncompressed_value(self):
+        self.assertEqual(encode_value(self.value, compression="", min_size=1024), self.value)
+        self.assertEqual(encode_value("{}", compression="zlib", min_size=1024), "{}")
+        self.assertEqual(decode_value(self.value.encode("utf-8")), self.value)
+        self.assertEqual(decode_value(self.value), self.value)
+
+    def test_cache_key(self):
+        data = {"marktId": "16", "version": "2", "aanmeldingen": [1, 2]}
+        same_data = {"aanmeldingen": [1, 2], "version": "2", "marktId": "16"}
+        self.assertEqual(get_cache_key(data), get_cache_key(same_data))
+        self.assertNotEqual(get_cache_key(data), get_cache_key({**data, "version": "1"}))
+        settings = {"OPTIMIZER": "fridge", "CYCLE_SEARCH": "linear"}
+        self.assertEqual(get_cache_key(data, settings), get_cache_key(same_data, dict(settings)))
+        self.assertNotEqual(get_cache_key(data, settings), get_cache_key(data, {**settings, "CYCLE_SEARCH": "skip"}))
+
+    def test_memory_result_cache(self):
+        cache = MemoryResultCache(max_size=2, ttl=60)
+        cache.set("a", "result a")
+        cache.set("b", "result b")
+        self.assertEqual(cache.get("a"), "result a")
+        cache.set("c", "result c")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "result a")
+        self.assertEqual(cache.get("c"), "result c")
+
+        expired_cache = MemoryResultCache(max_size=2, ttl=-1)
+        expired_cache.set("a", "result a")
+        self.assertIsNone(expired_cache.get("a"))
+
+
+class OutboxTestCase(unittest.TestCase):
+    def test_send(self):
+        sut = Outbox(max_size=1)
+        done = []
+        sut.send(done.append, 1)
+        sut.send(done.append, 2)
+        sut.flush()
+        self.assertListEqual(done, [1, 2])
+        sut.close()
+
+    def test_drop_optional_side_effect_if_full(self):
+        sut = Outbox(max_size=1)
+        done = []
+        started, release = threading.Event(), threading.Event()
+
+        def busy():
+            started.set()
+            release.wait()
+
+        sut.send(busy)
+        started.wait()
+        sut.send(done.append, "queued")
+        sut.send(done.append, "optional", optional=True)
+        release.set()
+        sut.flush()
+        self.assertEqual(sut.dropped, 1)
+        self.assertListEqual(done, ["queued"])
+        sut.close()
+
+
 class OutputLayoutTest(unittest.TestCase):
     def setUp(self):
         f = open("../fixtures/merchant_3000187072.json", "r")
@@ -388,6 +551,15 @@ class OutputLayoutTest(unittest.TestCase):
         self.assertEqual(1, len(output["afwijzingen"]))
         self.assertEqual(3, code)
 
+    def test_slim_data(self):
+        self.sut.add_allocation("3000187072", [101, 102, 103], self.mock_merchant_obj)
+        self.sut.merchants = [self.mock_merchant_obj]
+        output = self.sut.to_data(slim=True)
+        self.assertEqual(
+            set(output), {"naam", "marktId", "marktDate", "toewijzingen", "afwijzingen"}
+        )
+        self.assertEqual(output["toewijzingen"], self.sut.to_data()["toewijzingen"])
+
 
 class AllocatorTest(unittest.TestCase):
     def setUp(self):
@@ -499,6 +671,22 @@ class AllocatorTest(unittest.TestCase):
         columns = list(self.sut.merchants_df)
         self.assertIn("pref", columns)
 
+    def test_prepared_columns_match_lookups_per_merchant(self):
+        for erk, row in self.sut.merchants_df.iterrows():
+            self.assertListEqual(row["pref"], self.sut.get_prefs_for_merchant(erk))
+            self.assertEqual(row["will_move"], self.sut.get_willmove_for_merchant(erk))
+            self.assertEqual(
+                row["branche_required"],
+                self.sut.get_required_for_branche(row["voorkeur.branches"]),
+            )
+
+    def test_logs_per_allocator(self):
+        other = Allocator(FixtureDataprovider("../fixtures/test_input.json"))
+        num_logs = len(other.get_logs())
+        self.sut.get_allocation()
+        self.assertIn("--- Makkelijkemarkt Allocatie ---", [x["message"] for x in self.sut.get_logs()])
+        self.assertEqual(num_logs, len(other.get_logs()))
+
     def test_get_merchants_with_evi(self):
         evis = self.sut.get_merchants_with_evi()
         expected_evis = [
@@ -0,0 +1,638 @@
+import glob
+import json
+import multiprocessing
+import threading
+import unittest
+from unittest import mock
+
+from v2.allocate import allocate, parse_and_allocate
+
+from v2.branche import Branche
+from v2.conf import Status, RejectionReason, KraamTypes, LogLevel, trace, trace_context
+from v2.kramen import Kraam
+from v2.markt import Markt
+from v2.ondernemers import Ondernemer, Ondernemers
+from v2.parse import Parse
+from v2.segments import MarktSegments, coordinate_segments
+from v2.strategy import OptimizationStrategy, LocalSearchOptimizationStrategy
+
+MARKT_META = {
+    'id': 1,
+    'afkorting': 'TEST',
+    'naam': 'Testmarkt',
+    'markt_date': '2022-01-01',
+    'soort': 'dag',
+    'maxAantalKramenPerOndernemer': 3,
+}
+
+
+def create_markt(kramen_per_row=(4, 4), ondernemers=None, branches=None):
+    kraam_id = 1
+    rows = []
+    for amount in kramen_per_row:
+        row = []
+        for _ in range(amount):
+            row.append(Kraam(id=kraam_id))
+            kraam_id += 1
+        rows.append(row)
+    return Markt(MARKT_META, rows, branches or [], ondernemers or [])
+
+
+def create_soll(rank, **kwargs):
+    return Ondernemer(rank=rank, status=Status.SOLL, raw={}, **{'min': 1, 'max': 2, **kwargs})
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.branche = Branche(id='101-agf', max=4)
+        self.ondernemer_1 = create_soll(1, branche=self.branche)
+        self.ondernemer_2 = create_soll(2)
+        self.markt = create_markt(ondernemers=[self.ondernemer_1, self.ondernemer_2], branches=[self.branche])
+        self.kramen_map = self.markt.kramen.kramen_map
+
+    def get_state(self):
+        return (
+            {kraam.id: kraam.ondernemer for kraam in self.kramen_map.values()},
+            {ondernemer.rank: set(ondernemer.kramen) for ondernemer in self.markt.ondernemers.all()},
+            self.branche.assigned_count,
+            self.ondernemer_1.is_rejected,
+        )
+
+    def test_restore_working_copy(self):
+        initial_state = self.get_state()
+        working_copy = self.markt.get_working_copy()
+        self.kramen_map[1].assign(self.ondernemer_1)
+        self.kramen_map[2].assign(self.ondernemer_1)
+        self.kramen_map[5].assign(self.ondernemer_2)
+        self.assertEqual(self.branche.assigned_count, 2)
+
+        self.markt.restore_working_copy(working_copy)
+        self.assertEqual(self.get_state(), initial_state)
+        self.assertEqual(len(self.markt.journal), 0)
+
+    def test_restore_working_copy_after_restoring_older_working_copy(self):
+        initial = self.markt.get_working_copy()
+        self.kramen_map[1].assign(self.ondernemer_1)
+        self.ondernemer_2.reject(RejectionReason.UNKNOWN)
+        first_cycle = self.markt.get_working_copy()
+        first_cycle_state = self.get_state()
+
+        self.markt.restore_working_copy(initial)
+        self.kramen_map[3].assign(self.ondernemer_1)
+        self.kramen_map[4].assign(self.ondernemer_1)
+        self.kramen_map[1].assign(self.ondernemer_2)
+
+        self.markt.restore_working_copy(first_cycle)
+        self.assertEqual(self.get_state(), first_cycle_state)
+        self.assertTrue(self.ondernemer_2.is_rejected)
+
+    def test_restore_kraam_type_and_branche(self):
+        branche = Branche(id='102-vis', verplicht=True)
+        kraam = Kraam(id=1, branche=branche, bak=True, bak_licht=True)
+        markt = Markt(MARKT_META, [[kraam]], [branche], [])
+        working_copy = markt.get_working_copy()
+        kraam.kraam_type.remove_active()
+        kraam.remove_verplichte_branche(branche)
+        self.assertEqual(str(kraam.kraam_type), 'L')
+        self.assertIsNone(kraam.branche)
+
+        markt.restore_working_copy(working_copy)
+        self.assertEqual(str(kraam.kraam_type), 'LB')
+        self.assertEqual(kraam.branche, branche)
+
+    def test_allocation_hash_is_restored(self):
+        kramen = self.markt.kramen
+        initial_hashes = (kramen.calculate_allocation_hash(), kramen.calculate_custom_allocation_hash())
+        working_copy = self.markt.get_working_copy()
+        self.kramen_map[1].assign(self.ondernemer_1)
+        self.kramen_map[2].assign(self.ondernemer_2)
+        self.assertNotEqual(kramen.calculate_allocation_hash(), initial_hashes[0])
+        self.assertEqual(kramen.calculate_custom_allocation_hash(), 1 * 1 + 2 * 2)
+
+        self.markt.restore_working_copy(working_copy)
+        self.assertEqual((kramen.calculate_allocation_hash(), kramen.calculate_custom_allocation_hash()), initial_hashes)
+
+    def test_allocation_hash_depends_on_allocation_only(self):
+        kramen = self.markt.kramen
+        self.kramen_map[1].assign(self.ondernemer_1)
+        self.kramen_map[2].assign(self.ondernemer_2)
+        allocation_hash = kramen.calculate_allocation_hash()
+
+        self.kramen_map[1].unassign(self.ondernemer_1)
+        self.kramen_map[2].unassign(self.ondernemer_2)
+        self.kramen_map[2].assign(self.ondernemer_1)
+        self.kramen_map[1].assign(self.ondernemer_2)
+        self.assertNotEqual(kramen.calculate_allocation_hash(), allocation_hash)
+
+        self.kramen_map[1].unassign(self.ondernemer_2)
+        self.kramen_map[2].unassign(self.ondernemer_1)
+        self.kramen_map[2].assign(self.ondernemer_2)
+        self.kramen_map[1].assign(self.ondernemer_1)
+        self.assertEqual(kramen.calculate_allocation_hash(), allocation_hash)
+
+    def test_kramen_count_per_ondernemer(self):
+        working_copy = self.markt.get_working_copy()
+        self.kramen_map[1].assign(self.ondernemer_1)
+        self.kramen_map[2].assign(self.ondernemer_1)
+        with trace_context() as context_trace:
+            self.assertEqual(self.markt.get_kramen_count_per_ondernemer(working_copy), {1: 0, 2: 0})
+        self.assertEqual(self.ondernemer_1.kramen, {1, 2})
+        # not a working copy of a strategy
+        self.assertEqual(context_trace.get_summary()['counters'], {})
+
+    def test_cleared_working_copy_can_not_be_restored(self):
+        working_copy = self.markt.get_working_copy()
+        self.markt.clear_working_copies()
+        with self.assertRaises(ValueError):
+            self.markt.restore_working_copy(working_copy)
+
+
+class WindowIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ondernemer_1 = create_soll(1)
+        self.ondernemer_2 = create_soll(2)
+        self.markt = create_markt(kramen_per_row=(5, 3, 1), ondernemers=[self.ondernemer_1, self.ondernemer_2])
+        self.kramen = self.markt.kramen
+        self.kramen.kramen_map[8].is_blocked = True
+
+    def find_clusters_by_scanning(self, size, ondernemer=None):
+        return [
+            cluster.kramen_list for cluster in self.kramen.make_clusters(size)
+            if not cluster.contains_blocked_kramen() and cluster.is_available(ondernemer)
+        ]
+
+    def assert_same_clusters(self):
+        for size in range(1, 6):
+            for ondernemer in None, self.ondernemer_1, self.ondernemer_2:
+                clusters = [cluster.kramen_list for cluster in self.kramen.find_clusters(size, ondernemer)]
+                self.assertEqual(clusters, self.find_clusters_by_scanning(size, ondernemer))
+
+    def test_find_clusters(self):
+        clusters = [cluster.kramen_list for cluster in self.kramen.find_clusters(3)]
+        self.assertEqual(clusters, [{1, 2, 3}, {2, 3, 4}, {3, 4, 5}])
+        self.assert_same_clusters()
+
+    def test_find_clusters_after_assign_and_unassign(self):
+        self.assert_same_clusters()
+        working_copy = self.markt.get_working_copy()
+        self.kramen.kramen_map[2].assign(self.ondernemer_1)
+        self.kramen.kramen_map[3].assign(self.ondernemer_1)
+        self.kramen.kramen_map[7].assign(self.ondernemer_2)
+        self.assert_same_clusters()
+        self.kramen.kramen_map[2].unassign(self.ondernemer_1)
+        self.assert_same_clusters()
+        self.markt.restore_working_copy(working_copy)
+        self.assert_same_clusters()
+        self.assertEqual(len(self.kramen.find_clusters(1)), 8)
+
+
+class OndernemersSelectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.branche = Branche(id='101-agf', verplicht=True)
+        self.vpl = Ondernemer(rank=3, status=Status.VPL, own=[1], raw={}, branche=self.branche)
+        self.soll_bak = create_soll(12, bak=True, anywhere=True)
+        self.soll_branche = create_soll(7, branche=self.branche)
+        self.soll = create_soll(9, anywhere=True)
+        self.markt = create_markt(ondernemers=[self.soll_bak, self.vpl, self.soll_branche, self.soll])
+        self.ondernemers = self.markt.ondernemers
+
+    def select_ranks(self, **filter_kwargs):
+        return [ondernemer.rank for ondernemer in self.ondernemers.select(**filter_kwargs)]
+
+    def test_select_in_rank_order(self):
+        self.assertEqual(self.select_ranks(), [3, 7, 9, 12])
+        self.assertEqual([ondernemer.rank for ondernemer in self.ondernemers.all()], [3, 7, 9, 12])
+        self.assertEqual(self.select_ranks(status=Status.SOLL), [7, 9, 12])
+        self.assertEqual(self.select_ranks(status__in=[Status.VPL, Status.TVPL]), [3])
+
+    def test_select_by_props(self):
+        self.assertEqual(self.select_ranks(branche=Branche(id='101-agf')), [3, 7])
+        self.assertEqual(self.select_ranks(branche__not__in=[self.branche]), [9, 12])
+        self.assertEqual(self.select_ranks(kraam_type=KraamTypes.BAK), [12])
+        self.assertEqual(self.select_ranks(kraam_type=None), [3, 7, 9])
+        self.assertEqual(self.select_ranks(kraam_type__not__in=[*KraamTypes], anywhere=True), [9])
+        self.assertEqual(self.select_ranks(status=Status.SOLL, anywhere=True, kraam_type=None), [9])
+
+    def test_select_allocated(self):
+        kramen_map = self.markt.kramen.kramen_map
+        working_copy = self.markt.get_working_copy()
+        kramen_map[1].assign(self.vpl)
+        kramen_map[2].assign(self.soll)
+        kramen_map[3].assign(self.soll)
+        self.assertEqual(self.select_ranks(allocated=True), [3, 9])
+        self.assertEqual(self.select_ranks(allocated=False, status=Status.SOLL), [7, 12])
+
+        kramen_map[2].unassign(self.soll)
+        self.assertEqual(self.select_ranks(allocated=True), [3, 9])
+        kramen_map[3].unassign(self.soll)
+        self.assertEqual(self.select_ranks(allocated=True), [3])
+
+        self.markt.restore_working_copy(working_copy)
+        self.assertEqual(self.select_ranks(allocated=True), [])
+        self.assertEqual(self.select_ranks(allocated=False), [3, 7, 9, 12])
+
+    def test_prefs_from_unallocated_peers(self):
+        self.soll_branche.prefs = [2, 3]
+        self.soll.prefs = [3, 4]
+        self.soll_bak.prefs = [8]
+        markt = create_markt(ondernemers=[self.soll_bak, self.vpl, self.soll_branche, self.soll])
+        ondernemers, kramen_map = markt.ondernemers, markt.kramen.kramen_map
+        peer_prefs = ondernemers.get_prefs_from_unallocated_peers(peer_status=Status.SOLL)
+        self.assertEqual(set(peer_prefs), {2, 3, 4, 8})
+        branche_peer_prefs = ondernemers.get_prefs_from_unallocated_peers(peer_status=Status.SOLL,
+                                                                          branche=self.branche)
+        self.assertEqual(set(branche_peer_prefs), {2, 3})
+
+        working_copy = markt.get_working_copy()
+        kramen_map[3].assign(self.soll)
+        kramen_map[4].assign(self.soll)
+        self.assertEqual(set(ondernemers.get_prefs_from_unallocated_peers(peer_status=Status.SOLL)), {2, 3, 8})
+        kramen_map[2].assign(self.soll_branche)
+        self.assertEqual(set(ondernemers.get_prefs_from_unallocated_peers(peer_status=Status.SOLL)), {8})
+        self.assertEqual(set(branche_peer_prefs), set())
+
+        markt.restore_working_copy(working_copy)
+        self.assertEqual(set(ondernemers.get_prefs_from_unallocated_peers(peer_status=Status.SOLL)), {2, 3, 4, 8})
+
+
+def scan_select(ondernemers, **filter_kwargs):
+    """the select of the ondernemers before the index, a scan with the same comparisons"""
+    selected = []
+    for ondernemer in ondernemers:
+        for kwarg, value in filter_kwargs.items():
+            if kwarg == 'allocated':
+                matches = bool(ondernemer.kramen) is value
+            elif kwarg.endswith('__not__in'):
+                matches = getattr(ondernemer, kwarg[:-len('__not__in')]) not in value
+            elif kwarg.endswith('__in'):
+                matches = getattr(ondernemer, kwarg[:-len('__in')]) in value
+            else:
+                matches = getattr(ondernemer, kwarg) == value
+            if not matches:
+                break
+        else:
+            selected.append(ondernemer)
+    return sorted(selected, key=lambda ondernemer: ondernemer.rank)
+
+
+class OndernemersIndexParityTestCase(unittest.TestCase):
+    def test_same_selection_as_scan_during_allocation(self):
+        mismatches = []
+        select = Ondernemers.select
+        get_prefs_from_unallocated_peers = Ondernemers.get_prefs_from_unallocated_peers
+
+        def checked_select(ondernemers, **filter_kwargs):
+            selected = select(ondernemers, **filter_kwargs)
+            expected = scan_select(ondernemers.ondernemers, **filter_kwargs)
+            if [ondernemer.rank for ondernemer in selected] != [ondernemer.rank for ondernemer in expected]:
+                mismatches.append(filter_kwargs)
+            return selected
+
+        def checked_prefs(ondernemers, peer_status, **filter_kwargs):
+            prefs = get_prefs_from_unallocated_peers(ondernemers, peer_status, **filter_kwargs)
+            peers = scan_select(ondernemers.ondernemers, status=peer_status, allocated=False, **filter_kwargs)
+            if set(prefs) != {pref for ondernemer in peers for pref in ondernemer.prefs}:
+                mismatches.append(filter_kwargs)
+            return prefs
+
+        with mock.patch.object(Ondernemers, 'select', checked_select), \
+                mock.patch.object(Ondernemers, 'get_prefs_from_unallocated_peers', checked_prefs):
+            for path in sorted(glob.glob('../fixtures/**/*.json', recursive=True)):
+                with open(path) as f:
+                    input_data = json.load(f)
+                input_data = input_data.get('data', input_data)
+                if 'marktDate' not in input_data or 'toewijzingen' in input_data:
+                    continue
+                with self.subTest(path=path), trace_context():
+                    try:
+                        allocate(**Parse(input_data).__dict__)
+                    except Exception:
+                        # the inputs v2 can not parse are covered by the other tests
+                        pass
+                    self.assertEqual(mismatches, [])
+
+
+class SwapOndernemersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.soll_1 = create_soll(1, prefs=[3, 4])
+        self.soll_2 = create_soll(2, prefs=[5, 6])
+        self.soll_3 = create_soll(3, prefs=[1, 2])
+        self.soll_4 = create_soll(4, prefs=[7])
+        self.markt = create_markt(ondernemers=[self.soll_1, self.soll_2, self.soll_3, self.soll_4])
+        self.kramen_map = self.markt.kramen.kramen_map
+
+    def assign(self, ondernemer, *kraam_ids):
+        for kraam_id in kraam_ids:
+            self.kramen_map[kraam_id].assign(ondernemer)
+
+    def test_swap_two_ondernemers(self):
+        self.assign(self.soll_1, 5, 6)
+        self.assign(self.soll_2, 3, 4)
+        self.assign(self.soll_4, 8)
+        OptimizationStrategy(self.markt).swap_ondernemers()
+        self.assertEqual(self.soll_1.kramen, {3, 4})
+        self.assertEqual(self.soll_2.kramen, {5, 6})
+        self.assertEqual(self.soll_4.kramen, {8})
+
+    def test_swap_cycle_of_three_ondernemers(self):
+        self.assign(self.soll_1, 1, 2)
+        self.assign(self.soll_2, 3, 4)
+        self.assign(self.soll_3, 5, 6)
+        strategy = OptimizationStrategy(self.markt)
+        self.assertEqual(strategy.get_swap_cycles(), [(self.soll_1, self.soll_2, self.soll_3)])
+        strategy.swap_ondernemers()
+        self.assertEqual(self.soll_1.kramen, {3, 4})
+        self.assertEqual(self.soll_2.kramen, {5, 6})
+        self.assertEqual(self.soll_3.kramen, {1, 2})
+
+    def test_no_swap_without_cycle_or_with_other_amount_of_kramen(self):
+        self.assign(self.soll_1, 1, 2)
+        self.assign(self.soll_2, 3, 4)
+        self.assign(self.soll_3, 5)
+        self.assertEqual(OptimizationStrategy(self.markt).get_swap_cycles(), [])
+
+
+class LocalSearchOptimizationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.branche = Branche(id='101-agf', max=3)
+        self.vpl = Ondernemer(rank=1, status=Status.VPL, own=[2], prefs=[2, 3], max=3, raw={}, branche=self.branche)
+        self.soll = create_soll(5, prefs=[7, 8], max=3)
+        self.soll_anywhere = create_soll(9, anywhere=True, max=1, branche=self.branche)
+        self.markt = create_markt(ondernemers=[self.vpl, self.soll, self.soll_anywhere], branches=[self.branche])
+        self.kramen_map = self.markt.kramen.kramen_map
+
+    def assign(self, ondernemer, *kraam_ids):
+        for kraam_id in kraam_ids:
+            self.kramen_map[kraam_id].assign(ondernemer)
+
+    def test_expand_displace_and_move(self):
+        self.assign(self.vpl, 2)
+        self.assign(self.soll_anywhere, 3)
+        self.assign(self.soll, 5)
+        LocalSearchOptimizationStrategy(self.markt).run()
+        # the vpl takes the preferred kraam of the less senior soll with anywhere, the branche max stops it at 2 kramen
+        self.assertEqual(self.vpl.kramen, {2, 3})
+        self.assertEqual(self.soll_anywhere.kramen_count, 1)
+        self.assertNotIn(3, self.soll_anywhere.kramen)
+        self.assertEqual(self.branche.assigned_count, 3)
+        # the soll moves to the prefs and expands to max
+        self.assertEqual(self.soll.kramen, {6, 7, 8})
+
+    def test_budget(self):
+        self.assign(self.soll, 5)
+        LocalSearchOptimizationStrategy(self.markt, max_iterations=0).run()
+        self.assertEqual(self.soll.kramen, {5})
+
+
+class TraceContextTestCase(unittest.TestCase):
+    def test_logs_are_bounded(self):
+        with trace_context(max_logs=3) as context_trace:
+            for i in range(5):
+                trace.log(f"message {i}")
+        self.assertEqual([log['message'][-9:] for log in context_trace.get_logs()], ['message 2', 'message 3', 'message 4'])
+        self.assertEqual(context_trace.dropped_logs, 2)
+
+    def test_logs_per_context(self):
+        logs = {}
+
+        def log_messages(name):
+            with trace_context() as context_trace:
+                for i in range(100):
+                    trace.log(name)
+                logs[name] = {log['message'].split(': ')[-1] for log in context_trace.get_logs()}
+
+        threads = [threading.Thread(target=log_messages, args=(name,)) for name in ('a', 'b', 'c')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(logs, {'a': {'a'}, 'b': {'b'}, 'c': {'c'}})
+
+    def test_phase_durations_and_counters(self):
+        with trace_context() as context_trace:
+            trace.set_phase(epic='parse', story='ondernemers')
+            trace.add_counters(get_cluster=1, clusters_evaluated=3)
+            trace.set_phase(epic='remaining', story='remaining', task='allocate')
+            trace.add_counters(get_cluster=1, clusters_evaluated=2)
+            trace.set_phase(task='debug')
+            trace.add_counters(get_cluster=1)
+        summary = context_trace.get_summary()
+        self.assertEqual(summary['counters'], {'get_cluster': 3, 'clusters_evaluated': 5})
+        self.assertEqual(summary['epics']['remaining']['counters'], {'get_cluster': 2, 'clusters_evaluated': 2})
+        self.assertEqual(set(summary['epics']['parse']['stories']), {'ondernemers'})
+        self.assertEqual(set(summary['epics']['remaining']['stories']), {'remaining'})
+
+    def test_new_epic_does_not_keep_the_story(self):
+        with trace_context() as context_trace:
+            trace.set_phase(epic='allocate_own_kramen', story='allocate_own_kramen')
+            trace.set_phase(epic='verplichte_branches')
+            trace.set_phase(story='VM101')
+            trace.set_phase(epic='optimization')
+            trace.set_phase(story='optimize_all')
+            trace.set_phase(epic='fill_up_b_list')
+        self.assertEqual(context_trace.story, '')
+        stories = {epic: set(epic_summary['stories']) for epic, epic_summary in context_trace.get_summary()['epics'].items()}
+        self.assertEqual(stories, {
+            'allocate_own_kramen': {'allocate_own_kramen'},
+            'verplichte_branches': {'', 'VM101'},
+            'optimization': {'', 'optimize_all'},
+            'fill_up_b_list': {''},
+        })
+
+    def test_stories_of_allocation(self):
+        with open('../fixtures/soll_noflex_validation.json') as f:
+            output, _logs = parse_and_allocate(json.load(f))
+        epics = output['stats']['epics']
+        self.assertEqual(set(epics['optimization']['stories']), {'', 'optimize_all'})
+        self.assertEqual(set(epics['fill_up_b_list']['stories']), {'', 'allocate_b_list'})
+        self.assertNotIn('allocate_own_kramen', epics['verplichte_branches']['stories'])
+        self.assertEqual(set(epics['kraamtypes']['stories']), {'', 'B', 'L', 'E'})
+
+    def test_detail_logs_are_not_formatted_below_log_level(self):
+        formatted = []
+
+        def message():
+            formatted.append(True)
+            return 'detail'
+
+        with trace_context() as context_trace:
+            context_trace.log_detail_level = LogLevel.INFO
+            trace.log(message)
+            trace.log("skipped {}", 1)
+            trace.log("kept {}", 2, detail_level=LogLevel.INFO)
+        self.assertEqual(formatted, [])
+        self.assertEqual([log['message'].split(': ')[-1] for log in context_trace.get_logs()], ['kept 2'])
+
+        with trace_context() as context_trace:
+            context_trace.log_detail_level = LogLevel.DETAIL
+            trace.log(message)
+        self.assertEqual(formatted, [True])
+        self.assertEqual([log['message'].split(': ')[-1] for log in context_trace.get_logs()], ['detail'])
+
+
+class ParseAndAllocateTestCase(unittest.TestCase):
+    def test_slim_output(self):
+        with open('../fixtures/soll_noflex_validation.json') as f:
+            input_data = json.load(f)
+        output, _logs = parse_and_allocate(input_data)
+        slim_output, _logs = parse_and_allocate(input_data, slim=True)
+        self.assertEqual(set(slim_output), {'naam', 'marktId', 'marktDate', 'toewijzingen', 'afwijzingen', 'stats'})
+        self.assertEqual(slim_output['marktId'], '78')
+        self.assertEqual(slim_output['toewijzingen'], output['toewijzingen'])
+        self.assertEqual(slim_output['afwijzingen'], output['afwijzingen'])
+        self.assertIn('ondernemers', output)
+
+    def test_stats(self):
+        with open('../fixtures/soll_noflex_validation.json') as f:
+            input_data = json.load(f)
+        output, logs = parse_and_allocate(input_data)
+        stats = output['stats']
+        self.assertEqual(stats['counters']['assign'] - stats['counters']['unassign'],
+                         sum(len(toewijzing['plaatsen']) for toewijzing in output['toewijzingen']))
+        self.assertGreater(stats['epics']['remaining']['counters']['get_cluster'], 0)
+        self.assertIn('Phase duration and counters', logs[-1]['message'])
+
+    def test_deadline(self):
+        with open('../fixtures/soll_noflex_validation.json') as f:
+            json_data = f.read()
+        output, _logs = parse_and_allocate(json.loads(json_data), deadline=60)
+        self.assertNotIn('truncated', output)
+
+        truncated_output, logs = parse_and_allocate(json.loads(json_data), deadline=1e-9)
+        self.assertEqual(truncated_output['truncated']['epic'], 'verplichte_branches')
+        self.assertTrue(any('Deadline of 1e-09 seconds exceeded' in log['message'] for log in logs))
+        # the last valid state is the markt with only the own kramen of the vph
+        for toewijzing in truncated_output['toewijzingen']:
+            ondernemer = toewijzing['ondernemer']
+            self.assertIn(ondernemer['status'], ('vpl', 'tvpl', 'eb', 'exp', 'expf'))
+            self.assertEqual(set(toewijzing['plaatsen']), set(ondernemer['plaatsen']))
+        self.assertEqual(len(truncated_output['toewijzingen']) + len(truncated_output['afwijzingen']),
+                         len(output['toewijzingen']) + len(output['afwijzingen']))
+
+
+class CycleSearchTestCase(unittest.TestCase):
+    def allocate(self, input_data, cycle_search):
+        with trace_context():
+            try:
+                output = allocate(**Parse(input_data).__dict__, cycle_search=cycle_search)
+            except Exception as e:
+                return repr(e)
+        return {
+            key: sorted((item['erkenningsNummer'], sorted(item.get('plaatsen', [])), item.get('reason'))
+                        for item in output[key])
+            for key in ('toewijzingen', 'afwijzingen')
+        }
+
+    def assert_same_output_as_linear(self, cycle_search):
+        for path in sorted(glob.glob('../fixtures/**/*.json', recursive=True)):
+            with open(path) as f:
+                json_data = f.read()
+            input_data = json.loads(json_data)
+            input_data = input_data.get('data', input_data)
+            if 'marktDate' not in input_data or 'toewijzingen' in input_data:
+                continue
+            json_data = json.dumps(input_data)
+            with self.subTest(path=path):
+                self.assertEqual(self.allocate(json.loads(json_data), cycle_search),
+                                 self.allocate(json.loads(json_data), 'linear'))
+
+    def test_skip_has_same_output_as_linear(self):
+        self.assert_same_output_as_linear('skip')
+
+    def test_parallel_has_same_output_as_linear(self):
+        self.assert_same_output_as_linear('parallel')
+
+
+class MarktSegmentsTestCase(unittest.TestCase):
+    def get_segments(self, ondernemers):
+        markt = create_markt(kramen_per_row=(4, 4, 4, 4))
+        segments = MarktSegments(markt.kramen.rows, ondernemers, max_segments=4).split()
+        return [([[kraam.id for kraam in row] for row in rows], [ondernemer.rank for ondernemer in ondernemers])
+                for rows, ondernemers in segments]
+
+    def test_split(self):
+        segments = self.get_segments([
+            create_soll(1, prefs=[1, 2]),
+            create_soll(2, prefs=[5]),
+            create_soll(3, prefs=[8, 9]),
+            create_soll(4, prefs=[]),
+        ])
+        # the free last row and the ondernemer without prefs are in every segment
+        self.assertEqual(segments, [
+            ([[5, 6, 7, 8], [9, 10, 11, 12], [13, 14, 15, 16]], [2, 3, 4]),
+            ([[1, 2, 3, 4], [13, 14, 15, 16]], [1, 4]),
+        ])
+
+    def test_anywhere_is_one_segment(self):
+        self.assertEqual(self.get_segments([create_soll(1, prefs=[1]), create_soll(2, prefs=[5], anywhere=True)]), [])
+
+    def test_branche_max_is_one_segment(self):
+        branche = Branche(id='101-agf', max=2)
+        self.assertEqual(self.get_segments([create_soll(1, prefs=[1], branche=branche),
+                                            create_soll(2, prefs=[5], branche=branche)]), [])
+
+    def allocate(self, input_data, segments, cycle_search):
+        with trace_context():
+            try:
+                output = allocate(**Parse(input_data).__dict__, segments=segments, cycle_search=cycle_search)
+            except Exception as e:
+                return repr(e)
+        if cycle_search == 'parallel':
+            # the segments run their cycles one by one, that only equals the parallel search up to the order
+            # of the plaatsen (see CycleSearchTestCase)
+            for allocation in output['toewijzingen']:
+                allocation['plaatsen'] = sorted(allocation['plaatsen'])
+        return output
+
+    @mock.patch('v2.segments.SEGMENT_WORKERS', 4)
+    def test_parallel_has_same_output_as_whole_markt(self):
+        results = []
+
+        def coordinate(connections):
+            results.append(coordinate_segments(connections))
+            return results[-1]
+
+        for path in sorted(glob.glob('../fixtures/**/*.json', recursive=True)):
+            with open(path) as f:
+                input_data = json.load(f)
+            input_data = input_data.get('data', input_data)
+            if 'marktDate' not in input_data or 'toewijzingen' in input_data:
+                continue
+            # without anywhere most fixtures have independent segments
+            for ondernemer in input_data['ondernemers']:
+                ondernemer['voorkeur']['anywhere'] = False
+            json_data = json.dumps(input_data)
+            for cycle_search in ('linear', 'skip', 'parallel'):
+                results.clear()
+                with self.subTest(path=path, cycle_search=cycle_search), \
+                        mock.patch('v2.allocate.coordinate_segments', coordinate):
+                    self.assertEqual(self.allocate(json.loads(json_data), 'parallel', cycle_search),
+                                     self.allocate(json.loads(json_data), 'off', cycle_search))
+                    # the segments did not fail, so the markt was not allocated as a whole instead
+                    self.assertNotIn(None, results)
+
+    def test_segment_out_of_step_fails(self):
+        connections = []
+        segment_connections = []
+        for message in [('outcome', {}), ('output', {'toewijzingen': []}, [], {})]:
+            connection, segment_connection = multiprocessing.Pipe()
+            segment_connection.send(message)
+            connections.append(connection)
+            segment_connections.append(segment_connection)
+        # the segment that sent an outcome is aborted
+        segment_connections[0].send(('error', 'SegmentAbortedException()'))
+        self.assertIsNone(coordinate_segments(connections))
+        self.assertEqual(segment_connections[0].recv(), 'abort')
+
+    def test_segment_at_deadline_stops_the_others(self):
+        connections = []
+        segment_connections = []
+        for message in [('outcome', {}), ('output', {'toewijzingen': [], 'truncated': {}}, [], {})]:
+            connection, segment_connection = multiprocessing.Pipe()
+            segment_connection.send(message)
+            connections.append(connection)
+            segment_connections.append(segment_connection)
+        # the segment that sent an outcome stops at its deadline as well
+        segment_connections[0].send(('output', {'toewijzingen': [], 'truncated': {}}, [], {}))
+        self.assertEqual(len(coordinate_segments(connections)), 2)
+        self.assertEqual(segment_connections[0].recv(), 'deadline')
@@ -29,6 +29,7 @@ from testcases.soll_expand_nonFlex import *
 
 # unit-test
 from test_allocation import *
+from test_v2 import *
 
 DEBUG = "DEBUG"
 
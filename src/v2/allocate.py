@@ -1,22 +1,20 @@
 import datetime
 import json
+import multiprocessing
 import sys
 
 from v2.markt import Markt
-from v2.conf import KraamTypes, trace, PhaseValue
-from v2.strategy import ReceiveOwnKramenStrategy, HierarchyStrategy, FillUpStrategyBList, OptimizationStrategy
+from v2.conf import (KraamTypes, LogLevel, trace, trace_context, PhaseValue, DeadlineExceededException,
+                     OPTIMIZER, ALLOCATION_DEADLINE, CYCLE_SEARCH, MARKT_SEGMENTS)
+from v2.strategy import ReceiveOwnKramenStrategy, HierarchyStrategy, FillUpStrategyBList, OPTIMIZATION_STRATEGIES
 from v2.validate import ValidateMarkt
 from v2.parse import Parse
+from v2.segments import MarktSegments, SegmentCoordinator, coordinate_segments
 
+SLIM_OUTPUT_IDENTIFIERS = ('naam', 'marktId', 'marktDate')
 
-def allocate(markt_meta, rows, branches, ondernemers, *args, **kwargs):
-    trace.set_phase(epic='initial', story='meta', task='time', group=PhaseValue.unknown, agent=PhaseValue.event)
-    start = datetime.datetime.now()
-    trace.log(f"start {start}")
-
-    markt = Markt(markt_meta, rows, branches, ondernemers)
-    ValidateMarkt(markt)
 
+def run_strategies(markt, optimizer):
     trace.set_phase(epic='allocate_own_kramen', story='allocate_own_kramen')
     receive_own_kramen_strategy = ReceiveOwnKramenStrategy(markt)
     receive_own_kramen_strategy.run()
@@ -60,13 +58,116 @@ def allocate(markt_meta, rows, branches, ondernemers, *args, **kwargs):
     markt.report_ondernemers()
     markt.report_branches()
     trace.set_phase(epic='optimization')
-    optimization_strategy = OptimizationStrategy(markt)
+    optimization_strategy = OPTIMIZATION_STRATEGIES[optimizer](markt)
     optimization_strategy.run()
 
     trace.set_phase(epic='fill_up_b_list')
     fill_up_strategy_b_list = FillUpStrategyBList(markt, **remaining_query)
     fill_up_strategy_b_list.run()
 
+
+def allocate_segment(connection, markt_meta, rows, branches, ondernemers, **kwargs):
+    """runs in a forked child process, sends the output, the logs and the counters of the segment"""
+    with trace_context() as segment_trace:
+        try:
+            output = allocate(markt_meta, rows, branches, ondernemers, segments='off',
+                              segment_coordinator=SegmentCoordinator(connection), **kwargs)
+            message = ('output', output, segment_trace.get_logs(), dict(segment_trace.counters))
+        except Exception as e:
+            message = ('error', repr(e))
+    connection.send(message)
+    connection.close()
+
+
+def allocate_in_segments(markt_meta, rows, branches, ondernemers, **kwargs):
+    """
+    Allocates the independent segments of the markt at the same time and merges their outputs,
+    returns None if the markt is one segment or if a segment failed.
+    """
+    if kwargs['optimizer'] != 'fridge':
+        # the budget of the local search is for the whole markt
+        return None
+    if multiprocessing.current_process().daemon or 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    segments = MarktSegments(rows, ondernemers).split()
+    if not segments:
+        return None
+
+    context = multiprocessing.get_context('fork')
+    connections = []
+    children = []
+    for segment_rows, segment_ondernemers in segments:
+        connection, child_connection = context.Pipe()
+        child = context.Process(target=allocate_segment, daemon=True,
+                                args=(child_connection, markt_meta, segment_rows, branches, segment_ondernemers),
+                                kwargs=kwargs)
+        child.start()
+        child_connection.close()
+        connections.append(connection)
+        children.append(child)
+    results = coordinate_segments(connections)
+    for connection, child in zip(connections, children):
+        connection.close()
+        child.join()
+    if results is None:
+        trace.log("Allocation of a segment failed, allocating the markt as a whole", detail_level=LogLevel.INFO)
+        return None
+
+    rank_of_ondernemer = {ondernemer.erkenningsnummer: ondernemer.rank for ondernemer in ondernemers}
+    output = {
+        'toewijzingen': {},
+        'afwijzingen': {},
+    }
+    for _message, segment_output, segment_logs, segment_counters in results:
+        for key in ('toewijzingen', 'afwijzingen'):
+            # the ondernemers without rows are in every segment
+            for allocation in segment_output[key]:
+                output[key].setdefault(allocation['erkenningsNummer'], allocation)
+        if 'truncated' in segment_output:
+            output.setdefault('truncated', segment_output['truncated'])
+        trace.logs.extend(segment_logs)
+        for epic, counter in segment_counters.items():
+            trace.counters[epic].update(counter)
+    for key in ('toewijzingen', 'afwijzingen'):
+        allocations = output[key].values()
+        output[key] = sorted(allocations, key=lambda allocation: rank_of_ondernemer[allocation['erkenningsNummer']])
+    return output
+
+
+def allocate(markt_meta, rows, branches, ondernemers, *args, optimizer=OPTIMIZER, deadline=ALLOCATION_DEADLINE,
+             cycle_search=CYCLE_SEARCH, segments=MARKT_SEGMENTS, segment_coordinator=None, **kwargs):
+    """
+    With a deadline (in seconds) the allocation stops at the first check after the deadline, the output is
+    the last valid markt state and 'truncated' tells in which phase the allocation was cut short.
+    With segments='parallel' the independent segments of the markt are allocated in parallel.
+    """
+    trace.set_phase(epic='initial', story='meta', task='time', group=PhaseValue.unknown, agent=PhaseValue.event)
+    start = datetime.datetime.now()
+    trace.log(f"start {start}")
+
+    if segments == 'parallel':
+        output = allocate_in_segments(markt_meta, rows, branches, ondernemers, optimizer=optimizer,
+                                      deadline=deadline, cycle_search=cycle_search)
+        if output is not None:
+            trace.set_phase(epic='end', story='meta', task='time', group=PhaseValue.unknown, agent=PhaseValue.event)
+            stop = datetime.datetime.now()
+            trace.log(f"{stop} - duration {stop - start}")
+            return output
+
+    markt = Markt(markt_meta, rows, branches, ondernemers)
+    markt.set_deadline(deadline)
+    markt.cycle_search = cycle_search
+    markt.segment_coordinator = segment_coordinator
+    ValidateMarkt(markt)
+
+    truncated = None
+    try:
+        run_strategies(markt, optimizer)
+    except DeadlineExceededException as e:
+        truncated = e.phase
+        trace.set_phase(epic='deadline', story='meta', task='time', group=PhaseValue.unknown, agent=PhaseValue.event)
+        trace.log("Deadline of {} seconds exceeded in {}", deadline, truncated, detail_level=LogLevel.INFO)
+
     markt.report_indeling()
     markt.report_ondernemers()
     markt.report_rejections()
@@ -77,26 +178,38 @@ def allocate(markt_meta, rows, branches, ondernemers, *args, **kwargs):
         'toewijzingen': allocations,
         'afwijzingen': rejections,
     }
+    if truncated:
+        output['truncated'] = truncated
 
     trace.set_phase(epic='end', story='meta', task='time')
     trace.log(f"Allocation hash: {markt.kramen.calculate_custom_allocation_hash()}")
     stop = datetime.datetime.now()
     trace.log(f"{stop} - duration {stop - start}")
+    trace.log(lambda: f"Phase duration and counters: {json.dumps(trace.get_summary())}", detail_level=LogLevel.INFO)
     return output
 
 
-def parse_and_allocate(input_data):
-    trace.clear()
-    try:
-        parsed = Parse(input_data)
-        output = allocate(**parsed.__dict__)
-    except Exception as e:
-        output = {'error': str(e)}
+def parse_and_allocate(input_data, slim=False, deadline=ALLOCATION_DEADLINE):
+    """
+    Returns the input data enriched with the toewijzingen and afwijzingen,
+    or with slim only the output and the markt identifiers.
+    """
+    with trace_context() as allocation_trace:
+        try:
+            parsed = Parse(input_data)
+            output = allocate(**parsed.__dict__, deadline=deadline)
+        except Exception as e:
+            output = {'error': str(e)}
+        output['stats'] = allocation_trace.get_summary()
+    if slim:
+        identifiers = {key: input_data.get(key) for key in SLIM_OUTPUT_IDENTIFIERS}
+    else:
+        identifiers = input_data
     enriched_output = {
-        **input_data,
+        **identifiers,
         **output,
     }
-    logs = trace.get_logs()
+    logs = allocation_trace.get_logs()
     return enriched_output, logs
 
 
@@ -18,31 +18,31 @@ class BaseAllocation(TraceMixin):
 
     def get_limit_for_ondernemer_with_branche_with_max(self, ondernemer):
         branche = ondernemer.branche
-        self.trace.log(f"Calculate branche limit for {branche}")
+        self.trace.log("Calculate branche limit for {}", branche)
         limit = self.markt.kramen_per_ondernemer
-        self.trace.log(f"Hard limit = kramen_per_ondernemer = {limit}")
+        self.trace.log("Hard limit = kramen_per_ondernemer = {}", limit)
 
         queue = {}
         branche_ondernemers = self.markt.ondernemers.select(branche=branche, status__in=[*ALL_VPH_STATUS, Status.SOLL])
         for branche_ondernemer in branche_ondernemers:
             queue[branche_ondernemer] = len(branche_ondernemer.kramen)
-        self.trace.log(f"initial queue: {queue}")
+        self.trace.log("initial queue: {}", queue)
 
         available = branche.max - branche.assigned_count
-        self.trace.log(f"Branche {branche} max {branche.max} - assigned {branche.assigned_count}"
-                       f" = available {available}")
+        self.trace.log("Branche {} max {} - assigned {} = available {}",
+                       branche, branche.max, branche.assigned_count, available)
 
         if not queue:
-            self.trace.log(f"No queue: use all {available} available")
+            self.trace.log("No queue: use all {} available", available)
             return available
 
         previous_available = available + 1
         while available and available != previous_available:
             lowest = min(queue.values())
-            self.trace.log(f"lowest entitlement in queue: {lowest}")
+            self.trace.log("lowest entitlement in queue: {}", lowest)
             previous_available = available
-            self.trace.log(f"Queue: {[(key.rank, value) for key,value in queue.items()]}")
-            self.trace.log(f"Available: {available}")
+            self.trace.log(lambda: f"Queue: {[(key.rank, value) for key,value in queue.items()]}")
+            self.trace.log("Available: {}", available)
             for branche_ondernemer in sorted(queue, key=attrgetter('seniority')):
                 # self.trace.log(f"checking branche_ondernemer: {branche_ondernemer}")
                 if queue[branche_ondernemer] == lowest < branche_ondernemer.max and available:
@@ -53,34 +53,35 @@ class BaseAllocation(TraceMixin):
                     if branche_ondernemer.has_better_seniority_than(ondernemer):
                         continue
 
-                    self.trace.log(f"raising entitlement of branche_ondernemer: {branche_ondernemer}")
+                    self.trace.log("raising entitlement of branche_ondernemer: {}", branche_ondernemer)
                     queue[branche_ondernemer] += 1
                     available -= 1
 
-        self.trace.log(f"optimized queue: {[(key.rank, value) for key,value in queue.items()]}")
-        self.trace.log(f"optimized queue total: {sum(queue.values())}")
+        self.trace.log(lambda: f"optimized queue: {[(key.rank, value) for key,value in queue.items()]}")
+        self.trace.log("optimized queue total: {}", sum(queue.values()))
         return queue.get(ondernemer, 1)  # grant 1 kraam if ondernemer is not in queue (e.g. b_list)
 
     def get_right_size_for_ondernemer(self, ondernemer):
         current_amount_kramen = len(ondernemer.kramen)
         amount_kramen_wanted = ondernemer.max
-        self.trace.log(f"get_right_size_for_ondernemer {ondernemer}")
+        self.trace.log("get_right_size_for_ondernemer {}", ondernemer)
 
         entitled_kramen = self.markt.kramen_per_ondernemer
         if ondernemer.branche.max:
             branche_limit = self.get_limit_for_ondernemer_with_branche_with_max(ondernemer)
-            self.trace.log(f"Branche {ondernemer.branche} limit {branche_limit} kramen")
+            self.trace.log("Branche {} limit {} kramen", ondernemer.branche, branche_limit)
             entitled_kramen = min(self.markt.kramen_per_ondernemer, branche_limit)
-            self.trace.log(f"entitled_kramen = lowest of {branche_limit}, {self.markt.kramen_per_ondernemer}"
-                           f" = {entitled_kramen}")
+            self.trace.log("entitled_kramen = lowest of {}, {} = {}",
+                           branche_limit, self.markt.kramen_per_ondernemer, entitled_kramen)
         else:
-            self.trace.log(f"entitled_kramen = kramen_per_ondernemer = {entitled_kramen}")
+            self.trace.log("entitled_kramen = kramen_per_ondernemer = {}", entitled_kramen)
         if ondernemer.is_vph:
             right_size = clamp(current_amount_kramen, amount_kramen_wanted, entitled_kramen)
-            self.trace.log(f"(current, wanted, entitled) "
-                           f"{current_amount_kramen, amount_kramen_wanted, entitled_kramen}"
-                           f" = {right_size}")
+            self.trace.log("(current, wanted, entitled) {} = {}",
+                           (current_amount_kramen, amount_kramen_wanted, entitled_kramen), right_size)
         else:
             right_size = min(amount_kramen_wanted, entitled_kramen)
-            self.trace.log(f"(wanted, entitled) {amount_kramen_wanted, entitled_kramen} = {right_size}")
+            self.trace.log("(wanted, entitled) {} = {}", (amount_kramen_wanted, entitled_kramen), right_size)
+        if entitled_kramen == self.markt.kramen_per_ondernemer < amount_kramen_wanted:
+            self.markt.limited_by_kramen_per_ondernemer = True
         return right_size
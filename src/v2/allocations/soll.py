@@ -6,8 +6,8 @@ from v2.kramen import Cluster
 class SollAllocation(BaseAllocation):
     def find_and_assign_kramen_to_ondernemer(self, ondernemer):
         size = self.get_right_size_for_ondernemer(ondernemer)
-        self.trace.log(f"size {size} = min(ondernemer.max: {ondernemer.max}, kramen_per_ondernemer: "
-                       f"{self.markt.kramen_per_ondernemer})")
+        self.trace.log("size {} = min(ondernemer.max: {}, kramen_per_ondernemer: {})",
+                       size, ondernemer.max, self.markt.kramen_per_ondernemer)
         peer_prefs = self.markt.ondernemers.get_prefs_from_unallocated_peers(peer_status=ondernemer.status,
                                                                              **self.ondernemer_filter_kwargs)
         cluster = self.markt.kramen.get_cluster(size=size, ondernemer=ondernemer, peer_prefs=peer_prefs,
@@ -26,6 +26,7 @@ class SollAllocation(BaseAllocation):
         ondernemers = self.markt.ondernemers.select(status=Status.SOLL, allocated=False,
                                                     **self.ondernemer_filter_kwargs)
         for ondernemer in ondernemers:
+            self.markt.check_deadline()
             self.trace.set_phase(agent=ondernemer.rank)
             self.find_and_assign_kramen_to_ondernemer(ondernemer)
 
@@ -34,14 +35,15 @@ class SollAllocation(BaseAllocation):
         ondernemers = self.markt.ondernemers.select(status=Status.B_LIST, allocated=False,
                                                     **self.ondernemer_filter_kwargs)
         for ondernemer in ondernemers:
+            self.markt.check_deadline()
             self.trace.set_phase(agent=ondernemer.rank)
             self.find_and_assign_kramen_to_ondernemer(ondernemer)
 
     def keep_on_lowering_size_to_find_cluster(self, size, ondernemer, peer_prefs):
         cluster = Cluster()
         while size >= 1:
-            self.trace.log(f"Trying to find cluster with size {size} because anywhere is False for "
-                           f"ondernemer {ondernemer}")
+            self.trace.log("Trying to find cluster with size {} because anywhere is False for ondernemer {}",
+                           size, ondernemer)
             cluster = self.markt.kramen.get_cluster(size=size, ondernemer=ondernemer, peer_prefs=peer_prefs,
                                                     **self.kramen_filter_kwargs)
             if cluster:
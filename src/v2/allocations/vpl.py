@@ -12,7 +12,7 @@ class VplAllocation(BaseAllocation):
             for kraam_id in ondernemer.own:
                 kraam = self.markt.kramen.get_kraam_by_id(kraam_id=kraam_id)
                 if not kraam or kraam.is_blocked:
-                    self.trace.log(f"Kraam {kraam_id} does not exist or is blocked")
+                    self.trace.log("Kraam {} does not exist or is blocked", kraam_id)
                     ondernemer.reject(RejectionReason.KRAAM_DOES_NOT_EXIST)
                 else:
                     kraam.assign(ondernemer)
@@ -30,8 +30,9 @@ class VplAllocation(BaseAllocation):
         ondernemers = self.markt.ondernemers.select(status=Status.TVPLZ, allocated=False,
                                                     **self.ondernemer_filter_kwargs)
         for ondernemer in ondernemers:
+            self.markt.check_deadline()
             self.trace.set_phase(agent=ondernemer.rank)
-            self.trace.log(f"Trying to allocate TVPLZ {ondernemer}")
+            self.trace.log("Trying to allocate TVPLZ {}", ondernemer)
             size = len(ondernemer.own)
             peer_prefs = self.markt.ondernemers.get_prefs_from_unallocated_peers(peer_status=ondernemer.status,
                                                                                  **self.ondernemer_filter_kwargs)
@@ -45,9 +46,10 @@ class VplAllocation(BaseAllocation):
         self.trace.set_phase(task='move_to_prefs', group=vph_status)
         ondernemers = self.markt.ondernemers.select(status=vph_status, **self.ondernemer_filter_kwargs)
         for ondernemer in ondernemers:
+            self.markt.check_deadline()
             self.trace.set_phase(agent=ondernemer.rank)
             if set(ondernemer.prefs).difference(ondernemer.own):
-                self.trace.log(f"Trying to move Ondernemer {ondernemer}")
+                self.trace.log("Trying to move Ondernemer {}", ondernemer)
                 size = self.get_right_size_for_ondernemer(ondernemer)
                 current_size = len(ondernemer.kramen)
 
@@ -64,27 +66,28 @@ class VplAllocation(BaseAllocation):
         self.trace.set_phase(task='vph_uitbreiding', group=vph_status)
         ondernemers = self.markt.ondernemers.select(status=vph_status, **self.ondernemer_filter_kwargs)
         for ondernemer in ondernemers:
+            self.markt.check_deadline()
             self.expand_vph(ondernemer)
 
     def expand_vph(self, ondernemer):
         self.trace.set_phase(agent=ondernemer.rank)
-        self.trace.log(f"Uitbreiden van ondernemer {ondernemer}")
+        self.trace.log("Uitbreiden van ondernemer {}", ondernemer)
         size = self.get_right_size_for_ondernemer(ondernemer)
         current_size = len(ondernemer.kramen)
 
         if size < current_size:
-            self.trace.log(f"Current kramen size {size} smaller than current {current_size}, skip expansion")
+            self.trace.log("Current kramen size {} smaller than current {}, skip expansion", size, current_size)
             return
         if size == current_size:
-            self.trace.log(f"Size {size} same as {current_size}")
+            self.trace.log("Size {} same as {}", size, current_size)
             if not ondernemer.prefs:
-                self.trace.log(f"No prefs, skip expansion")
+                self.trace.log("No prefs, skip expansion")
                 return
             elif ondernemer.prefs and set(ondernemer.prefs).intersection(ondernemer.kramen):
-                self.trace.log(f"Current kramen matching with prefs, skip expansion")
+                self.trace.log("Current kramen matching with prefs, skip expansion")
                 return
             else:
-                self.trace.log(f"Current kramen {ondernemer.kramen} not matching with prefs {ondernemer.prefs}")
+                self.trace.log("Current kramen {} not matching with prefs {}", ondernemer.kramen, ondernemer.prefs)
         cluster = self.markt.kramen.get_cluster(size=size, ondernemer=ondernemer,
                                                 should_include=ondernemer.kramen, **self.kramen_filter_kwargs)
         cluster.assign(ondernemer)
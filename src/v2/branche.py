@@ -1,4 +1,7 @@
-class Branche:
+from v2.journal import JournalMixin
+
+
+class Branche(JournalMixin):
     def __init__(self, id=None, max=None, verplicht=False):
         self.id = id
         self.max = max
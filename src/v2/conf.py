@@ -1,9 +1,53 @@
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
 from enum import Enum
 import json
+import os
+import time
 
 BAK_TYPE_BRANCHE_IDS = ['bak', 'bak-licht']
 EXP_BRANCHE = '401 -  Overig markt - Experimentele zone'
 
+# maximum number of log entries kept per allocation, the oldest are dropped first
+MAX_TRACE_LOGS = 100000
+
+
+class LogLevel:
+    DETAIL = 1
+    INFO = 2
+
+
+# production can skip the detail logs with TRACE_LOG_LEVEL=2
+TRACE_LOG_LEVEL = int(os.getenv('TRACE_LOG_LEVEL', LogLevel.DETAIL))
+
+
+# optimizer after the hierarchy strategies: 'fridge' (OptimizationStrategy) or 'local_search'
+OPTIMIZER = os.getenv('OPTIMIZER', 'fridge')
+# budget of the local search optimizer, in seconds and in evaluated ondernemers
+LOCAL_SEARCH_TIME_BUDGET = float(os.getenv('LOCAL_SEARCH_TIME_BUDGET', 5))
+LOCAL_SEARCH_MAX_ITERATIONS = int(os.getenv('LOCAL_SEARCH_MAX_ITERATIONS', 100000))
+# cycles of the hierarchy strategies: 'linear' runs every kramen_per_ondernemer until the allocation stops changing,
+# 'skip' stops as soon as kramen_per_ondernemer did not limit anybody, the next cycle would have the same outcome
+# and 'parallel' evaluates the cycles in forked child processes, at most CYCLE_WORKERS at the same time
+CYCLE_SEARCH = os.getenv('CYCLE_SEARCH', 'linear')
+CYCLE_WORKERS = int(os.getenv('CYCLE_WORKERS', os.cpu_count() or 1))
+# maximum duration of an allocation in seconds, no deadline by default
+ALLOCATION_DEADLINE = float(os.getenv('ALLOCATION_DEADLINE', 0)) or None
+# with 'parallel' the independent segments of a markt are allocated at the same time in forked child processes,
+# the independent parts of the markt are combined to at most SEGMENT_WORKERS segments
+MARKT_SEGMENTS = os.getenv('MARKT_SEGMENTS', 'off')
+SEGMENT_WORKERS = int(os.getenv('SEGMENT_WORKERS', os.cpu_count() or 1))
+# the settings that change the output of an allocation, a cached output is only valid for the same settings
+ENGINE_SETTINGS = {
+    'OPTIMIZER': OPTIMIZER,
+    'CYCLE_SEARCH': CYCLE_SEARCH,
+    'MARKT_SEGMENTS': MARKT_SEGMENTS,
+    'ALLOCATION_DEADLINE': ALLOCATION_DEADLINE,
+}
+# the output of these optimizers depends on how far they get in their time budget
+TIME_BUDGETED_OPTIMIZERS = ('local_search',)
+
 
 class ComparableEnum(Enum):
     def __eq__(self, other):
@@ -83,7 +127,7 @@ class Step:
 
 
 class Trace:
-    def __init__(self, rows=None):
+    def __init__(self, rows=None, max_logs=None):
         self.steps = []
         self.count = 1
         self.action = Action
@@ -94,11 +138,21 @@ class Trace:
         self.group = ''
         self.agent = ''
         self.cycle = 0
+        self.phase_prefix = ''
+        self.update_phase_prefix()
 
-        self.log_detail_level = 1
-        self.logs = []
+        self.log_detail_level = TRACE_LOG_LEVEL
+        self.max_logs = max_logs
+        self.logs = deque(maxlen=max_logs)
+        self.dropped_logs = 0
         self.local = False
 
+        # time spent per (epic, story) and hot path counters per epic
+        self.timed_phase = None
+        self.phase_start = None
+        self.phase_durations = defaultdict(float)
+        self.counters = defaultdict(Counter)
+
     @property
     def content(self):
         return {
@@ -107,39 +161,60 @@ class Trace:
         }
 
     def clear(self):
-        self.logs = []
+        self.logs = deque(maxlen=self.max_logs)
+        self.dropped_logs = 0
 
-    def log(self, message, detail_level=1):
-        phase = f"{self.epic}__{self.story}__{self.task}__{self.group}__{self.agent}"
+    def update_phase_prefix(self):
+        self.phase_prefix = f"{self.epic}__{self.story}__{self.task}__{self.group}__{self.agent}"
         if self.cycle:
-            phase += f":{self.cycle}"
-        if detail_level >= self.log_detail_level:
-            complete_message = f"{phase}: {message}"
-            if self.local:
-                print(complete_message)
-
-            log_entry = {
-                'level': detail_level,
-                'message': complete_message,
-            }
-            self.logs.append(log_entry)
-
-    def debug(self, message):
+            self.phase_prefix += f":{self.cycle}"
+
+    def log(self, message, *args, detail_level=LogLevel.DETAIL):
+        """
+        The message is a str.format template for args or a callable returning the message,
+        it is only formatted if detail_level is not below the log_detail_level.
+        """
+        if detail_level < self.log_detail_level:
+            return
+        if callable(message):
+            message = message()
+        elif args:
+            message = message.format(*args)
+        complete_message = f"{self.phase_prefix}: {message}"
+        if self.local:
+            print(complete_message)
+
+        log_entry = {
+            'level': detail_level,
+            'message': complete_message,
+        }
+        if len(self.logs) == self.max_logs:
+            self.dropped_logs += 1
+        self.logs.append(log_entry)
+
+    def debug(self, message, *args):
+        if LogLevel.DETAIL < self.log_detail_level:
+            return
         task, group, agent = self.task, self.group, self.agent
         self.set_phase(task='debug', group=Status.UNKNOWN, agent=PhaseValue.event)
-        self.log(message)
+        self.log(message, *args)
         self.set_phase(task=task, group=Status(group), agent=agent)
 
     def get_logs(self):
-        return self.logs
+        return list(self.logs)
 
     def set_rows(self, rows):
         self.rows = rows
 
     def set_phase(self, epic='', story='', task='', group=None, agent=''):
+        # a new epic starts without a story, the story of the previous epic does not belong to it
+        phase = (epic or self.epic, story or ('' if epic else self.story))
+        if phase != self.timed_phase:
+            self.time_phase(phase)
         if epic:
             self.epic = epic
-        if story:
+            self.story = story
+        elif story:
             self.story = story
         if task:
             self.task = task
@@ -147,9 +222,43 @@ class Trace:
             self.group = group.value if group else ''
         if agent:
             self.agent = agent
+        self.update_phase_prefix()
+
+    def time_phase(self, phase):
+        """adds the time since the previous phase change to the timed phase and starts timing phase"""
+        now = time.perf_counter()
+        if self.timed_phase is not None:
+            self.phase_durations[self.timed_phase] += now - self.phase_start
+        self.timed_phase = phase
+        self.phase_start = now
+
+    def add_counters(self, **amounts):
+        self.counters[self.epic].update(amounts)
+
+    def get_summary(self):
+        """duration and counters per epic, with the duration per story"""
+        self.time_phase(self.timed_phase)
+        epics = {}
+        for (epic, story), duration in self.phase_durations.items():
+            epic_summary = epics.setdefault(epic, {'duration': 0.0, 'stories': {}, 'counters': {}})
+            epic_summary['duration'] += duration
+            epic_summary['stories'][story] = round(duration, 4)
+        totals = Counter()
+        for epic, counter in self.counters.items():
+            epic_summary = epics.setdefault(epic, {'duration': 0.0, 'stories': {}, 'counters': {}})
+            epic_summary['counters'] = dict(counter)
+            totals.update(counter)
+        for epic_summary in epics.values():
+            epic_summary['duration'] = round(epic_summary['duration'], 4)
+        return {
+            'duration': round(sum(self.phase_durations.values()), 4),
+            'counters': dict(totals),
+            'epics': epics,
+        }
 
     def set_cycle(self, cycle=0):
         self.cycle = cycle
+        self.update_phase_prefix()
 
     def set_report_phase(self, story='report', task='report'):
         self.set_phase(epic='report', story=story, task=task)
@@ -168,9 +277,11 @@ class Trace:
         self.count += 1
 
     def assign_kraam_to_ondernemer(self, kraam, ondernemer):
+        self.counters[self.epic]['assign'] += 1
         self.add_step(action=self.action.ASSIGN_KRAAM_TO_ONDERNEMER, kraam=kraam, ondernemer=ondernemer)
 
     def unassign_kraam(self, kraam):
+        self.counters[self.epic]['unassign'] += 1
         self.add_step(action=self.action.UNASSIGN_KRAAM, kraam=kraam)
 
     def assign_ondernemer_to_kraam(self):
@@ -183,7 +294,33 @@ class Trace:
         pass
 
 
-trace = Trace()
+current_trace = ContextVar('current_trace', default=Trace())
+
+
+class TraceProxy:
+    """
+    Module level access to the trace of the current context. Every allocation runs in its own
+    trace_context, so allocations in other threads or asyncio tasks don't share their logs.
+    """
+
+    def __getattr__(self, name):
+        return getattr(current_trace.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(current_trace.get(), name, value)
+
+
+@contextmanager
+def trace_context(max_logs=MAX_TRACE_LOGS, rows=None):
+    context_trace = Trace(rows=rows, max_logs=max_logs)
+    token = current_trace.set(context_trace)
+    try:
+        yield context_trace
+    finally:
+        current_trace.reset(token)
+
+
+trace = TraceProxy()
 
 
 class TraceMixin:
@@ -197,3 +334,13 @@ class PhaseValue:
 
 class HaltOptimizationException(Exception):
     pass
+
+
+class DeadlineExceededException(Exception):
+    def __init__(self, phase):
+        super().__init__(f"Deadline exceeded in {phase}")
+        self.phase = phase
+
+
+class SegmentAbortedException(Exception):
+    pass
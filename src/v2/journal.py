@@ -0,0 +1,101 @@
+import copy
+
+
+class Change:
+    __slots__ = ['parent', 'depth', 'redo', 'undo']
+
+    def __init__(self, parent=None, redo=None, undo=None):
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.redo = redo
+        self.undo = undo
+
+    def apply(self):
+        func, *args = self.redo
+        func(*args)
+
+    def revert(self):
+        func, *args = self.undo
+        func(*args)
+
+
+class WorkingCopy:
+    def __init__(self, journal, change, meta_data=None):
+        self.journal = journal
+        self.generation = journal.generation
+        self.change = change
+        self.meta_data = copy.deepcopy(meta_data)
+
+
+class Journal:
+    """
+    Records every mutation of the markt state (kramen, ondernemers and branches) as a change with an
+    undo and a redo action. The changes form a tree: a working copy is a reference to a change, so
+    restoring a working copy only reverts and replays the changes between the current state and the
+    working copy, instead of deep copying the whole markt.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.head = Change()
+
+    def __len__(self):
+        return self.head.depth
+
+    def reset(self):
+        # invalidates all working copies, so the recorded history can be garbage collected
+        self.generation += 1
+        self.head = Change()
+
+    def apply(self, redo, undo):
+        change = Change(self.head, redo, undo)
+        change.apply()
+        self.head = change
+
+    def setattr(self, obj, attr, value):
+        self.apply((setattr, obj, attr, value), (setattr, obj, attr, getattr(obj, attr)))
+
+    def checkpoint(self, meta_data=None):
+        return WorkingCopy(self, self.head, meta_data)
+
+    def rollback(self, working_copy):
+        if working_copy.journal is not self or working_copy.generation != self.generation:
+            raise ValueError('Working copy does not belong to the current journal')
+
+        to_revert, to_apply = [], []
+        current, target = self.head, working_copy.change
+        while current.depth > target.depth:
+            to_revert.append(current)
+            current = current.parent
+        while target.depth > current.depth:
+            to_apply.append(target)
+            target = target.parent
+        while current is not target:
+            to_revert.append(current)
+            current = current.parent
+            to_apply.append(target)
+            target = target.parent
+
+        for change in to_revert:
+            change.revert()
+        for change in reversed(to_apply):
+            change.apply()
+        self.head = working_copy.change
+        return copy.deepcopy(working_copy.meta_data)
+
+
+class JournalMixin:
+    journal = None
+
+    def journal_setattr(self, attr, value):
+        if self.journal is None:
+            setattr(self, attr, value)
+        else:
+            self.journal.setattr(self, attr, value)
+
+    def journal_apply(self, redo, undo):
+        if self.journal is None:
+            func, *args = redo
+            func(*args)
+        else:
+            self.journal.apply(redo, undo)
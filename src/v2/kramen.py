@@ -1,10 +1,12 @@
+from array import array
 from collections import defaultdict
 from operator import mul
 
 from v2.conf import KraamTypes, RejectionReason, TraceMixin, Status
+from v2.journal import JournalMixin
 
 
-class KraamType:
+class KraamType(JournalMixin):
     def __init__(self, bak=False, bak_licht=False, evi=False):
         self.props = []
         # order should be: evi, bak_licht, bak
@@ -43,9 +45,11 @@ class KraamType:
 
     def remove_active(self):
         try:
-            return self.props.pop()
+            active_prop = self.props[-1]
         except KeyError:
-            pass
+            return
+        self.journal_apply(redo=(self.props.pop,), undo=(self.props.append, active_prop))
+        return active_prop
 
     def does_allow(self, kraam_type):
         active_prop = self.get_active()
@@ -55,16 +59,18 @@ class KraamType:
             return kraam_type == active_prop
 
     def restore_original(self):
-        self.props = [*self.org_props]
+        self.journal_setattr('props', [*self.org_props])
 
 
-class Kraam(TraceMixin):
+class Kraam(TraceMixin, JournalMixin):
     def __init__(self, id, ondernemer=None, branche=None, is_blocked=False, **kwargs):
         self.id = id
         self.ondernemer = ondernemer
         self.branche = branche
         self.is_blocked = is_blocked
         self.kraam_type = KraamType(**kwargs)
+        self.windows = []
+        self.allocation_hash = None
 
     def __str__(self):
         kraam = f"kraam {self.id}"
@@ -91,14 +97,14 @@ class Kraam(TraceMixin):
         if self.branche == ondernemer.branche:
             return True
         else:
-            self.trace.log(f"Kraam {self} not allowed, different verplichte branche than ondernemer {ondernemer}")
+            self.trace.log("Kraam {} not allowed, different verplichte branche than ondernemer {}", self, ondernemer)
             return False
 
     def does_allow_ondernemer_kraam_type(self, ondernemer):
         if self.kraam_type.does_allow(ondernemer.kraam_type):
             return True
         else:
-            self.trace.log(f"Kraam {self} not allowed, different verplichte kraam_type than ondernemer {ondernemer}")
+            self.trace.log("Kraam {} not allowed, different verplichte kraam_type than ondernemer {}", self, ondernemer)
             return False
 
     def does_allow(self, ondernemer):
@@ -109,19 +115,28 @@ class Kraam(TraceMixin):
             return
         if self.ondernemer:
             if self.ondernemer == ondernemer.rank:
-                self.trace.log(f"Kraam {self.id} already assigned to own")
+                self.trace.log("Kraam {} already assigned to own", self.id)
             else:
-                self.trace.log(f"WARNING: kraam {self.id} already assigned to ondernemer {ondernemer}")
+                self.trace.log("WARNING: kraam {} already assigned to ondernemer {}", self.id, ondernemer)
         else:
-            self.trace.log(f"Assigning kraam {self.id} to ondernemer {ondernemer}")
-            self.ondernemer = ondernemer.rank
+            self.trace.log("Assigning kraam {} to ondernemer {}", self.id, ondernemer)
+            self.journal_apply(redo=(self.set_ondernemer, ondernemer.rank), undo=(self.set_ondernemer, None))
             self.trace.assign_kraam_to_ondernemer(self.id, ondernemer.rank)
             ondernemer.assign_kraam(self.id)
 
+    def set_ondernemer(self, ondernemer):
+        was_available = self.ondernemer is None
+        if self.allocation_hash is not None:
+            self.allocation_hash.update(self, self.ondernemer, ondernemer)
+        self.ondernemer = ondernemer
+        if was_available != (ondernemer is None):
+            for window_index, first, last in self.windows:
+                window_index.update_occupation(first, last, delta=1 if was_available else -1)
+
     def unassign(self, ondernemer):
         if self.ondernemer == ondernemer.rank:
-            self.trace.log(f"Unassigning kraam {self.id} from ondernemer {ondernemer}")
-            self.ondernemer = None
+            self.trace.log("Unassigning kraam {} from ondernemer {}", self.id, ondernemer)
+            self.journal_apply(redo=(self.set_ondernemer, None), undo=(self.set_ondernemer, ondernemer.rank))
             self.trace.unassign_kraam(self.id)
             ondernemer.unassign_kraam(self.id)
         else:
@@ -129,10 +144,10 @@ class Kraam(TraceMixin):
 
     def remove_verplichte_branche(self, branche):
         if self.branche == branche and self.branche.verplicht:
-            self.branche = None
-            self.trace.debug(f"Removed verplichte branche {branche} from {self}")
+            self.journal_setattr('branche', None)
+            self.trace.debug("Removed verplichte branche {} from {}", branche, self)
         else:
-            self.trace.debug(f"WARNING: kraam {self} does not have verplichte branche {branche}")
+            self.trace.debug("WARNING: kraam {} does not have verplichte branche {}", self, branche)
 
 
 class Cluster(TraceMixin):
@@ -187,8 +202,8 @@ class Cluster(TraceMixin):
             contains_own_kramen = bool(set(ondernemer.own).intersection(self.kramen_list))
             contains_prefs = bool(set(ondernemer.prefs).intersection(self.kramen_list))
             is_suitable = contains_own_kramen and contains_prefs
-            self.trace.log(f"contains_own_kramen: {contains_own_kramen}, contains_prefs: {contains_prefs}")
-            self.trace.log(f"Suits ondernemer status {ondernemer.status}: {is_suitable}")
+            self.trace.log("contains_own_kramen: {}, contains_prefs: {}", contains_own_kramen, contains_prefs)
+            self.trace.log("Suits ondernemer status {}: {}", ondernemer.status, is_suitable)
             return is_suitable
         return True
 
@@ -198,8 +213,8 @@ class Cluster(TraceMixin):
             current_size = len(ondernemer.kramen)
             offset = -abs(current_size)
             if branche.assigned_count + len(self.kramen) + offset > branche.max:
-                self.trace.log(f"WARNING: Amount of kramen {len(self.kramen) - offset} plus {branche.assigned_count} "
-                               f"exceeds branche '{branche}' max of {branche.max}")
+                self.trace.log("WARNING: Amount of kramen {} plus {} exceeds branche '{}' max of {}",
+                               len(self.kramen) - offset, branche.assigned_count, branche, branche.max)
                 return True
         return False
 
@@ -241,6 +256,119 @@ class Cluster(TraceMixin):
         return cluster_score
 
 
+class AllocationHash:
+    """
+    Zobrist style hash of the allocation: the xor of a key per (kraam, ondernemer) pair of the assigned kramen.
+    Kramen update the hash on assign/unassign in constant time, restoring a working copy replays the same
+    updates, so the hash is always the hash of the current allocation.
+    Next to it the custom hash (the sum of the ondernemer ranks weighted by the kraam position) is kept up to date.
+    """
+
+    def __init__(self, kramen):
+        self.value = 0
+        self.custom_value = 0
+        self.positions = {}
+        for position, kraam in enumerate(kramen):
+            self.positions[kraam] = position + 1
+            kraam.allocation_hash = self
+            if kraam.ondernemer is not None:
+                self.update(kraam, None, kraam.ondernemer)
+
+    @staticmethod
+    def get_key(kraam, ondernemer):
+        return hash((kraam.id, ondernemer))
+
+    def update(self, kraam, old_ondernemer, new_ondernemer):
+        if old_ondernemer is not None:
+            self.value ^= self.get_key(kraam, old_ondernemer)
+        if new_ondernemer is not None:
+            self.value ^= self.get_key(kraam, new_ondernemer)
+        if self.custom_value is not None:
+            try:
+                self.custom_value += self.positions[kraam] * ((new_ondernemer or 0) - (old_ondernemer or 0))
+            except TypeError:
+                # ranks that are not numbers, the custom hash is calculated from scratch from now on
+                self.custom_value = None
+
+
+class WindowIndex:
+    """
+    All windows of `size` adjacent kramen within a row, numbered in row order.
+    Per window the row id, start offset and the amount of occupied (or blocked) kramen is stored in arrays,
+    the windows without occupied kramen are kept in the `available` bitset. Kramen update the index on
+    assign/unassign, so finding the available clusters only visits the available windows.
+    """
+
+    def __init__(self, rows, size):
+        self.rows = rows
+        self.size = size
+        self.row_ids = array('l')
+        self.offsets = array('l')
+        self.occupied = array('l')
+        self.available = 0
+        self.clusters = {}
+
+        for row_id, row in enumerate(rows):
+            first = len(self.offsets)
+            amount_windows = len(row) - size + 1
+            for offset in range(max(amount_windows, 0)):
+                window = len(self.offsets)
+                self.row_ids.append(row_id)
+                self.offsets.append(offset)
+                occupied = sum(kraam.is_blocked or kraam.ondernemer is not None for kraam in row[offset:offset + size])
+                self.occupied.append(occupied)
+                if not occupied:
+                    self.available |= 1 << window
+            for position, kraam in enumerate(row):
+                start = max(position - size + 1, 0)
+                stop = min(position, amount_windows - 1)
+                if start <= stop:
+                    kraam.windows.append((self, first + start, first + stop))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def update_occupation(self, first, last, delta):
+        for window in range(first, last + 1):
+            self.occupied[window] += delta
+            if self.occupied[window]:
+                self.available &= ~(1 << window)
+            else:
+                self.available |= 1 << window
+
+    def get_cluster(self, window):
+        cluster = self.clusters.get(window)
+        if cluster is None:
+            offset = self.offsets[window]
+            cluster = Cluster(self.rows[self.row_ids[window]][offset:offset + self.size])
+            self.clusters[window] = cluster
+        return cluster
+
+    def get_windows_of_kraam(self, kraam):
+        for window_index, first, last in kraam.windows:
+            if window_index is self:
+                return range(first, last + 1)
+        return range(0)
+
+    def find_available_clusters(self, ondernemer=None, kramen_map=None):
+        windows = self.available
+        if ondernemer and ondernemer.kramen:
+            # windows partially occupied by the ondernemer itself are available to the ondernemer
+            for kraam_id in ondernemer.kramen:
+                kraam = kramen_map.get(kraam_id)
+                for window in self.get_windows_of_kraam(kraam) if kraam else []:
+                    cluster = self.get_cluster(window)
+                    if not cluster.contains_blocked_kramen() and cluster.is_available(ondernemer):
+                        windows |= 1 << window
+
+        clusters = []
+        while windows:
+            lowest = windows & -windows
+            clusters.append(self.get_cluster(lowest.bit_length() - 1))
+            windows ^= lowest
+        return clusters
+
+
 class Kramen(TraceMixin):
     def __init__(self, rows):
         self.rows = rows
@@ -248,6 +376,14 @@ class Kramen(TraceMixin):
         for row in rows:
             for kraam in row:
                 self.kramen_map[kraam.id] = kraam
+                kraam.windows = []
+        self.window_indexes = {}
+        self.allocation_hash = AllocationHash(self.kramen_map.values())
+
+    def set_journal(self, journal):
+        for kraam in self.kramen_map.values():
+            kraam.journal = journal
+            kraam.kraam_type.journal = journal
 
     def get_kraam_by_id(self, kraam_id):
         return self.kramen_map.get(kraam_id)
@@ -264,20 +400,18 @@ class Kramen(TraceMixin):
             } for kraam in row] for row in self.rows]
 
     def calculate_allocation_hash(self):
-        allocation = []
-        for kraam in self.kramen_map.values():
-            allocation.append((kraam.id, kraam.ondernemer))
-        frozen = frozenset(allocation)
-        return hash(frozen)
+        return self.allocation_hash.value
 
     def calculate_custom_allocation_hash(self):
+        if self.allocation_hash.custom_value is not None:
+            return self.allocation_hash.custom_value
         allocation = []
         for kraam in self.kramen_map.values():
             allocation.append((kraam.id, kraam.ondernemer))
         try:
             return sum(mul(index + 1, ondernemer or 0) for index, (_, ondernemer) in enumerate(allocation))
         except Exception as e:
-            self.trace.log(f'Exception {e} while calculating custom hash')
+            self.trace.log('Exception {} while calculating custom hash', e)
 
     def unassign_ondernemer(self, ondernemer):
         for kraam in self.kramen_map.values():
@@ -288,7 +422,7 @@ class Kramen(TraceMixin):
         if not new_cluster:
             return
         if new_cluster.kramen_list == ondernemer.kramen:
-            self.trace.log(f"Not moving, new cluster {new_cluster} same as current kramen for {ondernemer}")
+            self.trace.log("Not moving, new cluster {} same as current kramen for {}", new_cluster, ondernemer)
             return
 
         is_to_exceed_branche_max = new_cluster.does_exceed_branche_max(ondernemer)
@@ -307,11 +441,11 @@ class Kramen(TraceMixin):
                 continue
             if kraam.kraam_type == kraam_type:
                 active_prop = kraam.kraam_type.remove_active()
-                self.trace.debug(f"Removed active prop {active_prop} from kraam {kraam}")
+                self.trace.debug("Removed active prop {} from kraam {}", active_prop, kraam)
 
     def restore_original_kraamtype(self):
         for kraam in self.kramen_map.values():
-            self.trace.debug(f"Restoring original kraam type for {kraam}")
+            self.trace.debug("Restoring original kraam type for {}", kraam)
             kraam.kraam_type.restore_original()
 
     def order_clusters_by_ondernemer_prefs(self, clusters, ondernemer):
@@ -325,7 +459,7 @@ class Kramen(TraceMixin):
         for cluster in clusters:
             cluster_score = cluster.calculate_cluster_matching_prefs_score(prefs)
             if cluster_score:
-                self.trace.log(f"Scoring: cluster: {cluster}, prefs: {prefs}, cluster_score: {cluster_score}")
+                self.trace.log("Scoring: cluster: {}, prefs: {}, cluster_score: {}", cluster, prefs, cluster_score)
                 pref_clusters[cluster_score].append(cluster)
 
         for key in sorted(pref_clusters.keys(), reverse=True):
@@ -334,7 +468,7 @@ class Kramen(TraceMixin):
 
     def exclude_clusters_preferred_by_peers(self, clusters, peer_prefs):
         for cluster in clusters:
-            if cluster.kramen_list.intersection(peer_prefs):
+            if not peer_prefs.isdisjoint(cluster.kramen_list):
                 # logger.log(f"Cluster {cluster} in peer prefs: {peer_prefs}")
                 pass
             else:
@@ -349,33 +483,41 @@ class Kramen(TraceMixin):
                     clusters.append(Cluster(cluster))
         return clusters
 
+    def get_window_index(self, size):
+        window_index = self.window_indexes.get(size)
+        if window_index is None:
+            window_index = WindowIndex(self.rows, size)
+            self.window_indexes[size] = window_index
+        return window_index
+
     def find_clusters(self, size=1, ondernemer=None, **filter_kwargs):
         clusters = []
-        for cluster in self.make_clusters(size):
-            if cluster.contains_blocked_kramen():
-                continue
-            if cluster.is_available(ondernemer) and cluster.has_props(**filter_kwargs):
+        if size < 1:
+            return clusters
+        for cluster in self.get_window_index(size).find_available_clusters(ondernemer, self.kramen_map):
+            if cluster.has_props(**filter_kwargs):
                 clusters.append(cluster)
         if ondernemer:
-            self.trace.log(f"Found {len(clusters)} clusters of {size} for ondernemer {ondernemer}: {clusters}")
+            self.trace.log("Found {} clusters of {} for ondernemer {}: {}", len(clusters), size, ondernemer, clusters)
         return clusters
 
     def get_cluster(self, size, ondernemer, peer_prefs=None, should_include=None, **filter_kwargs):
         anywhere = getattr(ondernemer, 'anywhere', False)
-        peer_prefs = peer_prefs or []
+        peer_prefs = peer_prefs or set()
 
         clusters = self.find_clusters(size, ondernemer, **filter_kwargs)
+        self.trace.add_counters(get_cluster=1, clusters_evaluated=len(clusters))
         clusters = [cluster for cluster in clusters if cluster.is_allowed(ondernemer)]
         if should_include:
             should_include = set(should_include)
             clusters = [cluster for cluster in clusters if should_include.issubset(cluster.kramen_list)]
-            self.trace.log(f"Should include {should_include}: {clusters}")
+            self.trace.log("Should include {}: {}", should_include, clusters)
         pref_clusters = self.order_clusters_by_ondernemer_prefs(clusters, ondernemer)
 
-        self.trace.log(f"Anywhere: {anywhere}, peer_prefs: {peer_prefs}")
+        self.trace.log("Anywhere: {}, peer_prefs: {}", anywhere, peer_prefs)
         if anywhere or should_include:
             pref_clusters.extend(self.exclude_clusters_preferred_by_peers(clusters, peer_prefs))
             pref_clusters.extend(clusters)
-        self.trace.log(f"Best matching clusters: {pref_clusters}")
+        self.trace.log("Best matching clusters: {}", pref_clusters)
         first = next(iter(pref_clusters), Cluster())
         return first
@@ -1,11 +1,12 @@
-import copy
 import math
+import time
 import pandas as pd
 
 from v2.kramen import Kramen
 from v2.ondernemers import Ondernemers
-from v2.conf import (Status, RejectionReason, TraceMixin, PhaseValue,
-                     ALL_VPH_STATUS, BAK_TYPE_BRANCHE_IDS, REJECTION_REASON_NL)
+from v2.journal import Journal
+from v2.conf import (Status, RejectionReason, TraceMixin, PhaseValue, LogLevel, DeadlineExceededException,
+                     ALL_VPH_STATUS, BAK_TYPE_BRANCHE_IDS, REJECTION_REASON_NL, CYCLE_SEARCH)
 
 pd.set_option('display.max_colwidth', None)  # so auto truncate of broad columns is turned off
 pd.set_option('display.max_columns', None)  # so auto truncate of columns is turned off
@@ -22,6 +23,11 @@ class Markt(TraceMixin):
         self.soort = meta['soort']
         self.max_aantal_kramen_per_ondernemer = meta.get('maxAantalKramenPerOndernemer') or 1
         self.kramen_per_ondernemer = 1
+        # set when kramen_per_ondernemer made the size for an ondernemer smaller in the current cycle
+        self.limited_by_kramen_per_ondernemer = False
+        self.cycle_search = CYCLE_SEARCH
+        # set when the markt is one segment of a bigger markt, see v2.segments
+        self.segment_coordinator = None
 
         self.kramen = Kramen(rows)
         self.branches_map = {}
@@ -31,10 +37,17 @@ class Markt(TraceMixin):
         self.verplichte_branches = self.get_verplichte_branches()
         self.ondernemers = Ondernemers(ondernemers)
 
+        self.journal = Journal()
+        self.kramen.set_journal(self.journal)
+        self.ondernemers.set_journal(self.journal)
+        for branche in self.branches:
+            branche.journal = self.journal
+
         self.rejection_log = []
         self.step = 1
         self.working_copy = []
         self.allocation_hashes = []
+        self.deadline = None
 
         self.trace.set_rows(self.kramen.as_flat_rows())
 
@@ -45,7 +58,7 @@ class Markt(TraceMixin):
         except IndexError:
             last_allocation_hash = None
 
-        self.trace.debug(f"Current hash: {allocation_hash}, last hash {last_allocation_hash}, all: {self.allocation_hashes}")
+        self.trace.debug("Current hash: {}, last hash {}, all: {}", allocation_hash, last_allocation_hash, self.allocation_hashes)
         if allocation_hash == last_allocation_hash:
             return True
         else:
@@ -55,22 +68,39 @@ class Markt(TraceMixin):
     def clear_allocation_hashes(self):
         self.allocation_hashes = []
 
+    def set_deadline(self, seconds):
+        self.deadline = time.monotonic() + seconds if seconds else None
+
+    def check_deadline(self):
+        """the strategies call this between cycles and ondernemers, when the allocation state is consistent"""
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.raise_deadline_exceeded()
+
+    def raise_deadline_exceeded(self):
+        raise DeadlineExceededException({
+            'epic': self.trace.epic,
+            'story': self.trace.story,
+            'task': self.trace.task,
+        })
+
     def get_working_copy(self, meta_data=None):
-        return copy.deepcopy([
-            self.kramen,
-            self.ondernemers,
-            self.branches,
-            meta_data,
-        ])
+        self.trace.add_counters(working_copies=1)
+        return self.journal.checkpoint(meta_data)
 
     def restore_working_copy(self, working_copy):
-        [
-            self.kramen,
-            self.ondernemers,
-            self.branches,
-            meta_data,
-        ] = copy.deepcopy(working_copy)
-        return meta_data
+        self.trace.add_counters(working_copy_restores=1)
+        return self.journal.rollback(working_copy)
+
+    def clear_working_copies(self):
+        self.journal.reset()
+
+    def get_kramen_count_per_ondernemer(self, working_copy):
+        # only a look at the working copy, the journal is used directly so the working copy counters are not changed
+        current = self.journal.checkpoint()
+        self.journal.rollback(working_copy)
+        kramen_count = {ondernemer.rank: ondernemer.kramen_count for ondernemer in self.ondernemers.ondernemers}
+        self.journal.rollback(current)
+        return kramen_count
 
     def report_indeling(self):
         if self.trace.local:
@@ -120,15 +150,16 @@ class Markt(TraceMixin):
             if branche.max:
                 branche_ondernemers = self.ondernemers.select(branche=branche)
                 assigned_count = sum(len(ondernemer.kramen) for ondernemer in branche_ondernemers)
-                self.trace.log(f"{branche}, max: {branche.max}, assigned: {assigned_count}")
+                self.trace.log("{}, max: {}, assigned: {}", branche, branche.max, assigned_count,
+                               detail_level=LogLevel.INFO)
                 for ondernemer in branche_ondernemers:
-                    self.trace.log(ondernemer)
+                    self.trace.log(ondernemer, detail_level=LogLevel.INFO)
 
     def report_rejections(self):
         self.trace.set_report_phase(story='rejections', task='log')
-        self.trace.log(f"Rejection log:")
+        self.trace.log("Rejection log:", detail_level=LogLevel.INFO)
         for rejection in self.rejection_log:
-            self.trace.log(rejection)
+            self.trace.log(rejection, detail_level=LogLevel.INFO)
 
     def get_allocation(self, ondernemer):
         return {
@@ -148,9 +179,9 @@ class Markt(TraceMixin):
             if ondernemer.kramen:
                 allocations.append(allocation)
             else:
-                self.trace.log(f"Ondernemer without kramen: {ondernemer}")
+                self.trace.log("Ondernemer without kramen: {}", ondernemer)
                 if not ondernemer.is_rejected:
-                    self.trace.log(f"Ondernemer not rejected yet, rejecting now: {ondernemer}")
+                    self.trace.log("Ondernemer not rejected yet, rejecting now: {}", ondernemer)
                     ondernemer.reject(RejectionReason.UNKNOWN)
                 rejection = {
                     **allocation,
@@ -178,7 +209,7 @@ class Markt(TraceMixin):
                        if not ondernemer.reject_reason == RejectionReason.BRANCHE_FULL]
 
         if unallocated:
-            self.trace.debug(f"WARNING: Not everybody allocated! Unallocated: {unallocated}")
+            self.trace.debug("WARNING: Not everybody allocated! Unallocated: {}", unallocated)
             return False
         return True
 
@@ -191,8 +222,8 @@ class Markt(TraceMixin):
         # verplichte branche should also include "Experimentele zone" for EXP
         self.trace.set_phase(epic='parse', story='verplichte_branches', task='defining',
                              group=PhaseValue.unknown, agent=PhaseValue.event)
-        self.trace.log(f"Verplichte branches: {verplichte_branches}")
-        self.trace.log(f"Ignoring branches: {BAK_TYPE_BRANCHE_IDS}")
+        self.trace.log("Verplichte branches: {}", verplichte_branches)
+        self.trace.log("Ignoring branches: {}", BAK_TYPE_BRANCHE_IDS)
         return verplichte_branches
 
     def unassign_all_kramen_from_ondernemer(self, ondernemer):
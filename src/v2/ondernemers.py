@@ -1,11 +1,12 @@
-import itertools
+from collections import Counter
 
 from v2.conf import TraceMixin, RejectionReason, Status, ALL_VPH_STATUS, ALL_SOLL_STATUS
 from v2.branche import Branche
 from v2.kramen import KraamType
+from v2.journal import JournalMixin
 
 
-class Ondernemer(TraceMixin):
+class Ondernemer(TraceMixin, JournalMixin):
     def __init__(self, rank, erkenningsnummer='', description='', branche=None, prefs=None, min=0, max=0, anywhere=False,
                  kramen=None, own=None, status=None, raw=None, bak=False, bak_licht=False, evi=False):
         self.rank = rank
@@ -26,6 +27,7 @@ class Ondernemer(TraceMixin):
         self.reject_reason = ''
         self.seniority = self.get_seniority()
         self.can_move = self.status not in [Status.EB]
+        self.ondernemers_index = None
 
     def __str__(self):
         return f"Ondernemer {self.rank}, {self.status.value}, b={self.branche.shortname}, min={self.min}, max={self.max}, " \
@@ -70,25 +72,35 @@ class Ondernemer(TraceMixin):
     def kramen_count(self):
         return len(self.kramen)
 
-    def assign_kraam(self, kraam):
+    def add_kraam(self, kraam):
         self.kramen.add(kraam)
-        self.branche.assigned_count += 1
+        if self.ondernemers_index and len(self.kramen) == 1:
+            self.ondernemers_index.set_allocated(self, True)
+
+    def remove_kraam(self, kraam):
+        self.kramen.remove(kraam)
+        if self.ondernemers_index and not self.kramen:
+            self.ondernemers_index.set_allocated(self, False)
+
+    def assign_kraam(self, kraam):
+        self.journal_apply(redo=(self.add_kraam, kraam), undo=(self.remove_kraam, kraam))
+        self.branche.journal_setattr('assigned_count', self.branche.assigned_count + 1)
         if self.is_rejected:
             self.unreject()
 
     def unassign_kraam(self, kraam):
-        self.branche.assigned_count -= 1
-        self.kramen.remove(kraam)
+        self.branche.journal_setattr('assigned_count', self.branche.assigned_count - 1)
+        self.journal_apply(redo=(self.remove_kraam, kraam), undo=(self.add_kraam, kraam))
 
     def reject(self, reason):
-        self.trace.log(f"Rejecting: {reason.value} => {self}")
-        self.is_rejected = True
-        self.reject_reason = reason
+        self.trace.log("Rejecting: {} => {}", reason.value, self)
+        self.journal_setattr('is_rejected', True)
+        self.journal_setattr('reject_reason', reason)
 
     def unreject(self):
-        self.trace.log(f"Unrejecting: {self}")
-        self.reject_reason = ''
-        self.is_rejected = False
+        self.trace.log("Unrejecting: {}", self)
+        self.journal_setattr('reject_reason', '')
+        self.journal_setattr('is_rejected', False)
 
     def likes_proposed_kramen(self, proposed_kramen):
         if self.status in ALL_VPH_STATUS:
@@ -117,48 +129,130 @@ class Ondernemer(TraceMixin):
         return self.seniority < ondernemer.seniority
 
 
+class OndernemersIndex:
+    """
+    Secondary indexes on the ondernemers, as bitsets over the positions of the ondernemers ordered by rank.
+    Selecting is a bitwise intersection of the indexes, and the result is in rank order without sorting.
+    The prefs of the unallocated ondernemers are kept as reference counted multisets per selection, updated
+    when an ondernemer gets its first kraam or loses its last kraam.
+    """
+    prop_names = ['status', 'branche', 'kraam_type']
+    bool_prop_names = ['anywhere']
+
+    def __init__(self, ondernemers):
+        self.ondernemers = sorted(ondernemers, key=lambda ondernemer: ondernemer.rank)
+        self.positions = {}
+        self.everybody = (1 << len(self.ondernemers)) - 1
+        self.allocated = 0
+        self.indexes = {prop_name: {} for prop_name in [*self.prop_names, *self.bool_prop_names]}
+        self.unallocated_prefs = {}
+
+        for position, ondernemer in enumerate(self.ondernemers):
+            self.positions[ondernemer.rank] = position
+            for prop_name, index in self.indexes.items():
+                key = self.get_key(prop_name, getattr(ondernemer, prop_name))
+                index[key] = index.get(key, 0) | 1 << position
+            if ondernemer.kramen:
+                self.allocated |= 1 << position
+            ondernemer.ondernemers_index = self
+
+    @staticmethod
+    def get_key(prop_name, value):
+        if prop_name == 'status':
+            return getattr(value, 'value', value)
+        if prop_name == 'branche' and isinstance(value, Branche):
+            return 'branche', value.id
+        if prop_name == 'kraam_type' and isinstance(value, KraamType):
+            return value.get_active()
+        return value
+
+    def set_allocated(self, ondernemer, allocated):
+        position = self.positions[ondernemer.rank]
+        if allocated:
+            self.allocated |= 1 << position
+        else:
+            self.allocated &= ~(1 << position)
+
+        prefs = set(ondernemer.prefs)
+        for mask, prefs_counter in self.unallocated_prefs.items():
+            if mask & 1 << position:
+                if allocated:
+                    prefs_counter.subtract(prefs)
+                    for pref in prefs:
+                        if not prefs_counter[pref]:
+                            del prefs_counter[pref]
+                else:
+                    prefs_counter.update(prefs)
+
+    def get_mask(self, prop_name, values):
+        index = self.indexes[prop_name]
+        mask = 0
+        for value in values:
+            mask |= index.get(self.get_key(prop_name, value), 0)
+        return mask
+
+    def get_ondernemers(self, mask):
+        ondernemers = []
+        while mask:
+            lowest = mask & -mask
+            ondernemers.append(self.ondernemers[lowest.bit_length() - 1])
+            mask ^= lowest
+        return ondernemers
+
+    def get_filter_mask(self, **filter_kwargs):
+        mask = self.everybody
+        for kwarg, value in filter_kwargs.items():
+            if kwarg in [*self.prop_names, *self.bool_prop_names]:
+                mask &= self.get_mask(kwarg, [value])
+            elif kwarg.endswith('__not__in') and kwarg[:-len('__not__in')] in self.prop_names:
+                mask &= ~self.get_mask(kwarg[:-len('__not__in')], value)
+            elif kwarg.endswith('__in') and kwarg[:-len('__in')] in self.prop_names:
+                mask &= self.get_mask(kwarg[:-len('__in')], value)
+        return mask & self.everybody
+
+    def select(self, allocated=None, **filter_kwargs):
+        mask = self.get_filter_mask(**filter_kwargs)
+        if allocated is not None:
+            mask &= self.allocated if allocated else ~self.allocated
+        return self.get_ondernemers(mask)
+
+    def get_unallocated_prefs(self, **filter_kwargs):
+        """
+        Returns a live view on the prefs of the unallocated ondernemers matching the filters,
+        it changes when these ondernemers get allocated or unallocated.
+        """
+        mask = self.get_filter_mask(**filter_kwargs)
+        prefs_counter = self.unallocated_prefs.get(mask)
+        if prefs_counter is None:
+            prefs_counter = Counter()
+            for ondernemer in self.get_ondernemers(mask & ~self.allocated):
+                prefs_counter.update(set(ondernemer.prefs))
+            self.unallocated_prefs[mask] = prefs_counter
+        return prefs_counter.keys()
+
+
 class Ondernemers:
     def __init__(self, ondernemers=None):
         self.ondernemers = ondernemers or []
         self.ondernemers_map = {ondernemer.rank: ondernemer for ondernemer in ondernemers}
+        self.index = OndernemersIndex(self.ondernemers)
 
     def __repr__(self):
         return f'{len(self.ondernemers)} ondernemers'
 
+    def set_journal(self, journal):
+        for ondernemer in self.ondernemers:
+            ondernemer.journal = journal
+            ondernemer.branche.journal = journal
+
     def sort_by_rank(self, ondernemers):
         return sorted(ondernemers, key=lambda ondernemer: ondernemer.rank)
 
     def all(self):
-        return self.sort_by_rank(self.ondernemers)
+        return [*self.index.ondernemers]
 
     def get_prefs_from_unallocated_peers(self, peer_status, **filter_kwargs):
-        ondernemers = self.select(status=peer_status, allocated=False, **filter_kwargs)
-        all_prefs = (ondernemer.prefs for ondernemer in ondernemers)
-        return set(itertools.chain.from_iterable(all_prefs))
+        return self.index.get_unallocated_prefs(status=peer_status, **filter_kwargs)
 
     def select(self, **filter_kwargs):
-        filters = []
-        selected = []
-        prop_names = ['status', 'branche', 'kraam_type']
-        bool_prop_names = ['anywhere', 'is_soft_rejected']
-        for kwarg in filter_kwargs:
-            if kwarg in [*prop_names, *bool_prop_names]:
-                filters.append(lambda ondernemer, kwarg=kwarg: getattr(ondernemer, kwarg) == filter_kwargs[kwarg])
-            elif kwarg == 'allocated':
-                filters.append(lambda ondernemer: bool(ondernemer.kramen) is filter_kwargs['allocated'])
-
-            for prop_name in prop_names:
-                in_prop_name = f"{prop_name}__in"
-                not_in_prop_name = f"{prop_name}__not__in"
-                if kwarg == in_prop_name:
-                    filters.append(lambda ondernemer, prop_name=prop_name, in_prop_name=in_prop_name:
-                                   getattr(ondernemer, prop_name) in filter_kwargs[in_prop_name])
-                elif kwarg == not_in_prop_name:
-                    filters.append(lambda ondernemer, prop_name=prop_name, not_in_prop_name=not_in_prop_name:
-                                   getattr(ondernemer, prop_name) not in filter_kwargs[not_in_prop_name])
-
-        for ondernemer in self.ondernemers:
-            results = [f(ondernemer) for f in filters]
-            if all(results):
-                selected.append(ondernemer)
-        return self.sort_by_rank(selected)
+        return self.index.select(**filter_kwargs)
@@ -0,0 +1,163 @@
+from v2.conf import TraceMixin, SegmentAbortedException, SEGMENT_WORKERS
+
+
+class DisjointRows:
+    """union find over the row indexes of a markt"""
+
+    def __init__(self, amount):
+        self.parents = list(range(amount))
+
+    def find(self, index):
+        while self.parents[index] != index:
+            self.parents[index] = self.parents[self.parents[index]]
+            index = self.parents[index]
+        return index
+
+    def union(self, indexes):
+        indexes = [self.find(index) for index in indexes]
+        for index in indexes[1:]:
+            self.parents[index] = indexes[0]
+
+
+class MarktSegments(TraceMixin):
+    """
+    Splits a markt in segments that can be allocated independently. Clusters never span rows, so an ondernemer
+    without anywhere only gets kramen in the rows of the own kramen and the prefs. These rows form a segment
+    with the rows of the other ondernemers that share one of them, or that share a branche with a maximum.
+
+    Every segment also gets the rows that no ondernemer can get (they stay free, but count for the available
+    kramen) and the ondernemers without any row (they are rejected, but count for the validity of a cycle).
+    An ondernemer with anywhere can get kramen in every row, then the markt is one segment.
+    The independent parts are combined to at most max_segments segments with about the same amount of ondernemers.
+    """
+
+    def __init__(self, rows, ondernemers, max_segments=None):
+        self.rows = rows
+        self.ondernemers = ondernemers
+        self.max_segments = max_segments or SEGMENT_WORKERS
+
+    def get_rows_of_ondernemer(self, ondernemer, row_of_kraam):
+        kraam_ids = [*ondernemer.own, *ondernemer.prefs]
+        return {row_of_kraam[kraam_id] for kraam_id in kraam_ids if kraam_id in row_of_kraam}
+
+    def split(self):
+        """returns the segments as (rows, ondernemers), or an empty list if the markt is one segment"""
+        self.trace.set_phase(epic='segments', story='split', task='analyse')
+        anywhere = [ondernemer for ondernemer in self.ondernemers if ondernemer.anywhere]
+        if anywhere:
+            self.trace.log("Markt is one segment, {} ondernemers with anywhere", len(anywhere))
+            return []
+
+        row_of_kraam = {kraam.id: index for index, row in enumerate(self.rows) for kraam in row}
+        disjoint_rows = DisjointRows(len(self.rows))
+        rows_of_ondernemer = {}
+        rows_of_branche = {}
+        for ondernemer in self.ondernemers:
+            row_indexes = self.get_rows_of_ondernemer(ondernemer, row_of_kraam)
+            rows_of_ondernemer[ondernemer.rank] = row_indexes
+            disjoint_rows.union(row_indexes)
+            if ondernemer.branche.max:
+                rows_of_branche.setdefault(ondernemer.branche.id, set()).update(row_indexes)
+        for row_indexes in rows_of_branche.values():
+            disjoint_rows.union(row_indexes)
+
+        part_ondernemers = {}
+        without_rows = []
+        for ondernemer in self.ondernemers:
+            row_indexes = rows_of_ondernemer[ondernemer.rank]
+            if row_indexes:
+                root = disjoint_rows.find(min(row_indexes))
+                part_ondernemers.setdefault(root, []).append(ondernemer)
+            else:
+                without_rows.append(ondernemer)
+        amount_segments = min(len(part_ondernemers), self.max_segments)
+        if amount_segments < 2:
+            self.trace.log("Markt is one segment, {} independent parts", len(part_ondernemers))
+            return []
+
+        # the biggest part goes to the segment with the least ondernemers
+        segment_roots = [set() for _ in range(amount_segments)]
+        segment_sizes = [0] * amount_segments
+        for root, ondernemers in sorted(part_ondernemers.items(), key=lambda item: (-len(item[1]), item[0])):
+            smallest = segment_sizes.index(min(segment_sizes))
+            segment_roots[smallest].add(root)
+            segment_sizes[smallest] += len(ondernemers)
+
+        segments = []
+        for roots in segment_roots:
+            rows = [row for index, row in enumerate(self.rows)
+                    if disjoint_rows.find(index) in roots or disjoint_rows.find(index) not in part_ondernemers]
+            ondernemers = [ondernemer for root in roots for ondernemer in part_ondernemers[root]]
+            segments.append((rows, [*ondernemers, *without_rows]))
+        self.trace.log("Markt split into {} segments of {} independent parts, ondernemers per segment: {}, "
+                       "ondernemers without rows: {}", amount_segments, len(part_ondernemers), segment_sizes,
+                       len(without_rows))
+        return segments
+
+
+class SegmentCoordinator:
+    """used by a segment to make the cycle decisions of the strategies together with the other segments"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def decide(self, outcome):
+        self.connection.send(('outcome', outcome))
+        decision = self.connection.recv()
+        if decision == 'abort':
+            raise SegmentAbortedException()
+        return decision
+
+
+def decide_for_markt(outcomes):
+    """the decision of should_allocation_loop_continue for the whole markt from the outcomes of all segments"""
+    if all(outcome['same_hash'] for outcome in outcomes):
+        return 'same_hash'
+    if not all(outcome['valid'] for outcome in outcomes):
+        return 'invalid'
+    if not any(outcome['kramen_available'] for outcome in outcomes):
+        return 'full'
+    if not any(outcome['can_change'] for outcome in outcomes):
+        return 'skip'
+    return 'continue'
+
+
+def coordinate_segments(connections):
+    """
+    Every segment makes the same strategies and cycles, so they all send the outcome of a cycle before waiting for
+    the decision. A segment that sends its result while the others are in a cycle stopped at its deadline,
+    the others stop at their deadline as well. A result without a deadline there means the segments are out of
+    step, that counts as a failed segment. Returns the result per segment, or None if a segment failed.
+    """
+    results = {}
+    active = list(range(len(connections)))
+    failed = False
+    while active:
+        outcomes = {}
+        for index in active:
+            try:
+                message = connections[index].recv()
+            except EOFError:
+                message = ('error', "Segment process ended without result")
+            if message[0] == 'outcome':
+                outcomes[index] = message[1]
+            else:
+                results[index] = message
+                failed = failed or message[0] == 'error'
+        if outcomes and not failed:
+            for index in active:
+                if index not in outcomes and 'truncated' not in results[index][1]:
+                    results[index] = ('error', "Segment left the cycles without a deadline")
+                    failed = True
+        if failed:
+            decision = 'abort'
+        elif len(outcomes) < len(active):
+            decision = 'deadline'
+        else:
+            decision = decide_for_markt(outcomes.values())
+        for index in outcomes:
+            connections[index].send(decision)
+        active = list(outcomes)
+    if failed:
+        return None
+    return [results[index] for index in range(len(connections))]
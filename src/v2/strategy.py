@@ -1,7 +1,11 @@
 from collections import deque
+import multiprocessing
 from operator import attrgetter, sub
+import time
 
-from v2.conf import TraceMixin, Status, ALL_VPH_STATUS, PhaseValue, HaltOptimizationException
+from v2.conf import (TraceMixin, Status, ALL_VPH_STATUS, PhaseValue, HaltOptimizationException,
+                     DeadlineExceededException, LOCAL_SEARCH_TIME_BUDGET, LOCAL_SEARCH_MAX_ITERATIONS, CYCLE_WORKERS)
+from v2.kramen import Cluster
 from v2.allocations.vpl import VplAllocation
 from v2.allocations.soll import SollAllocation
 
@@ -31,29 +35,35 @@ class BaseStrategy(TraceMixin):
     def set_kramen_filter_kwargs(self, **filter_kwargs):
         self.kramen_filter_kwargs = filter_kwargs
 
+    def get_kramen_count_per_ondernemer(self):
+        return {ondernemer.rank: len(ondernemer.kramen) for ondernemer in self.markt.ondernemers.ondernemers}
+
     def is_iteration_better_than_previous(self):
         if self.working_copies:
-            previous = self.working_copies[-1]
-            _, previous_ondernemers, *_ = previous
-            combined_ondernemers = list(zip(self.markt.ondernemers.ondernemers, previous_ondernemers.ondernemers))
-            less_kramen = []
-            for current, previous in combined_ondernemers:
-                delta = len(current.kramen) - len(previous.kramen)
-                if delta < 0:
-                    if current.status == Status.SOLL:
-                        if not current.anywhere:
-                            continue
-                        if len(current.kramen) + 1 >= self.markt.kramen_per_ondernemer:
-                            continue
-                    if current.status == Status.B_LIST:
+            previous_kramen_count = self.markt.get_kramen_count_per_ondernemer(self.working_copies[-1])
+            return self.is_kramen_count_better_than_previous(self.get_kramen_count_per_ondernemer(),
+                                                             previous_kramen_count)
+
+    def is_kramen_count_better_than_previous(self, current_kramen_count, previous_kramen_count):
+        less_kramen = []
+        for current in self.markt.ondernemers.ondernemers:
+            previous = previous_kramen_count[current.rank]
+            delta = current_kramen_count[current.rank] - previous
+            if delta < 0:
+                if current.status == Status.SOLL:
+                    if not current.anywhere:
                         continue
-                    self.trace.debug(f"Ondernemer has less kramen in current iteration than previous")
-                    self.trace.debug(f"current: {current}")
-                    self.trace.debug(f"previous: {previous}")
-                    less_kramen.append([current, previous])
-            if less_kramen:
-                return False
-            return True
+                    if current_kramen_count[current.rank] + 1 >= self.markt.kramen_per_ondernemer:
+                        continue
+                if current.status == Status.B_LIST:
+                    continue
+                self.trace.debug("Ondernemer has less kramen in current iteration than previous")
+                self.trace.debug("current: {}", current)
+                self.trace.debug("previous kramen count: {}", previous)
+                less_kramen.append([current, previous])
+        if less_kramen:
+            return False
+        return True
 
     def is_allocation_valid(self):
         return (self.is_iteration_better_than_previous() and
@@ -61,13 +71,16 @@ class BaseStrategy(TraceMixin):
 
     def kramen_still_available(self):
         available_kramen_count = self.markt.kramen.find_clusters(1, **self.kramen_filter_kwargs)
-        self.trace.debug(f"Available kramen: {available_kramen_count}")
+        self.trace.debug("Available kramen: {}", available_kramen_count)
         return available_kramen_count
 
     def run(self):
         raise NotImplementedError
 
     def should_allocation_loop_continue(self):
+        if self.markt.segment_coordinator:
+            return self.should_segment_loop_continue()
+
         if self.markt.is_allocation_hash_same_as_previous_round():
             self.trace.debug('SAME HASH')
             return False
@@ -84,10 +97,57 @@ class BaseStrategy(TraceMixin):
         self.markt.kramen_per_ondernemer += 1
         return True
 
+    def should_segment_loop_continue(self):
+        """
+        The markt is one segment of a bigger markt, the outcome of the cycle is combined with the outcomes of the
+        other segments to the decision should_allocation_loop_continue would make for the whole markt.
+        """
+        decision = self.markt.segment_coordinator.decide({
+            'same_hash': self.markt.is_allocation_hash_same_as_previous_round(),
+            'valid': self.is_allocation_valid(),
+            'kramen_available': bool(self.kramen_still_available()),
+            'can_change': self.markt.cycle_search != 'skip' or self.markt.limited_by_kramen_per_ondernemer,
+        })
+        if decision == 'deadline':
+            self.markt.raise_deadline_exceeded()
+        if decision == 'invalid' and self.markt.kramen_per_ondernemer > 1:
+            self.markt.restore_working_copy(self.working_copies[-1])  # fallback to the previous state
+        if decision in ('same_hash', 'invalid', 'full'):
+            return False
+
+        self.working_copies.append(self.markt.get_working_copy())
+        self.markt.kramen_per_ondernemer += 1
+        return decision == 'continue'
+
+    def should_run_next_cycle(self):
+        if self.markt.segment_coordinator:
+            # the coordinator decides for the whole markt, including whether the next cycle can change it
+            return self.should_segment_loop_continue()
+        return self.should_allocation_loop_continue() and self.can_next_cycle_change_allocation()
+
+    def can_next_cycle_change_allocation(self):
+        """
+        Every cycle starts from the same state and only kramen_per_ondernemer differs. If it did not limit the size
+        for any ondernemer, the next cycle makes the same allocation and the linear search would stop there.
+        """
+        if self.markt.cycle_search != 'skip' or self.markt.limited_by_kramen_per_ondernemer:
+            return True
+        self.trace.debug("kramen_per_ondernemer {} did not limit any ondernemer, skipping the next cycles",
+                         self.markt.kramen_per_ondernemer - 1)
+        return False
+
+    def stop_at_deadline(self):
+        """falls back to the last valid cycle (or the state before the first cycle) and finishes"""
+        self.trace.log("Deadline exceeded, fallback to the last valid markt state")
+        if self.working_copies:
+            self.markt.restore_working_copy(self.working_copies[-1])
+        self.finish()
+
     def finish(self):
         self.markt.report_indeling()
         self.log_rejections()
         self.markt.clear_allocation_hashes()
+        self.markt.clear_working_copies()
         self.markt.report_ondernemers(**self.ondernemer_filter_kwargs)
         self.trace.set_cycle()
 
@@ -113,47 +173,154 @@ class HierarchyStrategy(BaseStrategy):
         self.working_copies.append(self.markt.get_working_copy())
         self.markt.kramen_per_ondernemer = 1
 
-        while self.markt.kramen_per_ondernemer <= self.markt.max_aantal_kramen_per_ondernemer:
-            self.trace.set_cycle(self.markt.kramen_per_ondernemer)
-            self.markt.restore_working_copy(self.working_copies[0])  # fallback to the initial state
-            self.markt.report_indeling()
+        try:
+            if self.markt.cycle_search == 'parallel':
+                self.run_cycles_in_parallel(vpl_allocation)
+            else:
+                self.run_cycles(vpl_allocation)
+        except DeadlineExceededException:
+            self.stop_at_deadline()
+            raise
+        self.finish()
 
-            # first expand
-            vpl_allocation.vph_uitbreiding(vph_status=Status.EB)
-            vpl_allocation.vph_uitbreiding(vph_status=Status.VPL)
-            vpl_allocation.vph_uitbreiding(vph_status=Status.TVPL)
-            vpl_allocation.vph_uitbreiding(vph_status=Status.EXP)
-            vpl_allocation.vph_uitbreiding(vph_status=Status.EXPF)
-            # then move to prefs
-            vpl_allocation.move_to_prefs(Status.VPL)
-            vpl_allocation.move_to_prefs(Status.TVPL)
-            vpl_allocation.move_to_prefs(Status.EXP)
-            vpl_allocation.move_to_prefs(Status.EXPF)
-            # try to move again, because move of others can make move now possible
-            vpl_allocation.move_to_prefs(Status.VPL)
-            vpl_allocation.move_to_prefs(Status.TVPL)
-            vpl_allocation.move_to_prefs(Status.EXP)
-            vpl_allocation.move_to_prefs(Status.EXPF)
-            # After other vphs have moved, expansion could be possible, so try again
-            vpl_allocation.vph_uitbreiding(vph_status=Status.EB)
-            vpl_allocation.vph_uitbreiding(vph_status=Status.VPL)
-            vpl_allocation.vph_uitbreiding(vph_status=Status.TVPL)
-            vpl_allocation.vph_uitbreiding(vph_status=Status.EXP)
-            vpl_allocation.vph_uitbreiding(vph_status=Status.EXPF)
-            # tvplz have anywhere so they are last vph to be allocated
-            vpl_allocation.allocate_tvplz()
+    def run_cycles(self, vpl_allocation):
+        while self.markt.kramen_per_ondernemer <= self.markt.max_aantal_kramen_per_ondernemer:
+            self.markt.check_deadline()
+            self.run_cycle(vpl_allocation)
+            if not self.should_run_next_cycle():
+                break
 
-            soll_allocation = SollAllocation(self.markt)
-            soll_allocation.set_ondernemer_filter_kwargs(**self.ondernemer_filter_kwargs)
-            soll_allocation.set_kramen_filter_kwargs(**self.kramen_filter_kwargs)
-            soll_allocation.allocate()
+    def run_cycles_in_parallel(self, vpl_allocation):
+        """
+        Every cycle starts from the initial state, so the cycles are evaluated at the same time in child processes
+        forked from it. The stop rules of run_cycles are replayed on their outcomes to choose the same cycle
+        and only the chosen cycle is run again in this process. Falls back to run_cycles if a child fails.
+        """
+        chosen = self.evaluate_cycles_in_parallel(vpl_allocation)
+        if not chosen:
+            self.trace.log("Parallel evaluation of the cycles not possible, running them one by one")
+            self.markt.kramen_per_ondernemer = 1
+            self.run_cycles(vpl_allocation)
+            return
+        chosen_cycle, kramen_per_ondernemer = chosen
+        self.trace.log("Parallel evaluation of the cycles chose kramen_per_ondernemer {}", chosen_cycle)
+        self.markt.check_deadline()
+        self.markt.kramen_per_ondernemer = chosen_cycle
+        self.run_cycle(vpl_allocation)
+        self.markt.kramen_per_ondernemer = kramen_per_ondernemer
+
+    def evaluate_cycles_in_parallel(self, vpl_allocation):
+        """returns the chosen cycle and the kramen_per_ondernemer run_cycles would end with, or None"""
+        can_fork = not multiprocessing.current_process().daemon and 'fork' in multiprocessing.get_all_start_methods()
+        if self.markt.max_aantal_kramen_per_ondernemer < 2 or not can_fork:
+            return None
+        context = multiprocessing.get_context('fork')
+        cycles = range(1, self.markt.max_aantal_kramen_per_ondernemer + 1)
+        workers = max(CYCLE_WORKERS, 1)
+        outcomes = {}
+        for start in range(0, len(cycles), workers):
+            children = []
+            for kramen_per_ondernemer in cycles[start:start + workers]:
+                receiver, sender = context.Pipe(duplex=False)
+                child = context.Process(target=self.evaluate_cycle, args=(vpl_allocation, kramen_per_ondernemer, sender),
+                                        daemon=True)
+                child.start()
+                sender.close()
+                children.append((kramen_per_ondernemer, receiver, child))
+            for kramen_per_ondernemer, receiver, child in children:
+                try:
+                    outcomes[kramen_per_ondernemer] = receiver.recv()
+                except EOFError:
+                    outcomes[kramen_per_ondernemer] = None
+                receiver.close()
+                child.join()
+            if None in outcomes.values():
+                return None
+            # the later cycles are not needed if the stop rules already stop in this batch
+            chosen = self.choose_cycle(outcomes)
+            if chosen:
+                return chosen
+        return None
+
+    def evaluate_cycle(self, vpl_allocation, kramen_per_ondernemer, connection):
+        """runs in a forked child process, sends what the stop rules need to know about the cycle"""
+        try:
+            self.markt.kramen_per_ondernemer = kramen_per_ondernemer
+            self.run_cycle(vpl_allocation)
+            outcome = {
+                'allocation_hash': self.markt.kramen.calculate_allocation_hash(),
+                'kramen_count': self.get_kramen_count_per_ondernemer(),
+                'valid': self.markt.is_allocation_valid(**self.ondernemer_filter_kwargs),
+                'kramen_available': bool(self.kramen_still_available()),
+            }
+        except Exception:
+            outcome = None
+        connection.send(outcome)
+        connection.close()
+
+    def choose_cycle(self, outcomes):
+        """
+        the stop rules of should_allocation_loop_continue applied to the outcomes of the cycles,
+        returns None if more cycles are needed
+        """
+        previous_hash = self.markt.allocation_hashes[-1] if self.markt.allocation_hashes else None
+        previous_kramen_count = self.get_kramen_count_per_ondernemer()  # the initial state
+        max_aantal_kramen_per_ondernemer = self.markt.max_aantal_kramen_per_ondernemer
+        for kramen_per_ondernemer in range(1, max_aantal_kramen_per_ondernemer + 1):
+            if kramen_per_ondernemer not in outcomes:
+                return None
+            outcome = outcomes[kramen_per_ondernemer]
+            self.markt.kramen_per_ondernemer = kramen_per_ondernemer
+            if outcome['allocation_hash'] == previous_hash:
+                return kramen_per_ondernemer, kramen_per_ondernemer
+            is_better = self.is_kramen_count_better_than_previous(outcome['kramen_count'], previous_kramen_count)
+            if not (is_better and outcome['valid']):
+                # fallback to the previous cycle
+                return max(kramen_per_ondernemer - 1, 1), kramen_per_ondernemer
+            if not outcome['kramen_available']:
+                return kramen_per_ondernemer, kramen_per_ondernemer
+            previous_hash = outcome['allocation_hash']
+            previous_kramen_count = outcome['kramen_count']
+        return max_aantal_kramen_per_ondernemer, max_aantal_kramen_per_ondernemer + 1
+
+    def run_cycle(self, vpl_allocation):
+        self.trace.set_cycle(self.markt.kramen_per_ondernemer)
+        self.markt.restore_working_copy(self.working_copies[0])  # fallback to the initial state
+        self.markt.limited_by_kramen_per_ondernemer = False
+        self.markt.report_indeling()
 
-            if not self.should_allocation_loop_continue():
-                break
-        self.finish()
+        # first expand
+        vpl_allocation.vph_uitbreiding(vph_status=Status.EB)
+        vpl_allocation.vph_uitbreiding(vph_status=Status.VPL)
+        vpl_allocation.vph_uitbreiding(vph_status=Status.TVPL)
+        vpl_allocation.vph_uitbreiding(vph_status=Status.EXP)
+        vpl_allocation.vph_uitbreiding(vph_status=Status.EXPF)
+        # then move to prefs
+        vpl_allocation.move_to_prefs(Status.VPL)
+        vpl_allocation.move_to_prefs(Status.TVPL)
+        vpl_allocation.move_to_prefs(Status.EXP)
+        vpl_allocation.move_to_prefs(Status.EXPF)
+        # try to move again, because move of others can make move now possible
+        vpl_allocation.move_to_prefs(Status.VPL)
+        vpl_allocation.move_to_prefs(Status.TVPL)
+        vpl_allocation.move_to_prefs(Status.EXP)
+        vpl_allocation.move_to_prefs(Status.EXPF)
+        # After other vphs have moved, expansion could be possible, so try again
+        vpl_allocation.vph_uitbreiding(vph_status=Status.EB)
+        vpl_allocation.vph_uitbreiding(vph_status=Status.VPL)
+        vpl_allocation.vph_uitbreiding(vph_status=Status.TVPL)
+        vpl_allocation.vph_uitbreiding(vph_status=Status.EXP)
+        vpl_allocation.vph_uitbreiding(vph_status=Status.EXPF)
+        # tvplz have anywhere so they are last vph to be allocated
+        vpl_allocation.allocate_tvplz()
+
+        soll_allocation = SollAllocation(self.markt)
+        soll_allocation.set_ondernemer_filter_kwargs(**self.ondernemer_filter_kwargs)
+        soll_allocation.set_kramen_filter_kwargs(**self.kramen_filter_kwargs)
+        soll_allocation.allocate()
 
     def finish(self):
-        self.trace.debug(f"Finished with kramen_per_ondernemer: {(self.markt.kramen_per_ondernemer - 1) or 1}")
+        self.trace.debug("Finished with kramen_per_ondernemer: {}", (self.markt.kramen_per_ondernemer - 1) or 1)
         self.markt.kramen_per_ondernemer = self.markt.max_aantal_kramen_per_ondernemer
         super().finish()
 
@@ -164,9 +331,19 @@ class FillUpStrategyBList(BaseStrategy):
         self.working_copies.append(self.markt.get_working_copy())
         self.markt.kramen_per_ondernemer = 1
 
+        try:
+            self.run_cycles()
+        except DeadlineExceededException:
+            self.stop_at_deadline()
+            raise
+        self.finish()
+
+    def run_cycles(self):
         while self.markt.kramen_per_ondernemer < self.markt.max_aantal_kramen_per_ondernemer:
+            self.markt.check_deadline()
             self.trace.set_cycle(self.markt.kramen_per_ondernemer)
             self.markt.restore_working_copy(self.working_copies[0])  # fallback to the initial state
+            self.markt.limited_by_kramen_per_ondernemer = False
 
             soll_allocation = SollAllocation(self.markt)
             soll_allocation.set_ondernemer_filter_kwargs(**self.ondernemer_filter_kwargs)
@@ -174,12 +351,11 @@ class FillUpStrategyBList(BaseStrategy):
             soll_allocation.allocate()
             soll_allocation.allocate_b_list()
 
-            if not self.should_allocation_loop_continue():
+            if not self.should_run_next_cycle():
                 break
-        self.finish()
 
     def finish(self):
-        self.trace.debug(f"Finished with kramen_per_ondernemer: {(self.markt.kramen_per_ondernemer - 1) or 1}")
+        self.trace.debug("Finished with kramen_per_ondernemer: {}", (self.markt.kramen_per_ondernemer - 1) or 1)
         super().finish()
 
 
@@ -194,7 +370,10 @@ class OptimizationStrategy(BaseStrategy):
             for limit in range(1, self.markt.max_aantal_kramen_per_ondernemer + 1):
                 self.optimize_all_assignments(limit=limit)
         except HaltOptimizationException:
-            self.trace.log(f"Optimization of assignments halted")
+            self.trace.log("Optimization of assignments halted")
+        except DeadlineExceededException:
+            self.stop_at_deadline()
+            raise
 
         self.trace.set_cycle()
         self.swap_ondernemers()
@@ -203,7 +382,7 @@ class OptimizationStrategy(BaseStrategy):
     def fill_fridge_with_soll_with_anywhere(self, exclude_ondernemer=None):
         self.trace.set_phase(task='fill_fridge', group=Status.SOLL, agent=PhaseValue.event)
         if not self.fridge:
-            self.trace.log(f"Fridge empty, now filling")
+            self.trace.log("Fridge empty, now filling")
             for soll in self.markt.ondernemers.select(status=Status.SOLL, anywhere=True, kraam_type=None):
                 self.trace.set_phase(task='fill_fridge', group=soll.status, agent=soll.rank)
                 if soll == exclude_ondernemer:
@@ -216,7 +395,7 @@ class OptimizationStrategy(BaseStrategy):
                 self.markt.unassign_all_kramen_from_ondernemer(soll)
                 self.fridge.append([soll, kramen_count])
         self.trace.set_phase(task='fill_fridge', group=Status.SOLL, agent=PhaseValue.event)
-        self.trace.log(f"Fridge filled ({len(self.fridge)}: {self.fridge}")
+        self.trace.log("Fridge filled ({}: {}", len(self.fridge), self.fridge)
 
     def reassign_ondernemers_from_the_fridge(self):
         all_allocated = True
@@ -233,14 +412,14 @@ class OptimizationStrategy(BaseStrategy):
                     all_allocated = False
             else:
                 all_allocated = False
-                self.trace.log(f"Could not reassign ondernemer from fridge: {soll}")
+                self.trace.log("Could not reassign ondernemer from fridge: {}", soll)
         return all_allocated
 
     def optimize_assignment(self, ondernemer, limit):
         self.trace.set_phase(task='optimize_assignment', group=ondernemer.status, agent=ondernemer.rank)
         self.trace.set_cycle(limit)
         current_amount_kramen = ondernemer.kramen_count
-        self.trace.log(f"Optimize assignment {ondernemer}")
+        self.trace.log("Optimize assignment {}", ondernemer)
         size = min(limit, self.markt.max_aantal_kramen_per_ondernemer)
         branche = ondernemer.branche
         if branche.max:
@@ -273,60 +452,223 @@ class OptimizationStrategy(BaseStrategy):
             ondernemer = self.markt.ondernemers.ondernemers_map[_ondernemer.rank]
             self.trace.set_phase(task='optimize_assignment', group=ondernemer.status, agent=ondernemer.rank)
             if ondernemer.has_verplichte_branche:
-                self.trace.log(f"Ondernemer has verplichte branche, skipping {ondernemer}")
+                self.trace.log("Ondernemer has verplichte branche, skipping {}", ondernemer)
                 continue
             if ondernemer.kramen_count >= limit:
-                self.trace.log(f"Ondernemer already at limit {limit}, skipping {ondernemer}")
+                self.trace.log("Ondernemer already at limit {}, skipping {}", limit, ondernemer)
                 continue
             if ondernemer.kramen_count >= ondernemer.max:
-                self.trace.log(f"Ondernemer already at max, skipping {ondernemer}")
+                self.trace.log("Ondernemer already at max, skipping {}", ondernemer)
                 continue
+            self.markt.check_deadline()
             working_copies.append(self.markt.get_working_copy())
             self.fill_fridge_with_soll_with_anywhere(exclude_ondernemer=ondernemer)
             self.optimize_assignment(ondernemer, limit)
             all_allocated = self.reassign_ondernemers_from_the_fridge()
             if not all_allocated:
                 self.markt.report_indeling()
-                self.trace.log(f"Could not optimize assignment for {ondernemer}, fallback to previous markt state")
+                self.trace.log("Could not optimize assignment for {}, fallback to previous markt state", ondernemer)
                 self.markt.restore_working_copy(working_copies[-1])
                 self.markt.report_indeling()
                 raise HaltOptimizationException()
             else:
                 self.markt.report_indeling()
 
-    def swap_ondernemers(self):
-        swappers = set()
-        ondernemers = self.markt.ondernemers.select(allocated=True)
+    def get_swap_cycles(self):
+        """
+        The allocated ondernemers that prefer exactly the kramen of another ondernemer with the same status and
+        the same amount of kramen form a preference graph. An ondernemer points to at most one other ondernemer,
+        so the cycles are found by following the pointers once: a cycle of two is a swap,
+        a longer cycle passes the kramen on to the next ondernemer.
+        """
+        ondernemers = [ondernemer for ondernemer in self.markt.ondernemers.select(allocated=True) if ondernemer.kramen]
+        owners = {(ondernemer.status, frozenset(ondernemer.kramen)): ondernemer for ondernemer in ondernemers}
+        wants = {}
+        for ondernemer in ondernemers:
+            partner = owners.get((ondernemer.status, frozenset(ondernemer.prefs)))
+            if partner is not None and partner != ondernemer and len(partner.kramen) == len(ondernemer.kramen):
+                wants[ondernemer] = partner
+
+        cycles = []
+        visited = set()
         for ondernemer in ondernemers:
-            for partner in ondernemers:
-                if (ondernemer.rank != partner.rank
-                        and ondernemer.kramen and len(ondernemer.kramen) == len(partner.kramen)
-                        and ondernemer.status == partner.status
-                        and set(ondernemer.prefs) == partner.kramen
-                        and set(partner.prefs) == ondernemer.kramen):
-                    swap = sorted([ondernemer, partner], key=attrgetter('rank'))
-                    swap = tuple(swap)
-                    swappers.add(swap)
+            path = []
+            positions = {}
+            while ondernemer in wants and ondernemer not in visited:
+                visited.add(ondernemer)
+                positions[ondernemer] = len(path)
+                path.append(ondernemer)
+                ondernemer = wants[ondernemer]
+            if ondernemer in positions:
+                cycle = path[positions[ondernemer]:]
+                first = cycle.index(min(cycle, key=attrgetter('rank')))
+                cycles.append(tuple(cycle[first:] + cycle[:first]))
+        return sorted(cycles, key=lambda cycle: cycle[0].rank)
+
+    def swap_ondernemers(self):
+        swappers = self.get_swap_cycles()
         if swappers:
             self.markt.report_indeling()
 
-        for ondernemer, partner in swappers:
+        for swap in swappers:
+            ondernemer = swap[0]
             self.trace.set_phase(task='swap_ondernemers', group=ondernemer.status, agent=ondernemer.rank)
-            self.trace.log(f"Swapping kramen from {ondernemer} and {partner}")
-            all_kramen = [self.markt.kramen.kramen_map[kraam_id] for kraam_id in [*ondernemer.kramen, *partner.kramen]]
+            self.trace.log(lambda: f"Swapping kramen from {' and '.join(str(partner) for partner in swap)}")
+            all_kramen = [self.markt.kramen.kramen_map[kraam_id] for partner in swap for kraam_id in partner.kramen]
             verplichte_branche_diversity = set([kraam.has_verplichte_branche for kraam in all_kramen])
             kraam_type_diversity = set([kraam.kraam_type.get_active() for kraam in all_kramen])
             if not (len(verplichte_branche_diversity) == 1 and len(kraam_type_diversity) == 1):
                 continue
 
-            self.markt.unassign_all_kramen_from_ondernemer(ondernemer)
-            self.markt.unassign_all_kramen_from_ondernemer(partner)
-            for pref in ondernemer.prefs:
-                kraam = self.markt.kramen.kramen_map[pref]
-                kraam.assign(ondernemer)
-            for pref in partner.prefs:
-                kraam = self.markt.kramen.kramen_map[pref]
-                kraam.assign(partner)
+            for partner in swap:
+                self.markt.unassign_all_kramen_from_ondernemer(partner)
+            for partner in swap:
+                for pref in partner.prefs:
+                    kraam = self.markt.kramen.kramen_map[pref]
+                    kraam.assign(partner)
 
         if swappers:
             self.markt.report_indeling()
+
+
+class LocalSearchOptimizationStrategy(OptimizationStrategy):
+    """
+    Optimizes the current assignment with small steps, evaluated without placing anybody from scratch:
+    - expand: an ondernemer gets an adjacent free kraam
+    - displace: an ondernemer gets an adjacent kraam of a less senior soll with anywhere,
+      that soll moves to another free cluster of the same size
+    - move: an ondernemer moves to a free cluster of the same size that better matches the prefs
+    The ondernemers are visited in seniority order, until a pass brings no improvement or the budget is spent.
+    Every step adds a kraam or improves the prefs of one ondernemer without taking kramen from anybody,
+    so the search ends. Finally the swaps are done like the OptimizationStrategy does.
+    """
+
+    def __init__(self, markt, time_budget=LOCAL_SEARCH_TIME_BUDGET, max_iterations=LOCAL_SEARCH_MAX_ITERATIONS,
+                 **filter_kwargs):
+        super().__init__(markt, **filter_kwargs)
+        self.time_budget = time_budget
+        self.max_iterations = max_iterations
+        self.iterations = 0
+        self.search_deadline = None
+        self.positions = {}
+        for row in self.markt.kramen.rows:
+            for index, kraam in enumerate(row):
+                self.positions[kraam.id] = (row, index)
+
+    def run(self):
+        self.trace.set_phase(story='optimize_all')
+        self.search_deadline = time.monotonic() + self.time_budget
+        ondernemers = self.markt.ondernemers.select(status__in=[*ALL_VPH_STATUS, Status.SOLL], kraam_type=None)
+        ondernemers = [ondernemer for ondernemer in sorted(ondernemers, key=attrgetter('seniority'))
+                       if not ondernemer.has_verplichte_branche]
+
+        try:
+            self.search(ondernemers)
+        except DeadlineExceededException:
+            self.stop_at_deadline()
+            raise
+        self.markt.report_indeling()
+
+        self.trace.set_cycle()
+        self.swap_ondernemers()
+        self.finish()
+
+    def search(self, ondernemers):
+        improved = True
+        while improved and not self.is_budget_spent():
+            improved = False
+            for ondernemer in ondernemers:
+                if self.is_budget_spent():
+                    self.trace.log("Local search budget spent after {} iterations", self.iterations)
+                    break
+                self.markt.check_deadline()
+                self.iterations += 1
+                if ondernemer.kramen and self.improve(ondernemer):
+                    improved = True
+
+    def is_budget_spent(self):
+        return self.iterations >= self.max_iterations or time.monotonic() > self.search_deadline
+
+    def improve(self, ondernemer):
+        self.trace.set_phase(task='local_search', group=ondernemer.status, agent=ondernemer.rank)
+        return self.expand(ondernemer) or self.move(ondernemer)
+
+    def get_adjacent_kramen(self, ondernemer):
+        adjacent_kramen = []
+        for kraam_id in ondernemer.kramen:
+            row, index = self.positions[kraam_id]
+            for neighbour_index in index - 1, index + 1:
+                if 0 <= neighbour_index < len(row):
+                    neighbour = row[neighbour_index]
+                    if neighbour.id not in ondernemer.kramen and not neighbour.is_blocked:
+                        adjacent_kramen.append(neighbour)
+        # the most preferred kramen first, also when the kraam is taken by a soll that can be displaced,
+        # of equally preferred kramen the free ones first
+        return sorted(adjacent_kramen, key=lambda kraam: (
+            -Cluster([kraam]).calculate_cluster_matching_prefs_score(ondernemer.prefs), kraam.ondernemer is not None))
+
+    def can_expand(self, ondernemer):
+        if ondernemer.kramen_count >= min(ondernemer.max, self.markt.max_aantal_kramen_per_ondernemer):
+            return False
+        branche = ondernemer.branche
+        return not (branche.max and branche.assigned_count + 1 > branche.max)
+
+    def can_be_displaced(self, soll, ondernemer):
+        return (soll.status == Status.SOLL and soll.anywhere and not soll.kraam_type
+                and not soll.has_verplichte_branche and ondernemer.has_better_seniority_than(soll))
+
+    def expand(self, ondernemer):
+        if not self.can_expand(ondernemer):
+            return False
+        for kraam in self.get_adjacent_kramen(ondernemer):
+            if not kraam.does_allow(ondernemer):
+                continue
+            if kraam.ondernemer is None:
+                self.trace.log("Expanding {} with kraam {}", ondernemer, kraam.id)
+                kraam.assign(ondernemer)
+                self.trace.add_counters(local_search_expand=1)
+                return True
+            soll = self.markt.ondernemers.ondernemers_map[kraam.ondernemer]
+            if self.can_be_displaced(soll, ondernemer):
+                cluster = self.get_new_cluster(soll, exclude=kraam.id)
+                if cluster:
+                    self.trace.log("Expanding {} with kraam {}, moving {} to {}", ondernemer, kraam.id, soll, cluster)
+                    self.markt.unassign_all_kramen_from_ondernemer(soll)
+                    for new_kraam in cluster.kramen:
+                        new_kraam.assign(soll)
+                    kraam.assign(ondernemer)
+                    self.trace.add_counters(local_search_displace=1)
+                    return True
+        return False
+
+    def get_new_cluster(self, soll, exclude):
+        clusters = [cluster for cluster in self.markt.kramen.find_clusters(soll.kramen_count, soll)
+                    if exclude not in cluster.kramen_list and cluster.is_allowed(soll)]
+        if not clusters:
+            return None
+        return max(clusters, key=lambda cluster: cluster.calculate_cluster_matching_prefs_score(soll.prefs))
+
+    def move(self, ondernemer):
+        if not (ondernemer.can_move and ondernemer.prefs):
+            return False
+        current_kramen = [self.markt.kramen.kramen_map[kraam_id] for kraam_id in ondernemer.kramen]
+        current_score = Cluster(current_kramen).calculate_cluster_matching_prefs_score(ondernemer.prefs)
+        best_cluster, best_score = None, current_score
+        for cluster in self.markt.kramen.find_clusters(ondernemer.kramen_count, ondernemer):
+            score = cluster.calculate_cluster_matching_prefs_score(ondernemer.prefs)
+            if score > best_score and cluster.is_allowed(ondernemer):
+                best_cluster, best_score = cluster, score
+        if best_cluster is None:
+            return False
+        self.trace.log("Moving {} to {}", ondernemer, best_cluster)
+        self.markt.unassign_all_kramen_from_ondernemer(ondernemer)
+        for kraam in best_cluster.kramen:
+            kraam.assign(ondernemer)
+        self.trace.add_counters(local_search_move=1)
+        return True
+
+
+OPTIMIZATION_STRATEGIES = {
+    'fridge': OptimizationStrategy,
+    'local_search': LocalSearchOptimizationStrategy,
+}
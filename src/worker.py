@@ -3,19 +3,60 @@ import os
 import traceback
 import sys
 import json
+import multiprocessing
 import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from random import randint
 from kjk.allocation import Allocator
 from kjk.inputdata import RedisDataprovider
 from kjk.logging import clog
 from kjk.mail import KjKEmailclient
+from kjk.outbox import Outbox
+from kjk.storage import (
+    JobStore,
+    MemoryResultCache,
+    RedisResultCache,
+    get_cache_key,
+    get_input_hash,
+    ALLOCATION_CACHE,
+)
 from v2.allocate import parse_and_allocate as allocate_v2
+from v2.conf import trace, ENGINE_SETTINGS, OPTIMIZER, TIME_BUDGETED_OPTIMIZERS
 
 SAVE_JOB_DATA = True
 
+# number of allocations running in parallel, every allocation runs in its own process
+ALLOCATION_WORKERS = int(os.getenv("ALLOCATION_WORKERS", "1"))
+
+# with ALLOCATION_JOBS_PER_CHILD > 0 the jobs run in a child process forked from the worker,
+# a new child is forked after every ALLOCATION_JOBS_PER_CHILD jobs
+ALLOCATION_JOBS_PER_CHILD = int(os.getenv("ALLOCATION_JOBS_PER_CHILD", "0"))
+
 ALLOCATION_MODE_CONCEPT = "concept"
 ALLOCATION_MODE_SCHEDULED = "scheduled"
 
+# the job data can ask for a slim result ("resultMode": "slim") with only the
+# toewijzingen, afwijzingen and markt identifiers instead of the echoed input,
+# optionally with a hash of the input ("inputHash": true)
+RESULT_MODE_FULL = "full"
+RESULT_MODE_SLIM = "slim"
+
+
+def save_job_data(job_res):
+    # write and rename, parallel jobs should never leave a mixed up job.json
+    data = json.loads(job_res)["data"]
+    tmp_file_name = f"job.json.{os.getpid()}"
+    f = open(tmp_file_name, "w")
+    json.dump(data, f, indent=4)
+    f.close()
+    os.replace(tmp_file_name, "job.json")
+
+
+def send_status_email(email_text):
+    email_client = KjKEmailclient()
+    email_client.send_mail(email_text)
+
 
 class JobDispatcher:
     """
@@ -35,20 +76,37 @@ class JobDispatcher:
 
     """
 
-    def __init__(self):
-        self.r = redis.StrictRedis(
+    def __init__(self, workers=ALLOCATION_WORKERS, result_cache=ALLOCATION_CACHE,
+                 jobs_per_child=ALLOCATION_JOBS_PER_CHILD):
+        self.workers = workers
+        self.jobs_per_child = jobs_per_child
+        self.r = self.get_redis_client()
+        self.result_cache = self.create_result_cache(result_cache)
+        self.outbox = Outbox()
+        self.waiting = "kjk-alloc:allocation:waiting"
+        self.active = "kjk-alloc:allocation:active"
+        self.jobs = "kjk-alloc:allocation:jobs"
+        self.success = "kjk-alloc:allocation:succeeded"
+        self.failed = "kjk-alloc:allocation:failed"
+
+    @staticmethod
+    def get_redis_client(decode_responses=True):
+        return redis.StrictRedis(
             host=os.getenv("REDIS_HOST"),
             port=os.getenv("REDIS_PORT"),
             db=0,
             password=os.getenv("REDIS_PASSWORD"),
             charset="utf-8",
-            decode_responses=True,
+            decode_responses=decode_responses,
         )
-        self.waiting = "kjk-alloc:allocation:waiting"
-        self.active = "kjk-alloc:allocation:active"
-        self.jobs = "kjk-alloc:allocation:jobs"
-        self.success = "kjk-alloc:allocation:succeeded"
-        self.failed = "kjk-alloc:allocation:failed"
+
+    def create_result_cache(self, result_cache):
+        if result_cache == "memory":
+            return MemoryResultCache()
+        if result_cache == "redis":
+            # the cached results can be compressed
+            return RedisResultCache(self.get_redis_client(decode_responses=False))
+        return None
 
     def list_keys(self):
         keys = self.r.keys()
@@ -56,92 +114,251 @@ class JobDispatcher:
             key_type = self.r.type(k)
             print(k, " -> ", key_type)
 
-    def process_job(self, job_id):
+    def process_job(self, job_id, store):
         print("processing .....")
         job_res = self.r.hget(self.jobs, job_id)
 
-        # store input in REDIS for 30 secs
+        # store input in REDIS for 10 min
         # to grab the input for debugging
-        self.r.set(f"JOB_{job_id}", job_res)
-        self.r.expire(f"JOB_{job_id}", 10 * 60)
+        store.set(f"JOB_{job_id}", job_res, 10 * 60)
 
         job = json.loads(job_res)
         start = time.time()
         data = job["data"]
         allocation_mode = data["mode"]
         if SAVE_JOB_DATA:
-            f = open("job.json", "w")
-            json.dump(data, f, indent=4)
-            f.close()
+            # the debug dump can be skipped if the outbox is full
+            self.outbox.send(save_job_data, job_res, optional=True)
 
-        version = data.get("version", '1')
-        print(f"Allocation version: {version}")
-        if version == '2':
-            output, logs = allocate_v2(data)
-            log_result = json.dumps(logs)
+        # concept allocations are often started again with the same input,
+        # scheduled allocations always run because they send the status email
+        # and the output of a time budgeted optimizer can differ from run to run
+        use_cache = (
+            self.result_cache is not None
+            and allocation_mode == ALLOCATION_MODE_CONCEPT
+            and OPTIMIZER not in TIME_BUDGETED_OPTIMIZERS
+        )
+        cache_key = get_cache_key(data, ENGINE_SETTINGS) if use_cache else None
+        cached = self.result_cache.get(cache_key) if use_cache else None
+        if cached is None:
+            output, log_result, clog_logs = self.allocate(data)
+            json_result = json.dumps(output)
+            # an allocation cut short by the deadline can complete in a next run
+            if use_cache and "truncated" not in output:
+                self.result_cache.set(cache_key, json.dumps([json_result, log_result]))
         else:
-            dp = RedisDataprovider(job["data"])
-            a = Allocator(dp)
-            output = a.get_allocation()
-            log_result = json.dumps(clog.get_logs())
+            print("Allocation result from cache")
+            json_result, log_result = json.loads(cached)
+            clog_logs = []
 
         # store results in REDIS for 10 min
-        output['version'] = version
-        json_result = json.dumps(output)
-        self.r.set(f"RESULT_{job_id}", json_result)
-        self.r.expire(f"RESULT_{job_id}", 10 * 60)
+        store.set(f"RESULT_{job_id}", json_result, 10 * 60)
 
         # store logs in REDIS for 10 min
-        self.r.set(f"LOGS_{job_id}", log_result)
-        self.r.expire(f"LOGS_{job_id}", 10 * 60)
+        store.set(f"LOGS_{job_id}", log_result, 10 * 60)
 
         if allocation_mode != ALLOCATION_MODE_CONCEPT:
             print("Sending status email to marktbureau.")
-            email_client = KjKEmailclient()
             email_text = ""
-            for log_line in clog.get_logs():
+            for log_line in clog_logs:
                 if log_line["level"] in ("ERROR"):
                     email_text += log_line["message"] + "\n"
-            email_client.send_mail(email_text)
+            self.outbox.send(send_status_email, email_text)
 
         clog.purge()
         stop = time.time()
         print("Concept allocation completed in ", round(stop - start, 2), "sec")
 
-    def wait_for_jobs(self):
-        print("waiting for allocation jobs...")
-        # self.list_keys()
-        job_id = self.r.brpoplpush(self.waiting, self.active)
+    def allocate(self, data):
+        """returns the output, the json logs and the clog logs of the allocation"""
+        version = data.get("version", '1')
+        result_mode = data.get("resultMode", RESULT_MODE_FULL)
+        slim = result_mode == RESULT_MODE_SLIM
+        print(f"Allocation version: {version}, result mode: {result_mode}")
+        if version == '2':
+            output, logs = allocate_v2(data, slim=slim)
+            log_result = json.dumps(logs)
+            clog_logs = clog.get_logs()
+        else:
+            dp = RedisDataprovider(data)
+            a = Allocator(dp)
+            output = a.get_allocation(slim=slim)
+            clog_logs = a.get_logs()
+            log_result = json.dumps(clog_logs)
+
+        output['version'] = version
+        if slim:
+            # tells the client the slim result mode is supported
+            output['resultMode'] = RESULT_MODE_SLIM
+            if data.get("inputHash"):
+                output['inputHash'] = get_input_hash(data)
+        return output, log_result, clog_logs
+
+    def handle_job(self, job_id):
+        """
+        process a job and do the bee queue bookkeeping,
+        everything the job writes to REDIS is written in one transaction at the end
+        """
+        clog.purge()
+        trace.clear()
+        store = JobStore(self.r)
         try:
-            self.process_job(job_id)
-            self.r.sadd(self.success, job_id)
-            self.r.lrem(self.active, 0, job_id)
-            self.r.hdel(self.jobs, job_id)
+            self.process_job(job_id, store)
+            store.pipeline.sadd(self.success, job_id)
+            store.pipeline.lrem(self.active, 0, job_id)
+            store.pipeline.hdel(self.jobs, job_id)
+            store.execute()
         except Exception as e:
             print("Error: ", e)
             print("-" * 60)
             traceback.print_exc(file=sys.stdout)
             error_str = traceback.format_exc()
             print("-" * 60)
+            self.fail_job(job_id, error_str, store)
+        finally:
+            # the next job in this process starts with empty logs
+            clog.purge()
+            trace.clear()
+
+    def fail_job(self, job_id, error_str, store=None):
+        # the store can already hold the writes of the failed job (JOB_ input for debugging)
+        if store is None:
+            store = JobStore(self.r)
+        # store error in REDIS for 10 min
+        error_id = randint(10000, 99999)
+        json_result = json.dumps(
+            {
+                "error": "Sorry, er is een fout opgetreden in deze indeling.",
+                "error_id": f"{error_id}",
+                "job_id": f"{job_id}",
+            }
+        )
+        store.set(f"RESULT_{job_id}", json_result, 10 * 60)
+        store.set(f"ERROR_{error_id}", error_str, 24 * 60 * 60)
+
+        store.pipeline.sadd(self.failed, job_id)
+        store.pipeline.hdel(self.jobs, job_id)
+        store.pipeline.lrem(self.active, 0, job_id)
+        store.execute()
+
+    def wait_for_jobs(self):
+        print("waiting for allocation jobs...")
+        if self.workers > 1:
+            self.wait_for_jobs_in_pool()
+            return
+        if self.jobs_per_child > 0:
+            self.wait_for_jobs_in_child()
+            return
+        while True:
+            job_id = self.r.brpoplpush(self.waiting, self.active)
+            self.handle_job(job_id)
+            print("waiting for allocation jobs...")
 
-            # store error in REDIS for 10 min
-            error_id = randint(10000, 99999)
-            json_result = json.dumps(
-                {
-                    "error": "Sorry, er is een fout opgetreden in deze indeling.",
-                    "error_id": f"{error_id}",
-                    "job_id": f"{job_id}",
-                }
-            )
-            self.r.set(f"RESULT_{job_id}", json_result)
-            self.r.expire(f"RESULT_{job_id}", 10 * 60)
-            self.r.set(f"ERROR_{error_id}", error_str)
-            self.r.expire(f"ERROR_{error_id}", 24 * 60 * 60)
-
-            self.r.sadd(self.failed, job_id)
-            self.r.hdel(self.jobs, job_id)
-            self.r.lrem(self.active, 0, job_id)
-        self.wait_for_jobs()
+    def wait_for_jobs_in_pool(self):
+        """
+        Run up to self.workers allocations in parallel.
+        A job is only taken from the waiting list when a worker process is free,
+        the worker processes do the bookkeeping of the jobs themselves.
+        """
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_pool_worker)
+        in_flight = set()
+        while True:
+            if len(in_flight) >= self.workers:
+                _done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                continue
+            job_id = self.r.brpoplpush(self.waiting, self.active)
+            print(f"job {job_id} started, {len(in_flight) + 1} jobs in progress")
+            try:
+                future = pool.submit(handle_job_in_pool_worker, job_id)
+            except BrokenProcessPool:
+                # a worker process died (oom killer), start with a fresh pool
+                pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_pool_worker)
+                in_flight = set()
+                future = pool.submit(handle_job_in_pool_worker, job_id)
+            future.add_done_callback(self._check_pool_job(job_id))
+            in_flight.add(future)
+
+    def wait_for_jobs_in_child(self):
+        """
+        Run the jobs in a child process forked from this worker.
+        The worker has imported both allocation engines before the fork, so a child starts
+        warm and with clean state. The child is forked before the worker waits for a job,
+        so it has set up its dispatcher by the time a job arrives. After jobs_per_child jobs
+        the child exits and the next child is forked, so leaked memory can not accumulate.
+        """
+        context = multiprocessing.get_context("fork")
+        child = None
+        while True:
+            if child is None:
+                child, connection = self._fork_child(context)
+                num_jobs = 0
+            job_id = self.r.brpoplpush(self.waiting, self.active)
+            if not child.is_alive():
+                # the child died while it was waiting, the job goes to a fresh child
+                child.join()
+                child, connection = self._fork_child(context)
+                num_jobs = 0
+            try:
+                connection.send(job_id)
+                connection.recv()
+            except (EOFError, OSError):
+                # the child died before it could do the bookkeeping (oom killer)
+                child.join()
+                self.fail_job(job_id, f"Allocation process stopped with exit code {child.exitcode}")
+                child = None
+                continue
+            num_jobs += 1
+            if num_jobs >= self.jobs_per_child:
+                connection.send(None)
+                child.join()
+                child = None
+            print("waiting for allocation jobs...")
+
+    def _fork_child(self, context):
+        connection, child_connection = context.Pipe()
+        child = context.Process(target=run_child_worker, args=(child_connection,), daemon=True)
+        child.start()
+        child_connection.close()
+        return child, connection
+
+    def _check_pool_job(self, job_id):
+        def check(future):
+            error = future.exception()
+            if error is not None:
+                # the worker process died before it could do the bookkeeping
+                self.fail_job(job_id, repr(error))
+
+        return check
+
+
+# one dispatcher (and redis connection) per worker process
+pool_worker_dispatcher = None
+
+
+def init_pool_worker():
+    global pool_worker_dispatcher
+    pool_worker_dispatcher = JobDispatcher(workers=1)
+
+
+def handle_job_in_pool_worker(job_id):
+    pool_worker_dispatcher.handle_job(job_id)
+
+
+def run_child_worker(connection):
+    """handles the job ids sent by the worker until it sends None"""
+    dispatcher = JobDispatcher(workers=1, jobs_per_child=0)
+    while True:
+        try:
+            job_id = connection.recv()
+        except EOFError:
+            # the worker stopped
+            break
+        if job_id is None:
+            break
+        dispatcher.handle_job(job_id)
+        connection.send(job_id)
+    # a child process exits without running the atexit handlers
+    dispatcher.outbox.close()
 
 
 if __name__ == "__main__":